@@ -0,0 +1,82 @@
+"""
+Buffered user.last_active updates.
+Requests only record the time in a dict; a background thread writes them in one bulk UPDATE every few seconds,
+ so user facing requests (polls, page loads) dont wait for a write transaction.
+"""
+
+import atexit
+import os
+import threading
+from datetime import datetime
+from typing import Dict, Optional
+
+from sqlalchemy import sql
+
+from . import log, C, db
+
+
+class LastActiveTracker:
+    """
+    Collects last active times of users and flushes them to user table every `interval` seconds,
+     and at exit. The worker thread starts on first use, so each (forked) server process gets its own.
+    """
+
+    def __init__(self, app, interval=C.LAST_ACTIVE_FLUSH_INTERVAL) -> None:
+        assert interval > 0
+        self.app = app
+        self.interval = interval
+        self._pending: Dict[str, datetime] = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._worker: Optional[threading.Thread] = None
+        self._pid = None
+        atexit.register(self.close)
+
+    def touch(self, user_id: str, when: Optional[datetime] = None):
+        with self._lock:
+            self._pending[user_id] = when or datetime.now()
+            if self._worker is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._stop.clear()
+                self._worker = threading.Thread(target=self._run, name='last-active', daemon=True)
+                self._worker.start()
+
+    def pending(self, user_id: str) -> Optional[datetime]:
+        """Time that is not yet written to db"""
+        return self._pending.get(user_id)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.flush()
+            except Exception as e:
+                log.exception(e)
+
+    def flush(self) -> int:
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        from .model import User
+        user = User.__table__
+        # other server processes may have written a later time; never go back
+        stmt = user.update().where(user.c.id == sql.bindparam('_id'),
+                                   sql.or_(user.c.last_active.is_(None), user.c.last_active < sql.bindparam('_time')))\
+            .values(last_active=sql.bindparam('_time'))
+        try:
+            with self.app.app_context(), db.engine.begin() as conn:
+                conn.execute(stmt, [dict(_id=user_id, _time=time) for user_id, time in pending.items()])
+        except Exception:
+            with self._lock:  # try again next time; newer times win
+                for user_id, time in pending.items():
+                    self._pending.setdefault(user_id, time)
+            raise
+        log.debug(f'Updated last_active of {len(pending)} users')
+        return len(pending)
+
+    def close(self):
+        self._stop.set()
+        try:
+            self.flush()
+        except Exception as e:
+            log.warning(f'Could not save last_active times: {e}')
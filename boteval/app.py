@@ -1,7 +1,6 @@
 import sys
 from argparse import ArgumentParser, ArgumentDefaultsHelpFormatter
 from pathlib import Path
-import importlib
 
 import flask
 from flask import Flask, Blueprint
@@ -11,7 +10,9 @@ from flask_login import LoginManager
 from . import log, __version__, db, C, TaskConfig, R
 from .controller import user_controllers, admin_controllers, init_login_manager, register_app_hooks
 from .service import ChatService
-from .utils import register_template_filters
+from .utils import register_template_filters, load_dir_as_module
+from .schema import upgrade_schema
+from .database import init_engine, init_sqlite
 
 
 app = Flask(__name__)
@@ -42,19 +43,6 @@ def parse_args():
     args = vars(parser.parse_args())
     return args
 
-def load_dir_as_module(dir_path: Path):
-    log.info(f'Going to import {dir_path} as a python module.')
-    module_name = dir_path.name
-    parent_dir = dir_path.resolve().parent
-
-    log.info(f'adding "{parent_dir}" to PYTHONPATH and importing "{module_name}"')
-    assert module_name not in sys.modules, f'{module_name} collide with existing module. please rename dir to something else'
-    sys.path.append(str(parent_dir))
-
-    _module = importlib.import_module(module_name)
-    log.info(f'import success! {_module=}')
-
-
 def init_app(**args):
 
     R._register_all()  # register all modules
@@ -73,22 +61,27 @@ def init_app(**args):
         db_uri = f'sqlite:///{task_dir.resolve()}/{db_file_name}'
         app.config['SQLALCHEMY_DATABASE_URI'] = db_uri
         log.info(f'SQLALCHEMY_DATABASE_URI = {db_uri}')
+    init_engine(app)
 
     if (task_dir / '__init__.py').exists(): # task dir has python code
         log.info(f'{task_dir} is a python module. Going to import it.')
         load_dir_as_module(task_dir)
 
     service = ChatService(config=config, task_dir=task_dir)
+    app.extensions['boteval'] = service  # for scripts and tests that need the service outside of controllers
 
     with app.app_context():
         login_manager.init_app(app)
         db.init_app(app)
+        init_sqlite(app, db)
         db.create_all(app=app)
+        upgrade_schema()  # existing databases: add new indexes and columns
         service.init_db()
         init_login_manager(login_manager=login_manager)
         register_app_hooks(app, service)
         register_template_filters(app)
-
+        # uwsgi forks workers after loading app; pooled connections must not be shared by processes
+        db.engine.dispose()
 
     bp = Blueprint('app', __name__, template_folder='templates', static_folder='static')
     user_controllers(router=bp, service=service)
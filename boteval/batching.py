@@ -0,0 +1,132 @@
+"""
+Dynamic micro-batching: items submitted by concurrent request threads are grouped into small batches
+ and processed together, e.g. one model.generate() call for many chat threads.
+"""
+
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, List
+
+from . import log, C
+
+
+class MicroBatcher:
+    """
+    Collects items from concurrent callers and processes them in batches on a worker thread.
+    A batch is dispatched when it has `max_batch_size` items, or when `max_wait` seconds have passed
+     since its first item arrived, whichever is earlier.
+
+    :param process_batch: function that maps a list of items to a list of results (same length and order)
+    """
+
+    _STOP = object()
+
+    def __init__(self, process_batch: Callable[[List[Any]], List[Any]],
+                 max_batch_size=C.DEF_BATCH_SIZE, max_wait=C.DEF_BATCH_WAIT, name='batcher') -> None:
+        assert max_batch_size >= 1
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.name = name
+        self._queue = queue.Queue()
+        self._worker = None
+        self._closed = False
+        self._lock = threading.Lock()  # guards worker, closed flag and stats
+        self._stats = dict(requests=0, batches=0, errors=0, total_latency=0.0, max_latency=0.0,
+                           total_process_time=0.0, start_time=time.time())
+
+    def submit(self, item) -> Future:
+        """Submits item for processing; raises RuntimeError if this batcher is closed"""
+        future = Future()
+        with self._lock:
+            if self._closed:
+                raise RuntimeError(f'{self.name} is closed')
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name=self.name, daemon=True)
+                self._worker.start()
+            # enqueued under the lock, so no item lands behind the stop signal of close()
+            self._queue.put((item, future, time.time()))
+        return future
+
+    def __call__(self, item, timeout=None):
+        """Submits item and waits for its result"""
+        return self.submit(item).result(timeout=timeout)
+
+    def close(self):
+        """Stops the worker after the items already submitted are processed; later submit()s raise"""
+        with self._lock:
+            self._closed = True
+            if self._worker is not None:
+                self._queue.put(self._STOP)
+                self._worker = None
+
+    def _next_batch(self) -> List:
+        first = self._queue.get()
+        if first is self._STOP:
+            return None
+        batch = [first]
+        deadline = time.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                item = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            if item is self._STOP:
+                self._queue.put(item)  # finish this batch, then stop
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        while (batch := self._next_batch()) is not None:
+            items = [item for item, _, _ in batch]
+            start = time.time()
+            try:
+                results = self.process_batch(items)
+                assert len(results) == len(items), f'Expected {len(items)} results, but got {len(results)}'
+                for (_, future, _), result in zip(batch, results):
+                    future.set_result(result)
+            except Exception as e:
+                log.exception(e)
+                failed = True
+                for _, future, _ in batch:
+                    future.set_exception(e)
+            else:
+                failed = False
+            end = time.time()
+            if self._update_stats(batch, start, end, failed=failed) % C.BATCH_STATS_LOG_FREQ == 0:
+                log.info(f'{self.name} stats: {self.stats()}')
+
+    def _update_stats(self, batch, start, end, failed=False) -> int:
+        """Adds a processed batch to stats; returns the number of batches so far"""
+        with self._lock:
+            stats = self._stats
+            stats['requests'] += len(batch)
+            stats['batches'] += 1
+            stats['errors'] += int(failed)
+            stats['total_process_time'] += end - start
+            for _, _, submit_time in batch:
+                stats['total_latency'] += end - submit_time
+                stats['max_latency'] = max(stats['max_latency'], end - submit_time)
+            return stats['batches']
+
+    def stats(self) -> Dict[str, float]:
+        """Throughput and latency stats, useful for tuning max_batch_size and max_wait"""
+        with self._lock:
+            stats = dict(self._stats)
+        n_req, n_batch = stats['requests'], stats['batches']
+        return dict(
+            requests=n_req,
+            batches=n_batch,
+            errors=stats['errors'],
+            avg_batch_size=n_req / n_batch if n_batch else 0.0,
+            avg_latency=stats['total_latency'] / n_req if n_req else 0.0,  # secs; from submit to result
+            max_latency=stats['max_latency'],
+            avg_batch_time=stats['total_process_time'] / n_batch if n_batch else 0.0,  # secs
+            throughput=n_req / max(time.time() - stats['start_time'], 1e-6),  # requests per sec
+        )
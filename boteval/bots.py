@@ -2,22 +2,34 @@
 
 
 import argparse
+import copy
+import threading
+import weakref
 from typing import Any, Dict, List
 
 
-from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
+from cachetools import TTLCache
 
 from . import log, C, R
+from .hub import hub
+from .batching import MicroBatcher
 
 
 # here are other models https://huggingface.co/models?pipeline_tag=conversational&sort=downloads
 BLENDERBOT_400M = "facebook/blenderbot-400M-distill"
 BLENDERBOT_90M = "facebook/blenderbot_small-90M"
 
+# guards session counts of all agents; held only for a few increments, so one lock is enough.
+# reentrant, as a garbage collection while holding it may finalize a session
+_sessions_lock = threading.RLock()
+
 
 class BotAgent:
     
     NAME = None
+    # sessions (see new_session) that are alive; an unloaded agent is closed when its last session is gone
+    _num_sessions = 0
+    _unloaded = False
     
     def __init__(self, *args, name=None, **kwargs) -> None:
         self.name = name or self.NAME
@@ -34,6 +46,48 @@ class BotAgent:
     def hear(self, msg: Dict[str, Any]):
         self.last_msg = msg
 
+    def new_session(self) -> 'BotAgent':
+        """
+        Creates a bot for one conversation (i.e., chat thread), with its own conversation state.
+        Heavy resources such as models, tokenizers and API clients are shared with this agent by reference.
+        Attributes that are lists, dicts, or sets are copied so sessions dont leak state into each other.
+        Bots keeping any other mutable conversation state should override this method and reset it.
+        """
+        session = copy.copy(self)
+        for key, val in vars(self).items():
+            if isinstance(val, (list, dict, set)):
+                setattr(session, key, copy.copy(val))
+        session.last_msg = None
+        with _sessions_lock:
+            self._num_sessions += 1
+        # session holds this agent's resources by reference, so they are closed only after it is garbage collected,
+        #  i.e. it is neither cached nor serving a request anymore
+        weakref.finalize(session, self._end_session)
+        return session
+
+    def _end_session(self):
+        with _sessions_lock:
+            self._num_sessions -= 1
+            idle = self._unloaded and self._num_sessions == 0
+        if idle:
+            self.close()
+
+    @property
+    def unloaded(self) -> bool:
+        return self._unloaded
+
+    def unload(self):
+        """Called when this agent is evicted; closes it now if it has no live sessions, else after the last one"""
+        with _sessions_lock:
+            self._unloaded = True
+            idle = self._num_sessions == 0
+        if idle:
+            self.close()
+
+    def close(self):
+        """Releases resources (e.g. models) held by this agent; called when the agent is unloaded and has no sessions"""
+        pass
+
     def talk(self) -> Dict[str, Any]:
         raise NotImplementedError(f'{type(self)} must implement talk() method')
 
@@ -72,24 +126,66 @@ class TransformerBot(BotAgent):
 
     NAME = 'transformers'
 
-    def __init__(self, model_name=BLENDERBOT_90M, **kwargs) -> None:
+    def __init__(self, model_name=BLENDERBOT_90M, dtype=None, batching=None, **kwargs) -> None:
+        """
+        :param model_name: huggingface seq2seq model name
+        :param dtype: torch dtype name for model weights, e.g. float16
+        :param batching: dict with max_batch_size and max_wait_ms; concurrent talk() calls from
+          threads are generated together in batches of at most max_batch_size, waiting at most max_wait_ms.
+        """
         super().__init__(name=f'{self.NAME}:{model_name}')
         self.model_name = model_name
+        self.dtype = dtype
         self.update_signature(model_name=model_name)
 
-        log.info(f'Loading model {model_name}')
-        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
-        self.model = AutoModelForSeq2SeqLM.from_pretrained(model_name)
-
+        # weights are shared with other bots and transforms using the same model
+        self.tokenizer, self.model = hub.acquire(model_name, dtype=dtype)
+        self._released = False
+
+        batching = batching or {}
+        self.batcher = MicroBatcher(self.generate,
+            max_batch_size=batching.get('max_batch_size', C.DEF_BATCH_SIZE),
+            max_wait=batching.get('max_wait_ms', C.DEF_BATCH_WAIT * 1000) / 1000,
+            name=f'batcher:{model_name}')
+
+    def close(self):
+        if not self._released:
+            self._released = True
+            self.batcher.close()
+            hub.release(self.model_name, dtype=self.dtype)
+
+    def generate(self, contexts: List[str]) -> List[str]:
+        # contexts are padded to the longest in batch
+        inputs = self.tokenizer(contexts, return_tensors="pt", padding=True, truncation=True)
+        reply_ids = self.model.generate(**inputs)
+        return self.tokenizer.batch_decode(reply_ids, skip_special_tokens=True)
 
-    def talk(self) -> str:
+    def talk(self, **kwargs) -> Dict[str, Any]:
         context = (self.last_msg or {}) .get('text', '[start]')
-        inputs = self.tokenizer([context], return_tensors="pt")
-        reply_ids = self.model.generate(**inputs)
-        reply = self.tokenizer.batch_decode(reply_ids, skip_special_tokens=True)[0]
+        reply = self.batcher(context)
         return dict(text=reply)
 
 
+class BotAgentPool(TTLCache):
+    """
+    Bot agents that are currently loaded, with LRU and idle time based eviction.
+    Evicted agents are unloaded, so their resources can be reclaimed once their sessions are done.
+    """
+
+    def popitem(self):
+        key, agent = super().popitem()
+        log.info(f'Unloading least recently used bot agent {key}')
+        agent.unload()
+        return key, agent
+
+    def expire(self, time=None):
+        expired = super().expire(time)
+        for key, agent in expired:
+            log.info(f'Unloading idle bot agent {key}')
+            agent.unload()
+        return expired
+
+
 def load_bot_agent(name: str, args: Dict[str, Any]) -> BotAgent:
     # log.info(f'Going to load bot {name} with args: {args}')
     bot_engines = R.registry[R.BOT]
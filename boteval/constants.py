@@ -19,15 +19,43 @@ DEF_MAX_TURNS_PER_THREAD = 100
 DEF_REWARD = '0.0'
 
 USER_ACTIVE_UPDATE_FREQ = 2 * 60 # seconds
+LAST_ACTIVE_FLUSH_INTERVAL = 10  # seconds; buffered last_active times are written to db this often
+DIALOG_CACHE_SIZE = 256  # max dialog managers kept in memory
+DIALOG_CACHE_TTL = 30 * 60  # seconds; idle dialog managers are dropped after this
+DEF_MAX_RESIDENT_AGENTS = 8  # max bot agents loaded at a time
+DEF_AGENT_IDLE_TIME = 60 * 60  # seconds; idle bot agents are unloaded after this
+DEF_BATCH_SIZE = 8  # max requests per model.generate() call
+DEF_BATCH_WAIT = 0.02  # seconds; max time a request waits for others to join its batch
+BATCH_STATS_LOG_FREQ = 100  # log batching stats every these many batches
+DEF_MT_BATCH_SIZE = 32  # max sentences per translation generate() call
+DEF_TRANSLATION_CACHE_SIZE = 50_000  # sentences; in-memory translation cache
+DEF_PRETRANSFORM_THREADS = 16  # concurrent seed messages per process in pre-transform
+DEF_PRETRANSFORM_CHUNK = 50  # topics per work unit in multi-process pre-transform
 MAX_PAGE_SIZE = 300
+ADMIN_PAGE_SIZE = 50  # topics per page on admin dashboard
+DASHBOARD_CACHE_TTL = 10  # secs; admin dashboard aggregates are cached this long
 
 PING_WAIT_TIME = 4 # secs
+PUSH_QUEUE_SIZE = 100  # max pending events per subscriber
+PUSH_KEEPALIVE = 15  # secs; comment line is sent on idle event streams
+PUSH_RETRY = 2  # secs; clients wait this long before reconnecting to a closed event stream
+PUSH_MAX_STREAM_TIME = 5 * 60  # secs; event streams are closed after this to free server threads; clients reconnect
 MAX_TEXT_LENGTH = 2048
 
 DEF_TOPICS_FILE = 'topics.json'
 DEF_INSTRUCTIONS_FILE = 'instructions.html'
 DEF_AGREEMENT_FILE = 'user-agreement.html'
 DEF_DATABSE_FILE = 'boteval.sqlite.db'
+DEF_DB_POOL_SIZE = 10  # connections per process; server databases only (postgres, mysql)
+DEF_DB_POOL_RECYCLE = 3600  # secs; reconnect before server drops idle connections
+DEF_SQLITE_POOL_SIZE = 5  # connections per process; pooled connections skip reopening file and pragmas
+# set on each new sqlite connection; see https://www.sqlite.org/pragma.html
+DEF_SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',  # readers dont block the writer and vice versa
+    'synchronous': 'NORMAL',  # safe with WAL; fsync at checkpoints instead of every commit
+    'busy_timeout': 10_000,  # millis; wait for the write lock instead of "database is locked"
+    'mmap_size': 256 * 2**20,  # bytes; read pages via memory map
+}
 
 ENV = {}
 for env_key in ['GTAG']:
@@ -49,5 +77,18 @@ MTURK = 'mturk'
 MTURK_SANDBOX = 'mturk_sandbox'
 MTURK_SANDBOX_URL = 'https://mturk-requester-sandbox.us-east-1.amazonaws.com'
 AWS_MAX_RESULTS = 100 
+MTURK_QUAL_CACHE_TTL = 5 * 60  # secs; qualified workers lists are refreshed from mturk this often
+MTURK_SYNC_INTERVAL = 10 * 60  # secs; local mirror of HITs and assignments is synced this often; 0 to disable
+MTURK_SYNC_BATCH = 100  # rows per write transaction in mirror sync
+JOB_LAUNCH = 'launch'  # job kind: launch topics on crowd
+JOB_PAYOUT = 'payout'  # job kind: approve assignments and send bonuses
+DEF_JOB_WORKERS = 8  # concurrent items (API calls) per background job
+DEF_JOB_RETRIES = 5  # retries of a throttled API call
+DEF_JOB_BACKOFF = 1.0  # secs; wait before first retry; doubles after each
+DEF_CROWD_RATE = 5  # API calls per second to crowd service, per process
+DEF_CROWD_BURST = 10  # API calls that can be made at once, after idle
+JOB_STALE_TIME = 5 * 60  # secs; running jobs not updated for this long are taken over (e.g. after restart)
+JOB_MAX_ERROR_LEN = 1024
+HUMAN_MOD_QUALIFICATION = 'human_moderator_qualification'  # name of mturk qualification type for human moderators
 MTURK_LOG_LEVEL = logging.INFO
 
@@ -5,18 +5,22 @@ import random
 from datetime import datetime
 from threading import Thread
 import json
+import time
 
 import flask
 from flask import request, url_for, redirect, Response
 import flask_login as FL
+from sqlalchemy import orm
 
 from boteval.service import ChatService
 
 
 from . import log, C, db
-from .utils import jsonify, render_template, register_template_filters
-from .model import ChatMessage, ChatThread, ChatTopic, User, SuperTopic
+from .utils import jsonify, render_template, register_template_filters, keyset_page
+from .model import ChatMessage, ChatThread, ChatTopic, User, SuperTopic, CrowdJob, CrowdJobItem
 from .mturk import MTurkController
+from .events import format_sse
+from .activity import LastActiveTracker
 
 
 def wrap(body=None, status=C.SUCCESS, description=None):
@@ -73,25 +77,54 @@ def is_safe_url(url):
 
 def register_app_hooks(app, service: ChatService):
 
+    # last_active times are written to db in bulk by a background thread; see activity.py
+    tracker = LastActiveTracker(app, interval=app.config.get('LAST_ACTIVE_FLUSH_INTERVAL',
+                                                             C.LAST_ACTIVE_FLUSH_INTERVAL))
+
     @app.before_request
     def update_last_active():
+        if flask.request.endpoint and flask.request.endpoint.endswith('static'):
+            return  # dont load user for static files
         user:User = FL.current_user
         if user and user.is_active:
-            if not user.last_active or\
-                (datetime.now() - user.last_active).total_seconds() > C.USER_ACTIVE_UPDATE_FREQ:
-                user.last_active = datetime.now()
-                db.session.merge(user)  # update
-                db.session.commit()
+            last_active = tracker.pending(user.id) or user.last_active
+            if not last_active or\
+                (datetime.now() - last_active).total_seconds() > C.USER_ACTIVE_UPDATE_FREQ:
+                tracker.touch(user.id)
     
     @app.before_first_request
     def before_first_request():
         log.info('Before first request')
+        if service.crowd_service:  # keep local mirror of crowd tasks in sync; one worker per server process
+            service.crowd_service.mirror.start(app)
+        service.jobs.resume_all(app)  # e.g. launches that were interrupted by a restart
         ping_url = flask.url_for('app.ping', _external=True, _scheme='https')
         Thread(target=service.check_ext_url, args=(ping_url,)).start()
 
 
 def user_controllers(router, service: ChatService):
 
+    def if_thread_changed(view):
+        """
+        Conditional GET for thread polling endpoints: thread version is the ETag, and
+        if the client already has the current version (If-None-Match), we answer 304 without running the view.
+        """
+        @functools.wraps(view)
+        def wrapper(thread_id, *args, **kwargs):
+            version = service.get_thread_version(thread_id)
+            if version is None:
+                return f'Thread {thread_id}  NOT found', 404
+            # no-cache: browsers may keep the response, but must revalidate it on every poll
+            if request.if_none_match.contains(version):
+                return Response(status=304, headers={'ETag': f'"{version}"', 'Cache-Control': 'no-cache'})
+            resp = flask.make_response(view(thread_id, *args, **kwargs))
+            if resp.status_code == 200:
+                # version was read before the view; if thread changed meanwhile, the next poll just gets a 200
+                resp.set_etag(version)
+                resp.headers['Cache-Control'] = 'no-cache'
+            return resp
+        return wrapper
+
     @router.route('/ping', methods=['GET', 'POST'])
     def ping():
         return jsonify(dict(reply='pong', time=datetime.now().timestamp())), 200
@@ -267,7 +300,7 @@ def user_controllers(router, service: ChatService):
 
         thread = service.get_thread_for_topic(user=FL.current_user, topic=topic, create_if_missing=True)
         if thread is None:
-            err_msg = 'Another user is loading this chat topic. Please retry after 10 seconds!'
+            err_msg = 'This topic has no free seats left'
             log.error(err_msg)
             return err_msg, 400
 
@@ -301,7 +334,7 @@ def user_controllers(router, service: ChatService):
         instructions_for_user = service.instructions
         if topic.human_moderator == 'yes' and request_worker_id is not None and request_worker_id != '':
             req_worker_is_human_mod = service.crowd_service.is_worker_qualified(user_worker_id=request_worker_id,
-                                                                                qual_name='human_moderator_qualification')
+                                                                                qual_name=C.HUMAN_MOD_QUALIFICATION)
 
         if req_worker_is_human_mod:
             instructions_for_user = service.human_mod_instructions
@@ -334,6 +367,8 @@ def user_controllers(router, service: ChatService):
                                    instructions_html=instructions_for_user,
                                    simple_instructions_html=service.simple_instructions,
                                    show_text_extra=FL.current_user.is_admin,
+                                   push_is_shared=service.broker.is_shared,
+                                   push_streams=service.push_streams,
                                    bot_name=C.Auth.BOT_USER,
                                    data=dict())
 
@@ -392,11 +427,12 @@ def user_controllers(router, service: ChatService):
     
 
     @router.route('/thread/<thread_id>/<user_id>/latest_message', methods=['GET'])
+    @if_thread_changed
     def get_latest_message(thread_id, user_id):
         """
         Func called by the AJAX script on the user side every 5 seconds.
         """
-        thread = service.get_thread(thread_id)
+        thread = service.get_thread(thread_id, messages=False)
         if not thread:
             return f'Thread {thread_id}  NOT found', 404
         user = User.get(user_id)
@@ -408,7 +444,7 @@ def user_controllers(router, service: ChatService):
         # We only need to send the last message to the user.
         # We don't need to worry about there might be >1 messages in the last 5 seconds,
         # because one user is always blocked after sending one message.
-        latest_message: ChatMessage = thread.messages[-1]
+        latest_message: ChatMessage = service.get_latest_message(thread.id)
         reply_dict = latest_message.as_dict() | dict(updated='0')
         if latest_message.user_id != user_id:
             reply_dict['updated'] = '1'
@@ -418,10 +454,66 @@ def user_controllers(router, service: ChatService):
         return flask.jsonify(reply_dict), 200
 
     @router.route('/thread/<thread_id>/get_thread_object', methods=['GET'])
+    @if_thread_changed
     def get_thread_object(thread_id) -> tuple[Response, int]:
         thread = service.get_thread(thread_id)
+        if not thread:
+            return f'Thread {thread_id}  NOT found', 404
         return flask.jsonify(thread.as_dict()), 200
 
+    @router.route('/thread/<thread_id>/messages', methods=['GET'])
+    @if_thread_changed
+    def get_thread_messages(thread_id) -> tuple[Response, int]:
+        """
+        Incremental alternative to get_thread_object: returns only the messages after the given message id.
+        Query args:
+          after: id of the last message known to the client
+          speakers_version: version stamp of speakers known to client; speakers are included only if changed
+        """
+        after_id = request.values.get('after', 0, type=int)
+        speakers_version = request.values.get('speakers_version')
+        updates = service.get_thread_updates(thread_id, after_id=after_id, speakers_version=speakers_version)
+        if updates is None:
+            return flask.jsonify(dict(status=C.ERROR, description=f'Thread {thread_id} NOT found')), 404
+        return flask.jsonify(updates), 200
+
+    @router.route('/thread/<thread_id>/events', methods=['GET'])
+    def thread_events(thread_id):
+        """
+        Server-sent events stream of a thread: message, speakers, and episode events are pushed as they happen.
+        Query args:
+          after: id of the last message known to the client; missed messages are replayed first.
+        On reconnect, browser's Last-Event-ID header (the last message id received) takes precedence over `after`.
+        """
+        if not service.push_streams:
+            return '', 204  # tells browsers not to reconnect
+        after_id = request.headers.get('Last-Event-ID', type=int)
+        if after_id is None:
+            after_id = request.values.get('after', 0, type=int)
+        # subscribe before reading the missed messages, so nothing falls in between; client skips duplicates
+        subscription = service.broker.subscribe(ChatThread.socket_name_of(thread_id))
+        updates = service.get_thread_updates(thread_id, after_id=after_id)
+        if updates is None:
+            subscription.close()
+            return flask.jsonify(dict(status=C.ERROR, description=f'Thread {thread_id} NOT found')), 404
+
+        def stream():
+            with subscription:
+                yield f'retry: {C.PUSH_RETRY * 1000}\n\n'
+                for msg in updates['messages']:
+                    yield format_sse('message', msg, id=msg['id'])
+                end_time = time.time() + C.PUSH_MAX_STREAM_TIME
+                while time.time() < end_time:
+                    event = subscription.get(timeout=C.PUSH_KEEPALIVE)
+                    if event is None:
+                        yield ': keepalive\n\n'
+                        continue
+                    name, data = event
+                    yield format_sse(name, data, id=data['id'] if name == 'message' else None)
+
+        headers = {'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}  # no buffering in nginx
+        return Response(stream(), mimetype='text/event-stream', headers=headers)
+
     @router.route('/thread/<thread_id>/<user_id>/rating', methods=['POST'])
     #@FL.login_required   <-- login didnt work in iframe in mturk
     def thread_rating(thread_id, user_id):
@@ -513,7 +605,7 @@ def user_controllers(router, service: ChatService):
             ext_id=assignment_id, ext_src=ext_src, data=data)
         
         if chat_thread is None: 
-            err_msg = 'Another user is loading this chat topic. Please retry after 10 seconds!'
+            err_msg = 'This topic has no free seats left'
             log.error(err_msg)
             return err_msg, 400
 
@@ -529,7 +621,8 @@ def admin_controllers(router, service: ChatService):
 
     # attach routes specific to crowd backend e.g. mturk
     if service.crowd_name in (C.MTURK, C.MTURK_SANDBOX):
-        MTurkController(service.crowd_service).register_routes(router, login_decorator=admin_login_required)
+        MTurkController(service.crowd_service, jobs=service.jobs)\
+            .register_routes(router, login_decorator=admin_login_required)
 
     admin_templ_args = dict(crowd_name = service.crowd_name)
 
@@ -543,13 +636,14 @@ def admin_controllers(router, service: ChatService):
             thread=ChatThread.query.count(),
             topic=ChatTopic.query.count(),
             message=ChatMessage.query.count(),
+            job=CrowdJob.query.count(),
             )
         return render_template('admin/index.html', counts=counts, **admin_templ_args)
 
     @router.route('/thread/<thread_id>/export')
     @admin_login_required
     def thread_export(thread_id):
-        thread: ChatThread = ChatThread.query.get(thread_id)
+        thread: ChatThread = service.get_thread(thread_id)
         if not thread:
             return 'Thread not found', 404
         return jsonify(thread), 200
@@ -557,14 +651,34 @@ def admin_controllers(router, service: ChatService):
     @router.route('/user/')
     @admin_login_required
     def get_users():
-        users = User.query.order_by(User.last_active.desc()).limit(C.MAX_PAGE_SIZE).all()
-        return render_template('admin/users.html', users=users, **admin_templ_args)
+        filters = {key: request.values[key] for key in ('role', 'ext_src') if request.values.get(key)}
+        query = User.query.options(orm.load_only(User.id, User.name, User.role, User.time_created, User.time_updated,
+                                                 User.last_active, User.ext_id, User.ext_src))
+        if filters:
+            query = query.filter_by(**filters)
+        users, next_after = keyset_page(query, User, after_id=request.values.get('after'))
+        return render_template('admin/users.html', users=users, filters=filters, next_after=next_after,
+                               **admin_templ_args)
 
     @router.route('/thread/')
     @admin_login_required
     def get_threads():
-        threads = ChatThread.query.order_by(ChatThread.time_updated.desc(), ChatThread.time_created.desc()).limit(C.MAX_PAGE_SIZE).all()
-        return render_template('admin/threads.html', threads=threads, **admin_templ_args)
+        filters = {key: request.values[key] for key in ('topic_id', 'ext_src', 'episode_done') if request.values.get(key)}
+        query = ChatThread.query.options(
+            orm.load_only(ChatThread.id, ChatThread.topic_id, ChatThread.episode_done, ChatThread.time_created,
+                          ChatThread.time_updated, ChatThread.ext_id, ChatThread.ext_src),
+            orm.selectinload(ChatThread.users).load_only(User.id))\
+            .add_columns(ChatThread.data['rating_done'].label('rating_done'))  # instead of loading all of data
+        if 'topic_id' in filters:
+            query = query.filter(ChatThread.topic_id == filters['topic_id'])
+        if 'ext_src' in filters:
+            query = query.filter(ChatThread.ext_src == filters['ext_src'])
+        if 'episode_done' in filters:
+            query = query.filter(ChatThread.episode_done == (filters['episode_done'].lower() in ('1', 'true', 'yes')))
+        threads, next_after = keyset_page(query, ChatThread, after_id=request.values.get('after', type=int),
+                                          id_of=lambda row: row.ChatThread.id)
+        return render_template('admin/threads.html', threads=threads, filters=filters, next_after=next_after,
+                               **admin_templ_args)
 
     @router.route('/topic/delete_all', methods=['POST'])
     @admin_login_required
@@ -583,18 +697,20 @@ def admin_controllers(router, service: ChatService):
             """
             Go to admin "topics" page.
             """
-            all_super_topics = SuperTopic.query.order_by(SuperTopic.time_updated.desc(), SuperTopic.time_created.desc()).\
-                limit(C.MAX_PAGE_SIZE).all()
-            all_topics = ChatTopic.query.order_by(ChatTopic.time_updated.desc(), ChatTopic.time_created.desc()).\
-                limit(C.MAX_PAGE_SIZE).all()
-            topic_thread_counts = service.get_thread_counts(episode_done=True)
-            super_topic_thread_counts = service.get_thread_counts_of_super_topic(episode_done=True)
-            topic_thread_counts_dict = {topic: topic_thread_counts.get(topic.id, 0) for topic in all_topics}
+            n_super_topics = SuperTopic.query.count()
+            query = SuperTopic.query.options(orm.defer(SuperTopic.data), orm.selectinload(SuperTopic.topics))
+            all_super_topics, next_after = keyset_page(query, SuperTopic, after_id=request.values.get('after'))
+            # only ids are needed for the launch form
+            unlaunched_tasks = ChatTopic.query.filter(ChatTopic.ext_id.is_(None))\
+                .options(orm.load_only(ChatTopic.id, ChatTopic.ext_id))\
+                .order_by(ChatTopic.time_updated.desc(), ChatTopic.time_created.desc()).all()
+            topic_thread_counts, super_topic_thread_counts = service.get_dashboard_counts()
             super_topics = \
                 [(super_topic, super_topic_thread_counts.get(super_topic.id, 0)) for super_topic in all_super_topics]
-            return render_template('admin/topics.html', tasks=all_topics, super_topics=super_topics,
+            return render_template('admin/topics.html', tasks=unlaunched_tasks, super_topics=super_topics,
                                    external_url_ok=service.is_external_url_ok, **admin_templ_args,
-                                   topic_thread_counts_dict=topic_thread_counts_dict, service=service)
+                                   topic_thread_counts_dict=topic_thread_counts, service=service,
+                                   next_after=next_after, n_super_topics=n_super_topics)
         else:
             """
             "POST" request to 1.create a new topic (task) under a super-topic 2. update the thread limit of all users
@@ -615,9 +731,12 @@ def admin_controllers(router, service: ChatService):
                                                           human_moderator=args['human_moderator'],
                                                           reward=args['reward'])
             elif "multi-tasks-launch" in args.keys():
+                # HITs are created in background; an API call per topic would take too long for a request
                 selected_task_ids = request.form.getlist('multi-tasks-launch')
-                for task_id in selected_task_ids:
-                    launch_topic_on_crowd(topic_id=task_id, crowd_name=service.crowd_name)
+                job = service.launch_topics_on_crowd(selected_task_ids)
+                if job:
+                    flask.flash(f'Launching {job.n_total} topics on {service.crowd_name}')
+                    return redirect(url_for('admin.get_job', job_id=job.id))
             else:
                 service.create_topic_from_super_topic(super_topic_id=args['super_topic_id'], endpoint=args['endpoint'],
                                                       persona_id=args['persona_id'],
@@ -646,6 +765,45 @@ def admin_controllers(router, service: ChatService):
         else:
             return 'Error: we couldnt launch on crowd', 400
 
+    @router.route('/job/')
+    @admin_login_required
+    def get_jobs():
+        jobs, next_after = keyset_page(CrowdJob.query, CrowdJob, after_id=request.values.get('after', type=int))
+        return render_template('admin/jobs.html', jobs=jobs, next_after=next_after, **admin_templ_args)
+
+    @router.route('/job/<int:job_id>')
+    @admin_login_required
+    def get_job(job_id):
+        job = CrowdJob.query.get(job_id)
+        if not job:
+            return f'Job {job_id} not found', 404
+        filters = {key: request.values[key] for key in ('status',) if request.values.get(key)}
+        query = CrowdJobItem.query.filter_by(job_id=job_id, **filters)
+        after = request.values.get('after', type=int)
+        if after:
+            query = query.filter(CrowdJobItem.id > after)
+        items = query.order_by(CrowdJobItem.id).limit(C.ADMIN_PAGE_SIZE + 1).all()
+        next_after = None
+        if len(items) > C.ADMIN_PAGE_SIZE:
+            items = items[:C.ADMIN_PAGE_SIZE]
+            next_after = items[-1].id
+        return render_template('admin/job.html', job=job, items=items, filters=filters, next_after=next_after,
+                               **admin_templ_args)
+
+    @router.route('/job/<int:job_id>/retry', methods=['POST'])
+    @admin_login_required
+    def retry_job(job_id):
+        count = service.jobs.retry_failed(flask.current_app._get_current_object(), job_id)
+        flask.flash(f'Retrying {count} failed items' if count else 'No failed items to retry')
+        return redirect(url_for('admin.get_job', job_id=job_id))
+
+    @router.route('/job/<int:job_id>/cancel', methods=['POST'])
+    @admin_login_required
+    def cancel_job(job_id):
+        service.jobs.cancel(job_id)
+        flask.flash(f'Cancelled job {job_id}; items in progress will finish')
+        return redirect(url_for('admin.get_job', job_id=job_id))
+
     @router.route(f'/config')
     @admin_login_required
     def get_config():
@@ -0,0 +1,97 @@
+"""
+Database engine tuning.
+Engine options are read from `flask_config.SQLALCHEMY_ENGINE_OPTIONS` (passed to sqlalchemy.create_engine),
+ and for SQLite, `flask_config.SQLITE_PRAGMAS` are set on every new connection.
+The defaults make SQLite usable from multiple server processes and threads (e.g. uwsgi --processes 4 --threads 2):
+ WAL journal lets readers and a writer work at the same time, and busy_timeout makes writers wait for the lock
+ instead of failing with "database is locked".
+"""
+from typing import Dict, Optional
+
+from sqlalchemy import event
+from sqlalchemy.engine import make_url
+from sqlalchemy.pool import NullPool, QueuePool
+
+from . import log, C
+
+
+def is_sqlite(db_uri: str) -> bool:
+    return make_url(db_uri).get_backend_name() == 'sqlite'
+
+
+def engine_options(db_uri: str, options: Optional[Dict] = None) -> Dict:
+    """
+    Fills in defaults for engine options.
+    :param db_uri: database URI
+    :param options: user given options; these take precedence over defaults
+    :return: options for sqlalchemy.create_engine
+    """
+    options = dict(options or {})
+    url = make_url(db_uri)
+    if url.get_backend_name() == 'sqlite':
+        if url.database in (None, '', ':memory:'):
+            return options  # flask-sqlalchemy uses a single static connection
+        # sqlite files get NullPool by default i.e. a new connection (and pragmas) per session; pool them instead.
+        # pool_size: 0 or null to go back to NullPool
+        options.setdefault('pool_size', C.DEF_SQLITE_POOL_SIZE)
+        if options['pool_size']:
+            options.setdefault('poolclass', QueuePool)
+            # pooled connections are handed over between server threads; sqlite3 module allows that only when asked
+            connect_args = options.setdefault('connect_args', {})
+            connect_args.setdefault('check_same_thread', False)
+        else:
+            options.pop('pool_size')
+            options.setdefault('poolclass', NullPool)
+    else:
+        options.setdefault('pool_size', C.DEF_DB_POOL_SIZE)
+        options.setdefault('pool_recycle', C.DEF_DB_POOL_RECYCLE)
+        options.setdefault('pool_pre_ping', True)  # dont hand out connections closed by server
+    return options
+
+
+def sqlite_pragmas(pragmas: Optional[Dict] = None) -> Dict:
+    """
+    Merges user given pragmas with defaults. Set a pragma to null to skip it.
+    """
+    pragmas = {**C.DEF_SQLITE_PRAGMAS, **(pragmas or {})}
+    return {name: val for name, val in pragmas.items() if val is not None}
+
+
+def set_sqlite_pragmas(engine, pragmas: Dict):
+    """
+    Sets pragmas on every new connection of engine.
+    """
+    if not pragmas:
+        return
+    for name in pragmas:
+        assert name.isidentifier(), f'Invalid pragma name: {name}'
+
+    @event.listens_for(engine, 'connect')
+    def _on_connect(dbapi_conn, conn_record):
+        cursor = dbapi_conn.cursor()
+        try:
+            for name, val in pragmas.items():
+                cursor.execute(f'PRAGMA {name}={val}')
+        finally:
+            cursor.close()
+
+    # journal_mode=WAL is a property of the database file; log what we got
+    with engine.connect() as conn:
+        journal_mode = conn.exec_driver_sql('PRAGMA journal_mode').scalar()
+    log.info(f'SQLite pragmas: {pragmas}; journal_mode={journal_mode}')
+
+
+def init_engine(app):
+    """
+    Configures engine options of flask-sqlalchemy. Call this before db.init_app(app),
+     and init_sqlite(app, db) after it (inside app context).
+    """
+    db_uri = app.config['SQLALCHEMY_DATABASE_URI']
+    options = engine_options(db_uri, app.config.get('SQLALCHEMY_ENGINE_OPTIONS'))
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+    log.info(f'SQLALCHEMY_ENGINE_OPTIONS = {options}')
+
+
+def init_sqlite(app, db):
+    if is_sqlite(app.config['SQLALCHEMY_DATABASE_URI']):
+        set_sqlite_pragmas(db.engine, sqlite_pragmas(app.config.get('SQLITE_PRAGMAS')))
@@ -0,0 +1,160 @@
+"""
+Benchmark of SQLite engine settings under a chat-like workload: several processes with several threads each
+ (like uwsgi --processes 4 --threads 2), mostly polling reads (latest message of a thread) and some message posts
+ (insert a message and update thread counters, in one transaction).
+Compares the default sqlite settings with the tuned defaults of boteval (see database.py).
+
+    python -m boteval.dbbench -p 4 -t 2 -d 10
+"""
+import argparse
+import multiprocessing as mp
+import random
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List
+
+from sqlalchemy import create_engine, exc, sql
+
+from . import log, C, db
+from . import model  # noqa: F401; registers tables in db.metadata
+from .database import engine_options, set_sqlite_pragmas
+
+N_THREADS = 100  # chat threads in database
+N_SEED_MESSAGES = 20  # per chat thread
+
+# name -> (engine options, pragmas)
+SETTINGS = {
+    'default': ({'pool_size': 0}, {}),  # i.e. boteval before engine tuning
+    'wal': ({'pool_size': 0}, {'journal_mode': 'WAL'}),
+    'wal+busy': ({'pool_size': 0}, {'journal_mode': 'WAL', 'busy_timeout': 10_000}),
+    'tuned': ({'pool_size': 0}, C.DEF_SQLITE_PRAGMAS),
+    'tuned+pool': ({}, C.DEF_SQLITE_PRAGMAS),  # boteval defaults
+}
+
+
+def make_engine(db_file: Path, options: Dict, pragmas: Dict):
+    db_uri = f'sqlite:///{db_file}'
+    engine = create_engine(db_uri, **engine_options(db_uri, options))
+    set_sqlite_pragmas(engine, pragmas)
+    return engine
+
+
+def setup_db(engine):
+    T = db.metadata.tables
+    db.metadata.create_all(engine)
+    with engine.begin() as conn:
+        conn.execute(T['user'].insert(), [dict(id=f'u{i}', name=f'u{i}', secret='x') for i in range(N_THREADS)])
+        conn.execute(T['topic'].insert(), dict(id='t0', name='t0', endpoint='e', persona_id='p', reward='0',
+                                               max_threads_per_topic=N_THREADS, max_turns_per_thread=100,
+                                               max_human_users_per_thread=1))
+        conn.execute(T['thread'].insert(), [dict(id=i, topic_id='t0', thread_state=1) for i in range(N_THREADS)])
+        conn.execute(T['message'].insert(), [dict(text=f'seed {j}', user_id=f'u{i}', thread_id=i, is_seed=True)
+                                             for i in range(N_THREADS) for j in range(N_SEED_MESSAGES)])
+        conn.execute(T['thread'].update().values(message_count=N_SEED_MESSAGES))
+
+
+def read_op(conn, thread_id):
+    T = db.metadata.tables
+    thread = T['thread']
+    last_id = conn.execute(sql.select(thread.c.last_message_id).where(thread.c.id == thread_id)).scalar()
+    msgs = T['message']
+    conn.execute(sql.select(msgs.c.id, msgs.c.text).where(msgs.c.thread_id == thread_id)
+                 .order_by(msgs.c.id.desc()).limit(1)).first()
+    return last_id
+
+
+def write_op(conn, thread_id):
+    T = db.metadata.tables
+    thread = T['thread']
+    with conn.begin():
+        # like the ORM does: read thread state, then write
+        conn.execute(sql.select(thread.c.episode_done, thread.c.message_count).where(thread.c.id == thread_id)).first()
+        msg_id = conn.execute(T['message'].insert().values(
+            text='hello', user_id=f'u{thread_id}', thread_id=thread_id)).inserted_primary_key[0]
+        conn.execute(thread.update().where(thread.c.id == thread_id).values(
+            message_count=thread.c.message_count + 1, last_message_id=msg_id))
+
+
+def _worker(args):
+    db_file, setting, n_threads, duration, write_ratio = args
+    options, pragmas = SETTINGS[setting]
+    engine = make_engine(db_file, options, pragmas)
+    stats = dict(reads=0, writes=0, errors=0, latencies=[])
+    lock = threading.Lock()
+    end_time = time.time() + duration
+
+    def loop():
+        rnd = random.Random()
+        while time.time() < end_time:
+            is_write = rnd.random() < write_ratio
+            start = time.perf_counter()
+            try:
+                with engine.connect() as conn:
+                    (write_op if is_write else read_op)(conn, rnd.randrange(N_THREADS))
+                ok = True
+            except exc.OperationalError as e:
+                ok = False
+                log.debug(f'{e}')
+            elapsed = time.perf_counter() - start
+            with lock:
+                if not ok:
+                    stats['errors'] += 1
+                else:
+                    stats['writes' if is_write else 'reads'] += 1
+                    stats['latencies'].append(elapsed)
+
+    threads = [threading.Thread(target=loop) for _ in range(n_threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    engine.dispose()
+    return stats
+
+
+def run(setting: str, procs: int, threads: int, duration: float, write_ratio: float) -> Dict:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        db_file = Path(tmp_dir) / 'bench.db'
+        options, pragmas = SETTINGS[setting]
+        engine = make_engine(db_file, options, pragmas)
+        setup_db(engine)
+        engine.dispose()
+        with mp.Pool(processes=procs) as pool:
+            results: List[Dict] = pool.map(_worker, [(db_file, setting, threads, duration, write_ratio)] * procs)
+    latencies = sorted(lat for res in results for lat in res['latencies'])
+    reads, writes, errors = [sum(res[key] for res in results) for key in ('reads', 'writes', 'errors')]
+    pct = lambda p: latencies[min(int(p * len(latencies)), len(latencies) - 1)] * 1000 if latencies else float('nan')
+    return dict(setting=setting, ops_per_sec=(reads + writes) / duration, reads=reads, writes=writes,
+                errors=errors, p50_ms=pct(0.5), p99_ms=pct(0.99))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        prog='boteval.dbbench', description=__doc__.strip().split('\n')[0],
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-p', '--procs', type=int, default=4, help='Number of processes')
+    parser.add_argument('-t', '--threads', type=int, default=2, help='Number of threads per process')
+    parser.add_argument('-d', '--duration', type=float, default=10, help='Seconds per setting')
+    parser.add_argument('-w', '--write-ratio', type=float, default=0.2, help='Fraction of operations that write')
+    parser.add_argument('-s', '--settings', nargs='+', choices=list(SETTINGS), default=list(SETTINGS),
+                        help='Settings to compare')
+    return vars(parser.parse_args())
+
+
+def main(**args):
+    args = args or parse_args()
+    rows = []
+    for setting in args['settings']:
+        log.info(f'Running {setting} for {args["duration"]}s')
+        rows.append(run(setting, procs=args['procs'], threads=args['threads'],
+                        duration=args['duration'], write_ratio=args['write_ratio']))
+    print(f'{"setting":12s} {"ops/s":>8s} {"reads":>8s} {"writes":>8s} {"errors":>7s} {"p50 ms":>7s} {"p99 ms":>8s}')
+    for row in rows:
+        print(f'{row["setting"]:12s} {row["ops_per_sec"]:8.0f} {row["reads"]:8d} {row["writes"]:8d}'
+              f' {row["errors"]:7d} {row["p50_ms"]:7.2f} {row["p99_ms"]:8.2f}')
+
+
+if '__main__' == __name__:
+    main()
@@ -0,0 +1,164 @@
+"""
+Publish-subscribe of chat events to per-thread channels.
+Browsers receive these events as server-sent events (see `thread_events` in controller).
+
+Event names:
+  message  -- a new message was added to thread; data is ChatMessage.as_dict()
+  speakers -- a user joined thread; data has speakers and speakers_version
+  episode  -- thread is done; data has episode_done
+"""
+
+import json
+import queue
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+from . import log, C, registry as R
+
+
+Event = Tuple[str, Dict[str, Any]]   # (event_name, data)
+
+
+def format_sse(event: str, data: Dict[str, Any], id=None) -> str:
+    """Formats an event as per server-sent events wire format"""
+    lines = []
+    if id is not None:
+        lines.append(f'id: {id}')
+    lines.append(f'event: {event}')
+    lines.append(f'data: {json.dumps(data, ensure_ascii=False)}')
+    return '\n'.join(lines) + '\n\n'
+
+
+class Subscription:
+
+    def get(self, timeout: float) -> Optional[Event]:
+        """Waits for the next event on the channel; returns None if nothing arrived within timeout"""
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class EventBroker:
+
+    # True if events reach subscribers of all server processes; otherwise browsers dont open event streams
+    #  by default (see `push.streams` config), and poll at full rate
+    is_shared = False
+
+    def publish(self, channel: str, event: str, data: Dict[str, Any]):
+        raise NotImplementedError()
+
+    def subscribe(self, channel: str) -> Subscription:
+        raise NotImplementedError()
+
+
+class LocalSubscription(Subscription):
+
+    def __init__(self, broker: 'LocalBroker', channel: str, max_size: int) -> None:
+        self.broker = broker
+        self.channel = channel
+        self.queue = queue.Queue(maxsize=max_size)
+
+    def get(self, timeout: float) -> Optional[Event]:
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.broker._unsubscribe(self)
+
+
+@R.register(R.BROKER, 'local')
+class LocalBroker(EventBroker):
+    """
+    In-process broker. Events reach only the subscribers of the same process,
+    so use this when running a single server process (threads are okay).
+    """
+
+    def __init__(self, max_queue_size=C.PUSH_QUEUE_SIZE) -> None:
+        self.max_queue_size = max_queue_size
+        self._subscribers: Dict[str, set] = {}
+        self._lock = threading.Lock()
+
+    def publish(self, channel: str, event: str, data: Dict[str, Any]):
+        with self._lock:
+            subs = list(self._subscribers.get(channel, ()))
+        for sub in subs:
+            try:
+                sub.queue.put_nowait((event, data))
+            except queue.Full:
+                # slow/dead consumer; client will catch up by polling
+                log.warning(f'Dropping {event} event on {channel}; subscriber queue is full')
+
+    def subscribe(self, channel: str) -> Subscription:
+        sub = LocalSubscription(self, channel, max_size=self.max_queue_size)
+        with self._lock:
+            self._subscribers.setdefault(channel, set()).add(sub)
+        return sub
+
+    def _unsubscribe(self, sub: LocalSubscription):
+        with self._lock:
+            subs = self._subscribers.get(sub.channel)
+            if subs:
+                subs.discard(sub)
+                if not subs:
+                    del self._subscribers[sub.channel]
+
+
+class RedisSubscription(Subscription):
+
+    def __init__(self, pubsub, channel: str) -> None:
+        self.pubsub = pubsub
+        self.pubsub.subscribe(channel)
+
+    def get(self, timeout: float) -> Optional[Event]:
+        msg = self.pubsub.get_message(ignore_subscribe_messages=True, timeout=timeout)
+        if not msg or msg.get('type') != 'message':
+            return None
+        payload = json.loads(msg['data'])
+        return payload['event'], payload['data']
+
+    def close(self):
+        self.pubsub.close()
+
+
+@R.register(R.BROKER, 'redis')
+class RedisBroker(EventBroker):
+    """
+    Broker backed by redis pub/sub; events reach subscribers across all server processes
+     (e.g. uwsgi --processes N).
+    Requires `redis` python package, unless `client` is given.
+    `client` can be any object having redis-py's `publish(channel, message)` and `pubsub()` methods;
+     useful for plugging a local stand-in for testing.
+    """
+
+    is_shared = True
+
+    def __init__(self, url='redis://localhost:6379/0', prefix='boteval:', client=None) -> None:
+        if client is None:
+            import redis
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+
+    def publish(self, channel: str, event: str, data: Dict[str, Any]):
+        payload = json.dumps(dict(event=event, data=data), ensure_ascii=False)
+        self.client.publish(self.prefix + channel, payload)
+
+    def subscribe(self, channel: str) -> Subscription:
+        return RedisSubscription(self.client.pubsub(), self.prefix + channel)
+
+
+def load_broker(name='local', args=None) -> EventBroker:
+    brokers = R.registry[R.BROKER]
+    assert name in brokers, f'{name=} is unknown broker; known={brokers.keys()}'
+    args = args or {}
+    log.info(f'loading event broker {name=} {args=}')
+    return brokers[name](**args)
@@ -0,0 +1,111 @@
+"""
+Process-wide registry of huggingface models.
+Bots and transforms that use the same model share one copy of its weights;
+the model is loaded on first acquire() and dropped when the last user release()s it.
+"""
+
+import gc
+import threading
+from typing import Any, Dict, Optional, Tuple
+
+from . import log
+
+
+class SharedModel:
+
+    def __init__(self) -> None:
+        self.tokenizer = None
+        self.model = None
+        self.ref_count = 0
+        self.error: Optional[BaseException] = None
+        self.loaded = threading.Event()  # set when loading is done, successful or not
+
+
+class ModelHub:
+
+    def __init__(self) -> None:
+        self._models: Dict[Tuple[str, Optional[str]], SharedModel] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(model_name: str, dtype=None) -> Tuple[str, Optional[str]]:
+        return model_name, dtype and str(dtype)
+
+    def acquire(self, model_name: str, dtype=None) -> Tuple[Any, Any]:
+        """
+        Gets (tokenizer, model) for the given seq2seq model name and dtype, loading it if needed.
+        Every acquire() should be paired with a release() when the caller is done with the model.
+        :param model_name: huggingface model name or path
+        :param dtype: torch dtype or its name e.g. 'float16'. None for default dtype
+        """
+        key = self._key(model_name, dtype)
+        # the hub-wide lock only guards the map and ref counts; loading happens outside of it,
+        # so acquiring a loaded model is not blocked by another (slow) model being loaded
+        with self._lock:
+            entry = self._models.get(key)
+            is_loader = entry is None
+            if is_loader:
+                entry = SharedModel()
+                self._models[key] = entry
+            entry.ref_count += 1
+
+        if is_loader:
+            try:
+                entry.tokenizer, entry.model = self._load(model_name, dtype)
+            except BaseException as e:
+                entry.error = e
+                with self._lock:
+                    if self._models.get(key) is entry:
+                        del self._models[key]
+                raise
+            finally:
+                entry.loaded.set()
+        else:
+            entry.loaded.wait()
+            if entry.error is not None:
+                raise RuntimeError(f'Failed to load model {key}') from entry.error
+
+        log.info(f'Acquired model {key}; users={entry.ref_count}')
+        return entry.tokenizer, entry.model
+
+    def release(self, model_name: str, dtype=None):
+        key = self._key(model_name, dtype)
+        with self._lock:
+            entry = self._models.get(key)
+            if entry is None:
+                log.warning(f'Model {key} is not loaded; nothing to release')
+                return
+            entry.ref_count -= 1
+            log.info(f'Released model {key}; users={entry.ref_count}')
+            unload = entry.ref_count <= 0
+            if unload:
+                log.info(f'Unloading model {key}')
+                del self._models[key]
+        if unload:
+            # outside of the lock; collection may finalize objects that release() other models
+            del entry
+            gc.collect()
+
+    @property
+    def loaded_models(self) -> Dict[Tuple[str, Optional[str]], int]:
+        """Currently loaded models and their number of users"""
+        with self._lock:
+            return {key: entry.ref_count for key, entry in self._models.items()
+                    if entry.loaded.is_set() and entry.error is None}
+
+    def _load(self, model_name: str, dtype=None):
+        from transformers import AutoTokenizer, AutoModelForSeq2SeqLM
+        args = {}
+        if dtype:
+            if isinstance(dtype, str) and dtype != 'auto':
+                import torch
+                dtype = getattr(torch, dtype)
+            args['torch_dtype'] = dtype
+        log.info(f'Loading model {model_name} {args}')
+        tokenizer = AutoTokenizer.from_pretrained(model_name)
+        model = AutoModelForSeq2SeqLM.from_pretrained(model_name, **args)
+        return tokenizer, model
+
+
+# the one instance per process
+hub = ModelHub()
@@ -0,0 +1,247 @@
+"""
+Background jobs that make many crowd API calls, e.g. launching hundreds of HITs.
+A job (CrowdJob) has items (CrowdJobItem, one per topic, assignment, etc.) whose progress is saved in the database,
+ so the admin page shows status without waiting, and unfinished jobs resume after a restart.
+Items run on a bounded thread pool; API calls go through a token bucket and are retried when throttled.
+"""
+
+import os
+import random
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional
+
+from sqlalchemy import sql
+
+from . import log, C, db
+from .model import CrowdJob, CrowdJobItem
+
+
+class TokenBucket:
+    """
+    Rate limiter: allows `rate` calls per second on average, and bursts of upto `burst` calls.
+    Shared by all threads of a process.
+    """
+
+    def __init__(self, rate: float, burst: int = 1) -> None:
+        assert rate > 0 and burst >= 1
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a call is allowed"""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._time) * self.rate)
+                self._time = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+THROTTLE_CODES = {'Throttling', 'ThrottlingException', 'RequestLimitExceeded', 'TooManyRequestsException',
+                  'ServiceUnavailable', 'ServiceFault'}
+
+
+def is_throttled(err: Exception) -> bool:
+    """True if err is a transient error (throttling or server side), i.e. worth retrying"""
+    response = getattr(err, 'response', None)  # botocore ClientError
+    if not isinstance(response, dict):
+        return False
+    error = response.get('Error', {})
+    msg = str(error.get('Message', '')).lower()
+    return error.get('Code') in THROTTLE_CODES or 'rate exceeded' in msg or 'throttl' in msg
+
+
+def call_with_retry(fn: Callable, *args, bucket: Optional[TokenBucket] = None, retries=C.DEF_JOB_RETRIES,
+                    backoff=C.DEF_JOB_BACKOFF, **kwargs):
+    """
+    Calls fn(*args, **kwargs) after acquiring a token from bucket; retries upto `retries` times
+     with exponential backoff (and jitter) when throttled. Other errors are raised right away.
+    """
+    for attempt in range(retries + 1):
+        if bucket:
+            bucket.acquire()
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if attempt >= retries or not is_throttled(e):
+                raise
+            wait = backoff * 2 ** attempt * (0.5 + random.random())
+            log.warning(f'Throttled: {e}; retrying in {wait:.1f}s ({attempt + 1}/{retries})')
+            time.sleep(wait)
+
+
+class JobRunner:
+    """
+    Runs items of crowd jobs on a thread pool, which is shared by all jobs of a process, so that concurrent jobs
+     dont use up database connections. Handlers are registered per job kind:
+        handler(item: CrowdJobItem, params: dict) -> dict
+    A handler runs inside app context, returns result data of the item, and raises on failure.
+    Handlers must be idempotent: an item may run again if the server stopped before its status was saved.
+    """
+
+    def __init__(self, max_workers=C.DEF_JOB_WORKERS) -> None:
+        self.max_workers = max_workers
+        self.handlers: Dict[str, Callable] = {}
+        self._lock = threading.Lock()
+        self._running: Dict[int, threading.Thread] = {}  # job id -> thread; in this process
+        self._pool: Optional[ThreadPoolExecutor] = None
+        self._pid = None
+
+    @property
+    def owner(self) -> str:
+        return f'{socket.gethostname()}:{os.getpid()}'
+
+    def _get_pool(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._pool is None or self._pid != os.getpid():  # threads dont survive fork
+                self._pid = os.getpid()
+                self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='job')
+            return self._pool
+
+    def register(self, kind: str, handler: Callable):
+        self.handlers[kind] = handler
+
+    def create(self, kind: str, keys: List[str], params: Optional[Dict] = None, ext_src=None,
+               item_data: Optional[Dict[str, Dict]] = None) -> CrowdJob:
+        """
+        Saves a new job; call start() to run it.
+        :param keys: item keys e.g. topic ids
+        :param params: job parameters, passed to handler
+        :param item_data: key -> data of item; the handler sees it as item.data
+        """
+        assert kind in self.handlers, f'Unknown job kind {kind}; known: {list(self.handlers)}'
+        keys = list(dict.fromkeys(keys))
+        item_data = item_data or {}
+        job = CrowdJob(kind=kind, ext_src=ext_src, status=CrowdJob.PENDING, n_total=len(keys), data=params or {})
+        db.session.add(job)
+        db.session.flush()
+        if keys:
+            db.session.execute(CrowdJobItem.__table__.insert(),
+                               [dict(job_id=job.id, key=key, status=CrowdJobItem.PENDING, data=item_data.get(key, {}))
+                                for key in keys])
+        db.session.commit()
+        log.info(f'Created {kind} job {job.id} with {len(keys)} items')
+        return job
+
+    def _claim(self, job_id: int) -> bool:
+        # one process runs a job; a running job is taken over when its owner stopped updating it (e.g. restarted)
+        stale = datetime.now() - timedelta(seconds=C.JOB_STALE_TIME)
+        res = db.session.execute(sql.update(CrowdJob).where(
+            CrowdJob.id == job_id,
+            sql.or_(CrowdJob.status == CrowdJob.PENDING,
+                    sql.and_(CrowdJob.status == CrowdJob.RUNNING,
+                             sql.or_(CrowdJob.owner == self.owner, CrowdJob.time_updated < stale))))
+            .values(status=CrowdJob.RUNNING, owner=self.owner, time_updated=datetime.now())
+            .execution_options(synchronize_session=False))
+        db.session.commit()
+        return res.rowcount == 1
+
+    def start(self, app, job_id: int) -> bool:
+        """Runs job in background. :return: False if the job is running already or finished"""
+        with self._lock:
+            if job_id in self._running:
+                return False
+            if not self._claim(job_id):
+                return False
+            thread = threading.Thread(target=self._run, args=(app, job_id), name=f'job-{job_id}', daemon=True)
+            self._running[job_id] = thread
+        thread.start()
+        return True
+
+    def resume_all(self, app):
+        """Resumes jobs that were left unfinished, e.g. by a restart"""
+        stale = datetime.now() - timedelta(seconds=C.JOB_STALE_TIME)
+        job_ids = [job_id for job_id, in db.session.query(CrowdJob.id).filter(
+            sql.or_(CrowdJob.status == CrowdJob.PENDING,
+                    sql.and_(CrowdJob.status == CrowdJob.RUNNING, CrowdJob.time_updated < stale)))]
+        for job_id in job_ids:
+            if self.start(app, job_id):
+                log.info(f'Resumed job {job_id}')
+
+    def retry_failed(self, app, job_id: int) -> int:
+        """Marks failed items as pending, and runs job again. :return: number of items to retry"""
+        job = CrowdJob.query.get(job_id)
+        if not job or job.is_active:
+            return 0  # items are picked up once per run; let it finish first
+        count = CrowdJobItem.query.filter_by(job_id=job_id, status=CrowdJobItem.FAILED)\
+            .update(dict(status=CrowdJobItem.PENDING), synchronize_session=False)
+        if count:
+            CrowdJob.query.filter(CrowdJob.id == job_id)\
+                .update(dict(status=CrowdJob.PENDING, n_failed=CrowdJob.n_failed - count),
+                        synchronize_session=False)
+        db.session.commit()
+        if count:
+            self.start(app, job_id)
+        return count
+
+    def cancel(self, job_id: int):
+        # workers check job status before each item
+        CrowdJob.query.filter(CrowdJob.id == job_id, CrowdJob.status.in_([CrowdJob.PENDING, CrowdJob.RUNNING]))\
+            .update(dict(status=CrowdJob.CANCELLED), synchronize_session=False)
+        db.session.commit()
+
+    def _run(self, app, job_id: int):
+        try:
+            with app.app_context():
+                job = CrowdJob.query.get(job_id)
+                handler = self.handlers[job.kind]
+                params = dict(job.data)
+                item_ids = [item_id for item_id, in db.session.query(CrowdJobItem.id).filter_by(
+                    job_id=job_id, status=CrowdJobItem.PENDING).order_by(CrowdJobItem.id)]
+                log.info(f'Running {job.kind} job {job_id}: {len(item_ids)} pending items')
+                db.session.remove()
+            pool = self._get_pool()
+            futures = [pool.submit(self._run_item, app, job_id, item_id, handler, params) for item_id in item_ids]
+            for future in futures:
+                future.result()
+            with app.app_context():
+                status = db.session.query(CrowdJob.status).filter_by(id=job_id).scalar()
+                if status == CrowdJob.RUNNING:
+                    job = CrowdJob.query.get(job_id)
+                    job.status = CrowdJob.FAILED if job.n_failed else CrowdJob.DONE
+                    db.session.commit()
+                log.info(f'Job {job_id} finished')
+        except Exception as e:
+            log.exception(e)
+        finally:
+            with self._lock:
+                self._running.pop(job_id, None)
+
+    def _run_item(self, app, job_id: int, item_id: int, handler: Callable, params: Dict):
+        with app.app_context():
+            status = db.session.query(CrowdJob.status).filter_by(id=job_id).scalar()
+            if status != CrowdJob.RUNNING:
+                return  # cancelled
+            item = CrowdJobItem.query.get(item_id)
+            if item.status != CrowdJobItem.PENDING:
+                return
+            # commit now; dont hold a write transaction (i.e. the database lock on sqlite) during API calls
+            item.attempts += 1
+            db.session.commit()
+            try:
+                result = handler(item, params) or {}
+                item.status, item.error = CrowdJobItem.DONE, None
+                item.data = dict(item.data, **result)
+                counter = dict(n_done=CrowdJob.n_done + 1)
+            except Exception as e:
+                db.session.rollback()
+                log.warning(f'Job {job_id} item {item.key} failed: {e}')
+                item = CrowdJobItem.query.get(item_id)
+                item.status, item.error = CrowdJobItem.FAILED, str(e)[:C.JOB_MAX_ERROR_LEN]
+                counter = dict(n_failed=CrowdJob.n_failed + 1)
+            # item and job progress are saved together; time_updated is the heartbeat of the job owner
+            db.session.execute(sql.update(CrowdJob).where(CrowdJob.id == job_id)
+                               .values(time_updated=datetime.now(), **counter)
+                               .execution_options(synchronize_session=False))
+            db.session.commit()
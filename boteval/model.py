@@ -1,6 +1,7 @@
 from typing import Dict, List, Optional, Any
 import hashlib
-from sqlalchemy import orm, sql
+import json
+from sqlalchemy import func, orm, sql
 
 
 from . import db, log
@@ -28,8 +29,9 @@ class BaseModel(db.Model):
     data: str = db.Column(db.JSON(), nullable=False, server_default='{}')
     time_created = db.Column(db.DateTime(timezone=True),
                              server_default=sql.func.now())
+    # set on insert too, so listings can be ordered (and paged) by it
     time_updated = db.Column(db.DateTime(timezone=True),
-                             onupdate=sql.func.now())
+                             default=sql.func.now(), onupdate=sql.func.now())
 
     def __eq__(self, other):
         """
@@ -81,6 +83,11 @@ class BaseModelWithExternal(BaseModel):
 class User(BaseModelWithExternal):
 
     __tablename__ = 'user'
+    __table_args__ = (
+        db.Index('ix_user_ext_src_ext_id', 'ext_src', 'ext_id'),  # crowd worker lookup on landing
+        db.Index('ix_user_last_active', 'last_active'),
+        db.Index('ix_user_time_updated_id', 'time_updated', 'id'),  # admin users page, recent first
+    )
 
     ANONYMOUS = 'Anonymous'
     ROLE_BOT = 'bot'
@@ -171,6 +178,10 @@ class User(BaseModelWithExternal):
 class ChatMessage(BaseModelWithExternal):
 
     __tablename__ = 'message'
+    __table_args__ = (
+        # messages of a thread are always read in id order, often as "since id" deltas
+        db.Index('ix_message_thread_id_id', 'thread_id', 'id'),
+    )
 
     id: int = db.Column(db.Integer, primary_key=True)
     text: str = db.Column(db.String(2048), nullable=False)
@@ -198,13 +209,22 @@ UserThread = db.Table(
     db.Column('user_id', db.String(31), db.ForeignKey('user.id'),
               primary_key=True),
     db.Column('thread_id', db.Integer, db.ForeignKey('thread.id'),
-              primary_key=True)
+              primary_key=True),
+    # number of messages by user in thread; see ChatThread.count_message()
+    db.Column('turn_count', db.Integer, nullable=False, server_default='0'),
+    # primary key covers user_id -> threads; this one is for thread_id -> users
+    db.Index('ix_user_thread_thread_id', 'thread_id'),
     )
 
 
 class ChatThread(BaseModelWithExternal):
 
     __tablename__ = 'thread'
+    __table_args__ = (
+        db.Index('ix_thread_topic_id_episode_done', 'topic_id', 'episode_done'),  # threads of a topic
+        db.Index('ix_thread_episode_done_topic_id', 'episode_done', 'topic_id'),  # done/not-done counts per topic
+        db.Index('ix_thread_time_updated_id', 'time_updated', 'id'),  # admin threads page, recent first
+    )
 
     id: int = db.Column(db.Integer, primary_key=True)
     topic_id = db.Column(db.String(31),
@@ -214,11 +234,13 @@ class ChatThread(BaseModelWithExternal):
                              server_default=sql.expression.false(),
                              nullable=False)
     # one-to-many
+    # Note: relations are loaded on access; queries that need them should say so e.g. with selectinload()
+    #   so that listing/counting threads doesnt drag in all their messages
     messages: List[ChatMessage] = db.relationship(
-        'ChatMessage', backref='thread', lazy=False, uselist=True)
+        'ChatMessage', backref='thread', lazy='select', uselist=True, order_by='ChatMessage.id')
     # many-to-many : https://flask-sqlalchemy.palletsprojects.com/en/2.x/models/#many-to-many-relationships
     users: List[User] = db.relationship(
-        'User', secondary=UserThread, lazy='subquery',
+        'User', secondary=UserThread, lazy='select',
         backref=db.backref('threads', lazy=True))
 
     # key: userid;  value: speaker_id
@@ -231,7 +253,14 @@ class ChatThread(BaseModelWithExternal):
     # key: userid;  value: submit_url
     submit_url_dict = db.Column(db.JSON(), nullable=False, server_default='{}')
 
-    thread_state: int = db.Column(db.Integer, nullable=False)
+    # no longer used; seats are reserved under a topic lock (see ChatService.lock_topic)
+    thread_state: int = db.Column(db.Integer, nullable=False, default=0)
+
+    # denormalized counters, so we dont have to load messages to know these; see count_message()
+    message_count: int = db.Column(db.Integer, nullable=False, server_default='0')
+    last_message_id: int = db.Column(db.Integer, nullable=True)
+    # bumped when data (e.g. ratings) or users change; see bump_data_version()
+    data_version: int = db.Column(db.Integer, nullable=False, server_default='0')
 
     need_moderator_bot = db.Column(db.Boolean, server_default=sql.expression.true(), nullable=False)
 
@@ -246,8 +275,51 @@ class ChatThread(BaseModelWithExternal):
     human_moderator: str = db.Column(db.String(32), nullable=True)
     reward: str = db.Column(db.String(32), nullable=True)
 
-    def count_turns(self, user: User):
-        return sum(msg.user_id == user.id for msg in self.messages)
+    def count_turns(self, user: User) -> int:
+        return db.session.query(UserThread.c.turn_count)\
+            .filter(UserThread.c.thread_id == self.id, UserThread.c.user_id == user.id).scalar() or 0
+
+    def count_human_turns(self) -> int:
+        return db.session.query(func.coalesce(func.sum(UserThread.c.turn_count), 0))\
+            .join(User, User.id == UserThread.c.user_id)\
+            .filter(UserThread.c.thread_id == self.id,
+                    User.role.in_([User.ROLE_HUMAN, User.ROLE_HUMAN_MODERATOR])).scalar()
+
+    def count_message(self, msg: ChatMessage):
+        """
+        Updates counters for a new message of this thread; msg should be flushed (i.e. has id).
+        Counters are incremented in SQL (not read-modify-write in python), so concurrent writers dont lose counts.
+        Commit along with the message, so both are saved or neither.
+        """
+        assert msg.id is not None and msg.thread_id == self.id
+        db.session.execute(sql.update(ChatThread).where(ChatThread.id == self.id).values(
+            message_count=ChatThread.message_count + 1,
+            last_message_id=sql.case((ChatThread.last_message_id > msg.id, ChatThread.last_message_id), else_=msg.id))
+            .execution_options(synchronize_session=False))
+        db.session.execute(sql.update(UserThread)
+            .where(UserThread.c.thread_id == self.id, UserThread.c.user_id == msg.user_id)
+            .values(turn_count=UserThread.c.turn_count + 1))
+
+    @classmethod
+    def recount_messages(cls, thread_ids: Optional[List[int]]=None):
+        """
+        Recomputes message counters from message table, for given threads or all threads.
+        For bulk inserts (which skip count_message) and for backfilling counters of old databases.
+        """
+        msgs = ChatMessage.__table__
+        # counters are derived data; keep time_updated as is, listings are ordered and paged by it
+        thread_stmt = sql.update(cls).values(
+            message_count=sql.select(func.count(msgs.c.id)).where(msgs.c.thread_id == cls.id).scalar_subquery(),
+            last_message_id=sql.select(func.max(msgs.c.id)).where(msgs.c.thread_id == cls.id).scalar_subquery(),
+            time_updated=cls.time_updated)
+        turns_stmt = sql.update(UserThread).values(
+            turn_count=sql.select(func.count(msgs.c.id)).where(msgs.c.thread_id == UserThread.c.thread_id,
+                                                              msgs.c.user_id == UserThread.c.user_id).scalar_subquery())
+        if thread_ids is not None:
+            thread_stmt = thread_stmt.where(cls.id.in_(thread_ids))
+            turns_stmt = turns_stmt.where(UserThread.c.thread_id.in_(thread_ids))
+        db.session.execute(thread_stmt.execution_options(synchronize_session=False))
+        db.session.execute(turns_stmt)
 
     def flag_speakers_modified(self):
         # seql alchemy isnt reliable in recognising modifications to JSON, so we explicitely tell it
@@ -266,12 +338,43 @@ class ChatThread(BaseModelWithExternal):
             episode_done=self.episode_done,
             users=[u.as_dict() for u in self.users],
             messages=[m.as_dict() for m in self.messages],
-            speakers=self.speakers
+            speakers=self.speakers,
+            message_count=self.message_count,
+            last_message_id=self.last_message_id,
         )
         
+    @property
+    def speakers_version(self) -> str:
+        return self.speakers_version_of(self.speakers)
+
+    @staticmethod
+    def speakers_version_of(speakers: Optional[Dict[str, str]]) -> str:
+        # short digest of speakers map; pollers send it back so we can skip resending unchanged speakers
+        return hashlib.md5(json.dumps(speakers or {}, sort_keys=True).encode()).hexdigest()[:8]
+
+    def bump_data_version(self):
+        # incremented in SQL, so concurrent bumps (e.g. two users submitting ratings) are not lost
+        self.data_version = ChatThread.data_version + 1
+
+    @property
+    def version(self) -> str:
+        return self.version_of(self.last_message_id, self.speakers, self.episode_done, self.data_version)
+
+    @staticmethod
+    def version_of(last_message_id, speakers, episode_done, data_version) -> str:
+        # changes whenever a message is added, a user joins, ratings are submitted, or episode ends;
+        #  pollers get it as ETag
+        return f'{last_message_id or 0}.{ChatThread.speakers_version_of(speakers)}.{int(bool(episode_done))}' \
+               f'.{data_version or 0}'
+
     @property
     def socket_name(self):
-        return f'sock4thread_{self.id}'
+        return self.socket_name_of(self.id)
+
+    @staticmethod
+    def socket_name_of(thread_id) -> str:
+        # name of the channel where events of this thread are published
+        return f'sock4thread_{thread_id}'
 
 
 class SuperTopic(BaseModelWithExternal):
@@ -280,6 +383,9 @@ class SuperTopic(BaseModelWithExternal):
     So, by introducing a super_topic model, we are able to launch multiple assignments(topics) with one super_topic.
     """
     __tablename__ = 'super_topic'
+    __table_args__ = (
+        db.Index('ix_super_topic_time_updated_id', 'time_updated', 'id'),  # admin topics page, recent first
+    )
 
     id: str = db.Column(db.String(32), primary_key=True)  # redefine id as str
     name: str = db.Column(db.String(100), nullable=False)
@@ -297,6 +403,11 @@ class ChatTopic(BaseModelWithExternal):
     """
 
     __tablename__ = 'topic'
+    __table_args__ = (
+        db.Index('ix_topic_ext_id', 'ext_id'),  # HIT id lookup on mturk landing
+        db.Index('ix_topic_super_topic_id', 'super_topic_id'),
+        db.Index('ix_topic_time_updated_id', 'time_updated', 'id'),
+    )
 
     id: str = db.Column(db.String(64), primary_key=True)  # redefine id as str
     name: str = db.Column(db.String(100), nullable=False)
@@ -308,6 +419,8 @@ class ChatTopic(BaseModelWithExternal):
     max_human_users_per_thread: int = db.Column(db.Integer, nullable=False)
     human_moderator: str = db.Column(db.String(32), nullable=True)
     reward: str = db.Column(db.String(32), nullable=False)
+    # number of seats reserved in topic; incrementing it write-locks the topic row, which serializes joiners
+    join_count: int = db.Column(db.Integer, nullable=False, server_default='0')
 
     def as_dict(self):
         return super().as_dict() | dict(name=self.name)
@@ -336,4 +449,184 @@ class ChatTopic(BaseModelWithExternal):
         return cls.query.get(topic.id)
 
 
+class MTurkHIT(BaseModel):
+    """
+    Local mirror of a HIT on MTurk, kept in sync by mturk.MTurkMirror; admin pages are rendered from this.
+    id is HITId; `data` has the HIT as returned by MTurk API (datetimes as ISO strings).
+    """
+
+    __tablename__ = 'mturk_hit'
+    __table_args__ = (
+        db.Index('ix_mturk_hit_ext_src_time_synced', 'ext_src', 'time_synced'),
+        db.Index('ix_mturk_hit_topic_id', 'topic_id'),
+        db.Index('ix_mturk_hit_time_updated_id', 'time_updated', 'id'),
+    )
+
+    id: str = db.Column(db.String(64), primary_key=True)  # redefine id as str
+    ext_src: str = db.Column(db.String(32), nullable=False)  # mturk or mturk_sandbox
+    # topic.ext_id == id; not a foreign key, as topics may be deleted locally while HIT lives on
+    topic_id: str = db.Column(db.String(64), nullable=True)
+    status: str = db.Column(db.String(32), nullable=True)
+    review_status: str = db.Column(db.String(32), nullable=True)
+    title: str = db.Column(db.String(256), nullable=True)
+    creation_time = db.Column(db.DateTime(timezone=True), nullable=True)
+    expiration = db.Column(db.DateTime(timezone=True), nullable=True)
+    max_assignments: int = db.Column(db.Integer, nullable=True)
+    n_pending: int = db.Column(db.Integer, nullable=True)
+    n_available: int = db.Column(db.Integer, nullable=True)
+    n_completed: int = db.Column(db.Integer, nullable=True)
+    qual_ids: str = db.Column(db.String(512), nullable=True)  # required qualification type ids, space separated
+    time_synced = db.Column(db.DateTime(timezone=True), nullable=True)  # last seen on mturk
+    assignments_synced = db.Column(db.DateTime(timezone=True), nullable=True)
+
+    def as_api(self) -> Dict[str, Any]:
+        """HIT as returned by MTurk API"""
+        return dict(self.data, CreationTime=self.creation_time, Expiration=self.expiration)
+
+
+class MTurkAssignment(BaseModel):
+    """
+    Local mirror of an assignment on MTurk, kept in sync by mturk.MTurkMirror.
+    id is AssignmentId; `data` has the assignment as returned by MTurk API (datetimes as ISO strings).
+    """
+
+    __tablename__ = 'mturk_assignment'
+    __table_args__ = (
+        db.Index('ix_mturk_assignment_hit_id', 'hit_id'),
+        db.Index('ix_mturk_assignment_worker_id', 'worker_id'),
+        db.Index('ix_mturk_assignment_thread_id', 'thread_id'),
+        db.Index('ix_mturk_assignment_status', 'status'),
+    )
+
+    id: str = db.Column(db.String(64), primary_key=True)  # redefine id as str
+    ext_src: str = db.Column(db.String(32), nullable=False)
+    hit_id: str = db.Column(db.String(64), nullable=False)
+    worker_id: str = db.Column(db.String(64), nullable=False)
+    # chat thread of this assignment: thread.ext_id or a value in thread.assignment_id_dict
+    thread_id: int = db.Column(db.Integer, nullable=True)
+    status: str = db.Column(db.String(32), nullable=False)
+    accept_time = db.Column(db.DateTime(timezone=True), nullable=True)
+    submit_time = db.Column(db.DateTime(timezone=True), nullable=True)
+    approval_time = db.Column(db.DateTime(timezone=True), nullable=True)
+
+    def as_api(self) -> Dict[str, Any]:
+        """Assignment as returned by MTurk API"""
+        res = dict(self.data, AssignmentStatus=self.status)
+        for key, val in [('AcceptTime', self.accept_time), ('SubmitTime', self.submit_time),
+                         ('ApprovalTime', self.approval_time)]:
+            if val is not None:
+                res[key] = val
+        return res
+
+
+class MTurkQualifiedWorker(BaseModel):
+    """
+    Local mirror of qualification memberships on MTurk, kept in sync by mturk.MTurkMirror.
+    """
+
+    __tablename__ = 'mturk_qualified_worker'
+    __table_args__ = (
+        db.UniqueConstraint('qual_id', 'worker_id', name='uq_mturk_qualified_worker_qual_id_worker_id'),
+        db.Index('ix_mturk_qualified_worker_worker_id', 'worker_id'),
+    )
+
+    ext_src: str = db.Column(db.String(32), nullable=False)
+    qual_id: str = db.Column(db.String(64), nullable=False)
+    worker_id: str = db.Column(db.String(64), nullable=False)
+    status: str = db.Column(db.String(32), nullable=True)
+    grant_time = db.Column(db.DateTime(timezone=True), nullable=True)
+
+    def as_api(self) -> Dict[str, Any]:
+        return dict(self.data, QualificationTypeId=self.qual_id, WorkerId=self.worker_id, Status=self.status,
+                    GrantTime=self.grant_time)
+
+
+class MTurkPayment(BaseModel):
+    """
+    Ledger of payouts on MTurk: one row per assignment. Approvals and bonuses are recorded as soon as they are made,
+     and the bonus amount once decided, so an assignment is never paid twice; see mturk.MTurkPayout.
+    id is AssignmentId.
+    """
+
+    __tablename__ = 'mturk_payment'
+    __table_args__ = (
+        db.Index('ix_mturk_payment_hit_id', 'hit_id'),
+        db.Index('ix_mturk_payment_job_id', 'job_id'),
+    )
+
+    id: str = db.Column(db.String(64), primary_key=True)  # redefine id as str
+    ext_src: str = db.Column(db.String(32), nullable=False)
+    hit_id: str = db.Column(db.String(64), nullable=True)
+    worker_id: str = db.Column(db.String(64), nullable=False)
+    job_id: int = db.Column(db.Integer, nullable=True)  # payout job working on it; see CrowdJob
+    bonus: str = db.Column(db.String(16), nullable=True)  # USD e.g. '0.25'; '0.00' for no bonus
+    approved_at = db.Column(db.DateTime(timezone=True), nullable=True)
+    bonus_paid_at = db.Column(db.DateTime(timezone=True), nullable=True)
+
+    @property
+    def has_bonus(self) -> bool:
+        return bool(self.bonus) and float(self.bonus) > 0
+
+    @property
+    def is_settled(self) -> bool:
+        """Nothing more to pay"""
+        return bool(self.approved_at) and (not self.has_bonus or bool(self.bonus_paid_at))
+
+
+class CrowdJob(BaseModel):
+    """
+    A background job of many crowd API calls e.g. launching topics as HITs; see jobs.JobRunner.
+    `data` has the job parameters.
+    """
+
+    __tablename__ = 'crowd_job'
+    __table_args__ = (
+        db.Index('ix_crowd_job_status', 'status'),
+        db.Index('ix_crowd_job_time_updated_id', 'time_updated', 'id'),
+    )
+
+    PENDING = 'pending'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'  # finished, with some failed items
+    CANCELLED = 'cancelled'
+
+    kind: str = db.Column(db.String(32), nullable=False)  # e.g. launch
+    ext_src: str = db.Column(db.String(32), nullable=True)  # crowd backend e.g. mturk
+    status: str = db.Column(db.String(16), nullable=False)
+    owner: str = db.Column(db.String(128), nullable=True)  # host:pid of process running it
+    n_total: int = db.Column(db.Integer, nullable=False, server_default='0')
+    n_done: int = db.Column(db.Integer, nullable=False, server_default='0')
+    n_failed: int = db.Column(db.Integer, nullable=False, server_default='0')
+
+    items = db.relationship('CrowdJobItem', lazy='dynamic', order_by='CrowdJobItem.id')
+
+    @property
+    def is_active(self) -> bool:
+        return self.status in (self.PENDING, self.RUNNING)
+
+    @property
+    def n_pending(self) -> int:
+        return self.n_total - self.n_done - self.n_failed
+
+
+class CrowdJobItem(BaseModel):
+    """
+    A unit of work in a CrowdJob e.g. a topic to launch. `data` has the result.
+    """
+
+    __tablename__ = 'crowd_job_item'
+    __table_args__ = (
+        db.UniqueConstraint('job_id', 'key', name='uq_crowd_job_item_job_id_key'),
+        db.Index('ix_crowd_job_item_job_id_status', 'job_id', 'status'),
+    )
+
+    PENDING = 'pending'
+    DONE = 'done'
+    FAILED = 'failed'
 
+    job_id: int = db.Column(db.Integer, db.ForeignKey('crowd_job.id'), nullable=False)
+    key: str = db.Column(db.String(64), nullable=False)  # e.g. topic id
+    status: str = db.Column(db.String(16), nullable=False)
+    attempts: int = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    error: str = db.Column(db.String(1024), nullable=True)
@@ -1,14 +1,26 @@
 import copy
+import functools
 import logging
+import os
+import re
+import threading
+import time
+from typing import Dict, List, Optional
 
 import boto3
 import requests
 from flask import request
 import datetime
+from cachetools import TTLCache
 
-from . import C, log
-from .utils import jsonify, render_template
-from .model import ChatThread
+from flask import current_app, flash, redirect, url_for
+from sqlalchemy import exc, func, orm, sql
+
+from . import C, log, db
+from .utils import jsonify, render_template, stream_template, keyset_page
+from .jobs import TokenBucket, call_with_retry
+from .model import (ChatThread, ChatTopic, MTurkHIT, MTurkAssignment, MTurkQualifiedWorker, MTurkPayment,
+                    CrowdJob, CrowdJobItem)
 
 
 logging.getLogger('boto3').setLevel(C.MTURK_LOG_LEVEL)
@@ -29,16 +41,33 @@ def get_mturk_client(sandbox=False, endpoint_url=C.MTURK_SANDBOX_URL, profile=No
 
 class MTurkService:
 
-    def __init__(self, client, hit_settings=None) -> None:
+    ASSIGNMENT_STATUSES = ['Submitted', 'Approved', 'Rejected']
+
+    def __init__(self, client, hit_settings=None, qual_cache_ttl=C.MTURK_QUAL_CACHE_TTL,
+                 sync_interval=C.MTURK_SYNC_INTERVAL, rate_limit=C.DEF_CROWD_RATE,
+                 burst=C.DEF_CROWD_BURST) -> None:
         self.client = client
         self.hit_settings = hit_settings
         self.is_sandbox = 'sandbox' in self.endpoint_url
         self.name =  C.MTURK_SANDBOX if self.is_sandbox else C.MTURK
 
+        # qualification lookups are on the path of user requests; avoid AWS calls for each
+        self._qual_lock = threading.Lock()
+        self._qual_ids: Dict[str, str] = {}  # name -> id; ids dont change
+        self._qual_misses = TTLCache(maxsize=64, ttl=qual_cache_ttl)  # names not found
+        self._qual_workers = TTLCache(maxsize=64, ttl=qual_cache_ttl)  # id -> frozenset of worker ids
+        # local copy of HITs, assignments and qualifications; admin pages are rendered from it
+        self.mirror = MTurkMirror(self, interval=sync_interval)
+        # bulk operations (e.g. launching many HITs) share this rate limit, to stay under AWS throttling
+        self.bucket = TokenBucket(rate=rate_limit, burst=burst)
+        self.payout = MTurkPayout(self)
+
     @classmethod
-    def new(cls, client, hit_settings, **kwargs):
+    def new(cls, client, hit_settings, qualification_cache_ttl=C.MTURK_QUAL_CACHE_TTL,
+            sync_interval=C.MTURK_SYNC_INTERVAL, rate_limit=C.DEF_CROWD_RATE, burst=C.DEF_CROWD_BURST, **kwargs):
         client = get_mturk_client(**client)
-        return cls(client, hit_settings=hit_settings)
+        return cls(client, hit_settings=hit_settings, qual_cache_ttl=qualification_cache_ttl,
+                   sync_interval=sync_interval, rate_limit=rate_limit, burst=burst)
 
     @property
     def endpoint_url(self) -> str:
@@ -59,82 +88,152 @@ class MTurkService:
     def get_assignment(self, assignment_id):
         return self.client.get_assignment(AssignmentId=assignment_id)['Assignment']
 
+    def _paginate(self, method, result_key: str, max_results=C.AWS_MAX_RESULTS, **kwargs):
+        """
+        Yields items of all pages of a list_* API call, following NextToken
+        :param method: client method e.g. self.client.list_hits
+        :param result_key: key of items in the response e.g. 'HITs'
+        """
+        args = dict(kwargs, MaxResults=max_results)
+        while True:
+            data = method(**args)
+            yield from data.get(result_key) or []
+            next_token = data.get('NextToken')
+            if not next_token or not data.get(result_key):
+                break
+            args['NextToken'] = next_token
+
+    def iter_qualification_types(self, query: str='', page_size=C.AWS_MAX_RESULTS):
+        query = query and query.lower()
+        for qt in self._paginate(self.client.list_qualification_types, 'QualificationTypes', max_results=page_size,
+                                 MustBeRequestable=True, MustBeOwnedByCaller=True):
+            if not query or query in qt['Name'].lower() or query in qt['Description']:
+                yield qt
+
     def list_qualification_types(self, max_results=C.AWS_MAX_RESULTS, query: str=''):
-        data = self.client.list_qualification_types(
-            MustBeRequestable=True, MustBeOwnedByCaller=True,
-            MaxResults=max_results)
-        qtypes = data['QualificationTypes']
-        if query:
-            query = query.lower()
-            qtypes = [qt for qt in qtypes
-                    if query in qt['Name'].lower() or query in qt['Description']]
-        return qtypes
-
-    def get_qualification_type_id_by_name(self, qualification_name):
-        data = self.client.list_qualification_types(
-            MustBeRequestable=True, MustBeOwnedByCaller=True,
-            MaxResults=C.AWS_MAX_RESULTS)
-
-        qtypes = data['QualificationTypes']
-        for cur_type in qtypes:
-            if cur_type['Name'] == qualification_name:
-                return cur_type['QualificationTypeId']
+        # all pages; max_results is page size
+        return list(self.iter_qualification_types(query=query, page_size=max_results))
 
-        return ''
+    def get_qualification_type_id_by_name(self, qualification_name) -> str:
+        """
+        :return: id of qualification type; empty string if not found.
+        Names are resolved once and cached; not found names are retried after cache TTL
+        """
+        with self._qual_lock:
+            if qualification_name in self._qual_ids:
+                return self._qual_ids[qualification_name]
+            if qualification_name in self._qual_misses:
+                return ''
+        qual_id = ''
+        for cur_type in self.iter_qualification_types():
+            if cur_type['Name'] == qualification_name:
+                qual_id = cur_type['QualificationTypeId']
+                break
+        if not qual_id:
+            log.warning(f'Qualification type {qualification_name} not found')
+        with self._qual_lock:
+            if qual_id:
+                self._qual_ids[qualification_name] = qual_id
+            else:
+                self._qual_misses[qualification_name] = qual_id
+        return qual_id
+
+    def get_qualified_workers(self, qual_id: str) -> frozenset:
+        """
+        :return: ids of workers that have been granted the qualification; cached for qual_cache_ttl seconds
+        """
+        with self._qual_lock:
+            workers = self._qual_workers.get(qual_id)
+        if workers is None:
+            workers = frozenset(qual['WorkerId'] for qual in self.iter_workers_for_qualtype(qual_id, status='Granted'))
+            log.info(f'Qualification {qual_id} has {len(workers)} workers')
+            with self._qual_lock:
+                self._qual_workers[qual_id] = workers
+        return workers
+
+    def _update_qualified_workers(self, qual_id: str, worker_id: str, qualified: bool):
+        # keep the cache in sync with our own changes; changes made elsewhere show up after TTL
+        with self._qual_lock:
+            workers = self._qual_workers.get(qual_id)
+            if workers is not None:
+                self._qual_workers[qual_id] = workers | {worker_id} if qualified else workers - {worker_id}
 
     def is_worker_qualified(self, user_worker_id, qual_name):
-        human_moderator_qual_id = self.get_qualification_type_id_by_name(
-            qualification_name=qual_name)
-
-        workers = self.list_workers_for_qualtype(qual_id=human_moderator_qual_id, max_results=C.AWS_MAX_RESULTS)
+        qual_id = self.get_qualification_type_id_by_name(qualification_name=qual_name)
+        if not qual_id:
+            return False
+        return user_worker_id in self.get_qualified_workers(qual_id)
 
-        qual_list_js = workers.get('Qualifications')
-        for cur_qual in qual_list_js:
-            if user_worker_id == cur_qual.get('WorkerId'):
-                return True
-        return False
+    # list_* return one page (NextToken in response is for the next page); iter_* walk all pages lazily
 
-    def list_HITS(self, qual_id:str, max_results=C.AWS_MAX_RESULTS):
+    def list_HITS(self, qual_id:str, max_results=C.AWS_MAX_RESULTS, next_token=None):
         return self.client.list_hits_for_qualification_type(
             QualificationTypeId=qual_id,
-            MaxResults=max_results)
+            MaxResults=max_results,
+            **self._next_token_arg(next_token))
 
-    def list_workers_for_qualtype(self, qual_id:str, max_results=C.AWS_MAX_RESULTS):
+    def iter_HITs_for_qualtype(self, qual_id: str, page_size=C.AWS_MAX_RESULTS):
+        return self._paginate(self.client.list_hits_for_qualification_type, 'HITs', max_results=page_size,
+                              QualificationTypeId=qual_id)
+
+    def list_workers_for_qualtype(self, qual_id:str, max_results=C.AWS_MAX_RESULTS, next_token=None):
         return self.client.list_workers_with_qualification_type(
             QualificationTypeId=qual_id,
-            MaxResults=max_results)
+            MaxResults=max_results,
+            **self._next_token_arg(next_token))
+
+    def iter_workers_for_qualtype(self, qual_id: str, status: str=None, page_size=C.AWS_MAX_RESULTS):
+        args = dict(Status=status) if status else {}
+        return self._paginate(self.client.list_workers_with_qualification_type, 'Qualifications',
+                              max_results=page_size, QualificationTypeId=qual_id, **args)
 
     def list_all_hits(self, max_results=C.AWS_MAX_RESULTS, next_token=None):
-        args = dict(MaxResults=max_results)
-        if next_token:
-            args['NextToken'] = next_token
-        return self.client.list_hits(**args)
+        return self.client.list_hits(MaxResults=max_results, **self._next_token_arg(next_token))
+
+    def iter_all_hits(self, page_size=C.AWS_MAX_RESULTS):
+        return self._paginate(self.client.list_hits, 'HITs', max_results=page_size)
 
-    def list_assignments(self, HIT_id: str, max_results=C.AWS_MAX_RESULTS):
+    def list_assignments(self, HIT_id: str, max_results=C.AWS_MAX_RESULTS, next_token=None):
         return self.client.list_assignments_for_hit(
             HITId=HIT_id,
             MaxResults=max_results,
-            AssignmentStatuses=['Submitted', 'Approved', 'Rejected']
-        )
+            AssignmentStatuses=self.ASSIGNMENT_STATUSES,
+            **self._next_token_arg(next_token))
+
+    def iter_assignments(self, HIT_id: str, page_size=C.AWS_MAX_RESULTS):
+        return self._paginate(self.client.list_assignments_for_hit, 'Assignments', max_results=page_size,
+                              HITId=HIT_id, AssignmentStatuses=self.ASSIGNMENT_STATUSES)
+
+    @staticmethod
+    def _next_token_arg(next_token):
+        return dict(NextToken=next_token) if next_token else {}
 
     def qualify_worker(self, worker_id: str, qual_id: str, send_email=True):
         log.info(f"Qualifying worker: {worker_id} for {qual_id}")
-        return self.client.associate_qualification_with_worker(
+        data = self.client.associate_qualification_with_worker(
             QualificationTypeId=qual_id,
             WorkerId=worker_id,
             IntegerValue=1,
             SendNotification=send_email
             )
+        self._update_qualified_workers(qual_id, worker_id, qualified=True)
+        return data
 
     def disqualify_worker(self, worker_id: str, qual_id: str, reason: str=None):
         log.info(f"Disqualifying worker: {worker_id} for {qual_id}")
-        return self.client.disassociate_qualification_from_worker(
+        data = self.client.disassociate_qualification_from_worker(
             QualificationTypeId=qual_id,
             WorkerId=worker_id,
             Reason=reason
             )
+        self._update_qualified_workers(qual_id, worker_id, qualified=False)
+        return data
 
     def create_HIT(self, external_url, max_assignments, reward, frame_height=800, **kwargs):
+        """
+        Creates a HIT. Pass UniqueRequestToken (in kwargs) to make this safe to retry:
+         if a HIT was already created with that token, that HIT is returned instead of creating another.
+        """
         if not external_url.startswith('https://'):
             raise Exception(f"MTurk requires HTTPS URL")
 
@@ -157,7 +256,14 @@ class MTurkService:
         # keeping title and description will group the HITs together
 
         log.info(f'creating HIT..')
-        response = self.client.create_hit(**args)['HIT']
+        try:
+            response = call_with_retry(self.client.create_hit, bucket=self.bucket, **args)['HIT']
+        except Exception as e:
+            hit_id = args.get('UniqueRequestToken') and self._existing_HIT_id(e)
+            if not hit_id:
+                raise
+            log.info(f'HIT {hit_id} was already created with token {args["UniqueRequestToken"]}')
+            response = call_with_retry(self.client.get_hit, bucket=self.bucket, HITId=hit_id)['HIT']
         hit_id = response['HITId']
         hit_group_id = response['HITGroupId']
         subdomain = 'workersandbox' if self.is_sandbox else 'worker'
@@ -167,6 +273,61 @@ class MTurkService:
         log.info(f'Task URL: {task_url}')
         return hit_id, task_url, response
 
+    def bonus_settings(self) -> Dict:
+        """base_pay, pay_per_hour and reason of bonuses, from hit_settings"""
+        settings = self.hit_settings or {}
+        if "Reward" not in settings:
+            raise ValueError("You must set a reward attribute in the conf.yaml file.")
+        desired_rate = settings.get("DesiredRate", 15)
+        reason = settings.get("BonusReason")
+        return dict(base_pay=float(settings["Reward"]), pay_per_hour=float(desired_rate),
+                    reason=reason and reason.replace("[RATE]", str(desired_rate)))
+
+    #Calculates bonus given to worker to ensure the worker works $15 per hour.
+    @staticmethod
+    def get_bonus(pay_per_hour, base_pay, total_seconds):
+        bonus_payment = 0.00
+        total_mins = ((1.00/60.0) * total_seconds)
+        rate_payment = (pay_per_hour / 60.0) * total_mins
+        if rate_payment > base_pay:
+            bonus_payment = rate_payment - base_pay
+        bonus_payment_ret = round(bonus_payment, 2)
+        return bonus_payment_ret
+
+    def approve_assignment(self, asgn_id: str) -> bool:
+        """Approves a submitted assignment. :return: False if it was approved already"""
+        try:
+            call_with_retry(self.client.approve_assignment, bucket=self.bucket, AssignmentId=asgn_id)
+            return True
+        except Exception as e:
+            if not isinstance(getattr(e, 'response', None), dict):
+                raise
+            # e.g. auto approved after our last sync
+            asgn = call_with_retry(self.client.get_assignment, bucket=self.bucket, AssignmentId=asgn_id)
+            if asgn['Assignment']['AssignmentStatus'] != 'Approved':
+                raise
+            return False
+
+    def send_bonus(self, worker_id: str, asgn_id: str, amount: str, reason: str, unique_token: Optional[str] = None):
+        kwargs = dict(UniqueRequestToken=unique_token) if unique_token else {}
+        return call_with_retry(self.client.send_bonus, bucket=self.bucket, WorkerId=worker_id, BonusAmount=amount,
+                               AssignmentId=asgn_id, Reason=reason, **kwargs)
+
+    def list_bonus_payments(self, asgn_id: str) -> List[Dict]:
+        return list(self._paginate(functools.partial(call_with_retry, self.client.list_bonus_payments,
+                                                     bucket=self.bucket),
+                                   'BonusPayments', AssignmentId=asgn_id))
+
+    @staticmethod
+    def _existing_HIT_id(err: Exception) -> Optional[str]:
+        # duplicate UniqueRequestToken error has the id of the existing HIT in its message
+        error = (getattr(err, 'response', None) or {}).get('Error', {})
+        msg = str(error.get('Message', ''))
+        if 'HitAlreadyExists' not in msg and 'already exists' not in msg.lower():
+            return None
+        match = re.search(r'\b[A-Z0-9]{30}\b', msg)
+        return match and match.group(0)
+
     def task_complete(self, thread: ChatThread, result):
         assert thread.ext_src == self.name
         assignment_id = thread.ext_id
@@ -183,19 +344,469 @@ class MTurkService:
         return reply.status_code == 200
 
 
+def _to_jsonable(obj):
+    # mturk API responses have datetime objects
+    if isinstance(obj, datetime.datetime):
+        return obj.isoformat()
+    if isinstance(obj, dict):
+        return {key: _to_jsonable(val) for key, val in obj.items()}
+    if isinstance(obj, list):
+        return [_to_jsonable(val) for val in obj]
+    return obj
+
+
+def _to_local_time(dt: Optional[datetime.datetime]) -> Optional[datetime.datetime]:
+    # API gives tz aware times; we store naive local times, like the rest of the tables
+    if dt is not None and dt.tzinfo is not None:
+        dt = dt.astimezone().replace(tzinfo=None)
+    return dt
+
+
+def _chunks(items: List, size=C.MTURK_SYNC_BATCH):
+    for i in range(0, len(items), size):
+        yield items[i: i + size]
+
+
+class MTurkMirror:
+    """
+    Mirrors HITs, assignments and qualification memberships of the mturk account into local tables
+     (see MTurkHIT, MTurkAssignment, MTurkQualifiedWorker), so admin pages dont call MTurk API on every render.
+    Sync is incremental: all HITs are listed (100 per call), but assignments are fetched only for HITs that are new,
+     changed, or have assignments waiting for approval.
+    Sync runs every `interval` seconds on a background thread of each server process; a process skips its turn
+     when another process has synced recently.
+    """
+
+    HIT_STATE = ('status', 'review_status', 'max_assignments', 'n_pending', 'n_available', 'n_completed')
+
+    def __init__(self, mturk: 'MTurkService', interval=C.MTURK_SYNC_INTERVAL) -> None:
+        self.mturk = mturk
+        self.interval = interval
+        self._sync_lock = threading.Lock()  # one sync at a time per process
+        self._worker = None
+        self._pid = None
+        self.last_stats: Dict[str, int] = {}
+
+    @property
+    def name(self) -> str:
+        return self.mturk.name
+
+    def start(self, app):
+        """Starts periodic sync in background; once per process"""
+        if not self.interval:
+            log.info('mturk sync_interval is 0; mirror is synced on demand only')
+            return
+        if self._worker is not None and self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+        self._worker = threading.Thread(target=self._run, args=(app,), name='mturk-sync', daemon=True)
+        self._worker.start()
+
+    def _run(self, app):
+        while True:
+            try:
+                with app.app_context():
+                    last_synced = self.last_synced()
+                    if last_synced and (datetime.datetime.now() - last_synced).total_seconds() < self.interval / 2:
+                        log.debug(f'{self.name} was synced at {last_synced}; skipping')
+                    else:
+                        self.sync()
+            except Exception as e:
+                log.exception(e)
+            time.sleep(self.interval)
+
+    def sync_async(self, app) -> bool:
+        """Starts a sync now, in background. :return: False if a sync is in progress already"""
+        if self._sync_lock.locked():
+            return False
+        def _sync():
+            with app.app_context():
+                self.sync()
+        threading.Thread(target=_sync, name='mturk-sync-now', daemon=True).start()
+        return True
+
+    def last_synced(self) -> Optional[datetime.datetime]:
+        return db.session.query(func.max(MTurkHIT.time_synced)).filter(MTurkHIT.ext_src == self.name).scalar()
+
+    def sync(self) -> Dict[str, int]:
+        with self._sync_lock:
+            start = time.time()
+            log.info(f'Syncing {self.name} mirror')
+            try:
+                stats = self.sync_hits()
+                stats |= self.sync_qualifications()
+            except Exception:
+                db.session.rollback()
+                raise
+            log.info(f'Synced {self.name} mirror in {time.time() - start:.1f}s: {stats}')
+            self.last_stats = stats
+            return stats
+
+    @staticmethod
+    def _hit_fields(hit: Dict) -> Dict:
+        return dict(
+            data=_to_jsonable(hit),
+            status=hit.get('HITStatus'),
+            review_status=hit.get('HITReviewStatus'),
+            title=hit.get('Title'),
+            creation_time=_to_local_time(hit.get('CreationTime')),
+            expiration=_to_local_time(hit.get('Expiration')),
+            max_assignments=hit.get('MaxAssignments'),
+            n_pending=hit.get('NumberOfAssignmentsPending'),
+            n_available=hit.get('NumberOfAssignmentsAvailable'),
+            n_completed=hit.get('NumberOfAssignmentsCompleted'),
+            qual_ids=' '.join(req['QualificationTypeId'] for req in hit.get('QualificationRequirements', [])),
+        )
+
+    def _update_hits(self, where, **values):
+        # bookkeeping updates; these should not bump time_updated, which orders HITs page by recent change
+        db.session.execute(sql.update(MTurkHIT).where(MTurkHIT.ext_src == self.name, where)
+                           .values(time_updated=MTurkHIT.time_updated, **values)
+                           .execution_options(synchronize_session=False))
+
+    def sync_hits(self) -> Dict[str, int]:
+        stats = dict(hits_new=0, hits_changed=0, hits_deleted=0, assignments=0)
+        known = {row.id: row for row in MTurkHIT.query.filter_by(ext_src=self.name)
+                 .options(orm.load_only(MTurkHIT.id, *[getattr(MTurkHIT, key) for key in self.HIT_STATE]))}
+        seen = set()
+        refresh = []  # HITs whose assignments need sync
+        for i, hit in enumerate(self.mturk.iter_all_hits(), start=1):
+            hit_id = hit['HITId']
+            seen.add(hit_id)
+            fields = self._hit_fields(hit)
+            row = known.get(hit_id)
+            if row is None:
+                db.session.add(MTurkHIT(id=hit_id, ext_src=self.name, **fields))
+                stats['hits_new'] += 1
+                refresh.append(hit_id)
+            elif any(getattr(row, key) != fields[key] for key in self.HIT_STATE):
+                for key, val in fields.items():
+                    setattr(row, key, val)
+                stats['hits_changed'] += 1
+                refresh.append(hit_id)
+            if i % C.MTURK_SYNC_BATCH == 0:
+                db.session.commit()  # short write transactions; on sqlite, writers wait for each other
+        db.session.commit()
+
+        gone = list(known.keys() - seen)  # deleted on mturk
+        for chunk in _chunks(gone):
+            MTurkAssignment.query.filter(MTurkAssignment.hit_id.in_(chunk)).delete(synchronize_session=False)
+            MTurkHIT.query.filter(MTurkHIT.id.in_(chunk)).delete(synchronize_session=False)
+        stats['hits_deleted'] = len(gone)
+
+        now = datetime.datetime.now()
+        # link HITs to topics; topic.ext_id is indexed
+        topic_id = sql.select(ChatTopic.id).where(ChatTopic.ext_id == MTurkHIT.id).limit(1).scalar_subquery()
+        self._update_hits(MTurkHIT.topic_id.is_(None), topic_id=topic_id)
+        self._update_hits(sql.true(), time_synced=now)
+        db.session.commit()
+
+        # approvals (incl. auto approvals) dont change HIT, so keep checking HITs that have submitted assignments
+        waiting = db.session.query(MTurkAssignment.hit_id).filter(
+            MTurkAssignment.ext_src == self.name, MTurkAssignment.status == 'Submitted').distinct()
+        refresh = list(dict.fromkeys(refresh + [hit_id for hit_id, in waiting]))
+        for hit_id in refresh:
+            stats['assignments'] += self.sync_assignments(hit_id)
+        return stats
+
+    def sync_hit(self, HIT_id: str):
+        """Syncs one HIT and its assignments now; e.g. after changing it"""
+        hit = self.mturk.client.get_hit(HITId=HIT_id)['HIT']
+        row = MTurkHIT.query.get(HIT_id)
+        fields = self._hit_fields(hit)
+        if row is None:
+            row = MTurkHIT(id=HIT_id, ext_src=self.name, **fields)
+            db.session.add(row)
+        else:
+            for key, val in fields.items():
+                setattr(row, key, val)
+        db.session.commit()
+        self.sync_assignments(HIT_id)
+
+    def _thread_ids(self, HIT_id: str) -> Dict[str, int]:
+        # assignment id -> chat thread id
+        topic_ids = sql.select(ChatTopic.id).where(ChatTopic.ext_id == HIT_id)
+        threads = ChatThread.query.filter(ChatThread.topic_id.in_(topic_ids))\
+            .options(orm.load_only(ChatThread.id, ChatThread.ext_id, ChatThread.assignment_id_dict))
+        res = {}
+        for thread in threads:
+            for asgn_id in (thread.assignment_id_dict or {}).values():
+                res[asgn_id] = thread.id
+            if thread.ext_id:
+                res[thread.ext_id] = thread.id
+        return res
+
+    def sync_assignments(self, HIT_id: str) -> int:
+        """:return: number of new or changed assignments"""
+        remote = list(self.mturk.iter_assignments(HIT_id=HIT_id))  # upto MaxAssignments of HIT
+        known = {row.id: row for row in MTurkAssignment.query.filter_by(hit_id=HIT_id)}
+        thread_ids = self._thread_ids(HIT_id) if remote else {}
+        count = 0
+        for asgn in remote:
+            asgn_id = asgn['AssignmentId']
+            fields = dict(
+                data=_to_jsonable(asgn),
+                worker_id=asgn['WorkerId'],
+                thread_id=thread_ids.get(asgn_id),
+                status=asgn['AssignmentStatus'],
+                accept_time=_to_local_time(asgn.get('AcceptTime')),
+                submit_time=_to_local_time(asgn.get('SubmitTime')),
+                approval_time=_to_local_time(asgn.get('ApprovalTime')))
+            row = known.pop(asgn_id, None)
+            if row is None:
+                db.session.add(MTurkAssignment(id=asgn_id, ext_src=self.name, hit_id=HIT_id, **fields))
+                count += 1
+            elif row.status != fields['status'] or row.thread_id != fields['thread_id']:
+                for key, val in fields.items():
+                    setattr(row, key, val)
+                count += 1
+        for row in known.values():  # no longer listed; e.g. HIT was deleted and recreated
+            db.session.delete(row)
+        self._update_hits(MTurkHIT.id == HIT_id, assignments_synced=datetime.datetime.now())
+        db.session.commit()
+        return count
+
+    def set_assignment_status(self, asgn_id: str, status: str):
+        # reflect our own change now, without waiting for next sync
+        row = MTurkAssignment.query.get(asgn_id)
+        if row:
+            row.status = status
+            row.data = dict(row.data, AssignmentStatus=status)
+            db.session.commit()
+
+    def delete_hit(self, HIT_id: str):
+        MTurkAssignment.query.filter_by(hit_id=HIT_id).delete(synchronize_session=False)
+        MTurkHIT.query.filter_by(id=HIT_id).delete(synchronize_session=False)
+        db.session.commit()
+
+    def sync_qualifications(self) -> Dict[str, int]:
+        stats = dict(qual_types=0, qual_workers_new=0, qual_workers_deleted=0)
+        qual_ids = []
+        for qtype in self.mturk.iter_qualification_types():
+            qual_id = qtype['QualificationTypeId']
+            qual_ids.append(qual_id)
+            remote = {qual['WorkerId']: qual for qual in self.mturk.iter_workers_for_qualtype(qual_id)}
+            known = {row.worker_id: row for row in MTurkQualifiedWorker.query.filter_by(qual_id=qual_id)}
+            for worker_id, qual in remote.items():
+                row = known.pop(worker_id, None)
+                if row is None:
+                    db.session.add(MTurkQualifiedWorker(ext_src=self.name, qual_id=qual_id, worker_id=worker_id,
+                                                        status=qual.get('Status'), data=_to_jsonable(qual),
+                                                        grant_time=_to_local_time(qual.get('GrantTime'))))
+                    stats['qual_workers_new'] += 1
+                elif row.status != qual.get('Status'):
+                    row.status = qual.get('Status')
+                    row.data = _to_jsonable(qual)
+            for row in known.values():
+                db.session.delete(row)
+            stats['qual_workers_deleted'] += len(known)
+            db.session.commit()
+        # qualification types that were deleted
+        MTurkQualifiedWorker.query.filter(MTurkQualifiedWorker.ext_src == self.name,
+                                          MTurkQualifiedWorker.qual_id.notin_(qual_ids))\
+            .delete(synchronize_session=False)
+        db.session.commit()
+        stats['qual_types'] = len(qual_ids)
+        return stats
+
+    def set_qualified(self, worker_id: str, qual_id: str, qualified: bool):
+        row = MTurkQualifiedWorker.query.filter_by(qual_id=qual_id, worker_id=worker_id).first()
+        if qualified and not row:
+            db.session.add(MTurkQualifiedWorker(ext_src=self.name, qual_id=qual_id, worker_id=worker_id,
+                                                status='Granted', grant_time=datetime.datetime.now()))
+        elif not qualified and row:
+            db.session.delete(row)
+        db.session.commit()
+
+
+class MTurkPayout:
+    """
+    Bulk approval of assignments and bonus payments of HITs, as background jobs (see jobs.py).
+    Assignments are selected from the local mirror (see MTurkMirror), and bonuses are computed by MTurkService.get_bonus.
+    Every approval and bonus is recorded in a ledger (MTurkPayment) as soon as it is made, and the bonus amount
+     is fixed when first decided; so rerunning, retrying or resuming a payout never pays an assignment twice.
+    """
+
+    PAYABLE_STATUSES = ['Submitted', 'Approved']
+
+    def __init__(self, mturk: 'MTurkService') -> None:
+        self.mturk = mturk
+
+    @property
+    def name(self) -> str:
+        return self.mturk.name
+
+    def bonus_of(self, asgn: MTurkAssignment, settings: Dict) -> str:
+        bonus = 0.0
+        if asgn.accept_time and asgn.submit_time:
+            total_seconds = (asgn.submit_time - asgn.accept_time).total_seconds()
+            bonus = self.mturk.get_bonus(base_pay=settings['base_pay'], pay_per_hour=settings['pay_per_hour'],
+                                         total_seconds=total_seconds)
+        return f'{bonus:.2f}'
+
+    def plan(self, HIT_ids: List[str]):
+        """
+        What a payout of these HITs would do; nothing is changed.
+        :return: generator of (assignment, bonus, ledger row or None); rows are read in batches
+        """
+        settings = self.mturk.bonus_settings()
+        for HIT_ids_batch in _chunks(list(HIT_ids), size=C.MTURK_SYNC_BATCH):
+            rows = db.session.query(MTurkAssignment, MTurkPayment)\
+                .outerjoin(MTurkPayment, MTurkPayment.id == MTurkAssignment.id)\
+                .filter(MTurkAssignment.ext_src == self.name, MTurkAssignment.hit_id.in_(HIT_ids_batch),
+                        MTurkAssignment.status.in_(self.PAYABLE_STATUSES))\
+                .order_by(MTurkAssignment.hit_id, MTurkAssignment.submit_time).yield_per(C.MTURK_SYNC_BATCH)
+            for asgn, payment in rows:
+                # amount in ledger wins; it may have been paid already
+                bonus = payment.bonus if payment and payment.bonus is not None else self.bonus_of(asgn, settings)
+                yield asgn, bonus, payment
+
+    def create_job(self, jobs, HIT_ids: List[str]) -> CrowdJob:
+        """Creates a payout job of assignments of HITs that are not settled yet; start it with jobs.start()"""
+        settings = self.mturk.bonus_settings()
+        item_data = {}
+        for asgn, bonus, payment in self.plan(HIT_ids):
+            if payment and payment.is_settled:
+                continue
+            if float(bonus) > 0 and not settings['reason']:
+                raise ValueError('BonusReason must be set in mturk.hit_settings of conf.yml to send bonuses')
+            item_data[asgn.id] = dict(bonus=bonus)
+        return jobs.create(C.JOB_PAYOUT, keys=list(item_data), params=dict(n_HITs=len(HIT_ids), **settings),
+                           ext_src=self.name, item_data=item_data)
+
+    def _claim(self, asgn: MTurkAssignment, job_id: int, bonus: str) -> MTurkPayment:
+        # one job pays an assignment at a time
+        if not MTurkPayment.query.get(asgn.id):
+            db.session.add(MTurkPayment(id=asgn.id, ext_src=self.name, hit_id=asgn.hit_id, worker_id=asgn.worker_id,
+                                        bonus=bonus, job_id=job_id))
+            try:
+                db.session.commit()
+            except exc.IntegrityError:
+                db.session.rollback()  # another job just added it
+        res = db.session.execute(sql.update(MTurkPayment).where(
+            MTurkPayment.id == asgn.id, self._not_claimed_by_others(job_id))
+            .values(job_id=job_id).execution_options(synchronize_session=False))
+        db.session.commit()
+        payment = MTurkPayment.query.get(asgn.id)
+        if res.rowcount != 1:
+            raise ValueError(f'Assignment {asgn.id} is being paid by job {payment.job_id}')
+        if payment.bonus is None:
+            payment.bonus = bonus
+            db.session.commit()
+        return payment
+
+    @staticmethod
+    def _not_claimed_by_others(job_id: Optional[int] = None):
+        # ledger rows that no other active job is working on
+        other_active = sql.select(CrowdJob.id).where(
+            CrowdJob.id != job_id, CrowdJob.status.in_([CrowdJob.PENDING, CrowdJob.RUNNING])).scalar_subquery()
+        return sql.or_(MTurkPayment.job_id.is_(None), MTurkPayment.job_id == job_id,
+                       MTurkPayment.job_id.not_in(other_active))
+
+    def pay(self, item: CrowdJobItem, params: Dict) -> Dict:
+        """Job handler: approves an assignment and sends its bonus; each step is skipped if the ledger has it done"""
+        asgn = MTurkAssignment.query.get(item.key)
+        if not asgn:
+            raise ValueError(f'Assignment {item.key} not found in local mirror')
+        payment = self._claim(asgn, job_id=item.job_id, bonus=item.data['bonus'])
+        result = dict(bonus=payment.bonus, approved=False, bonus_sent=False)
+        if not payment.approved_at:
+            if asgn.status != 'Approved':
+                result['approved'] = self.mturk.approve_assignment(asgn.id)
+                self.mturk.mirror.set_assignment_status(asgn.id, 'Approved')
+            payment.approved_at = asgn.approval_time or datetime.datetime.now()
+            db.session.commit()
+        if payment.has_bonus and not payment.bonus_paid_at:
+            # bonuses sent outside of the ledger (e.g. before it existed) count too
+            paid = self.mturk.list_bonus_payments(asgn.id)
+            if paid:
+                log.info(f'Assignment {asgn.id} was given a bonus already: {paid}')
+                payment.bonus_paid_at = _to_local_time(paid[0].get('GrantTime')) or datetime.datetime.now()
+            else:
+                self.mturk.send_bonus(asgn.worker_id, asgn.id, amount=payment.bonus, reason=params['reason'],
+                                      unique_token=self.bonus_token(asgn.id))
+                payment.bonus_paid_at = datetime.datetime.now()
+                result['bonus_sent'] = True
+            db.session.commit()
+        return result
+
+    def record_approved(self, asgn_id: str):
+        """Records an approval made elsewhere e.g. by admin for one assignment"""
+        payment = self._get_or_new(asgn_id)
+        if payment and not payment.approved_at:
+            payment.approved_at = datetime.datetime.now()
+            db.session.commit()
+
+    @staticmethod
+    def bonus_token(asgn_id: str) -> str:
+        # UniqueRequestToken of bonus; mturk ignores repeated requests with the same token
+        return f'boteval-bonus-{asgn_id}'
+
+    def give_bonus(self, asgn_id: str, worker_id: str, amount: str, reason: str) -> Dict:
+        """
+        Sends a bonus for one assignment, e.g. by admin. The ledger row is claimed before the bonus is sent, and
+         the request token is the same as of payout jobs; so double clicks and running payouts dont pay it twice.
+        :return: response of send_bonus
+        :raises ValueError: if bonus was paid already, or a payout job is paying it
+        """
+        if not MTurkPayment.query.get(asgn_id):
+            db.session.add(self._get_or_new(asgn_id) or
+                           MTurkPayment(id=asgn_id, ext_src=self.name, worker_id=worker_id))  # not in mirror yet
+            try:
+                db.session.commit()
+            except exc.IntegrityError:
+                db.session.rollback()  # added concurrently
+        claimed = db.session.execute(sql.update(MTurkPayment).where(
+            MTurkPayment.id == asgn_id, MTurkPayment.bonus_paid_at.is_(None), self._not_claimed_by_others())
+            .values(bonus=amount, bonus_paid_at=datetime.datetime.now())
+            .execution_options(synchronize_session=False)).rowcount
+        db.session.commit()
+        if claimed != 1:
+            payment = MTurkPayment.query.get(asgn_id)
+            if payment.bonus_paid_at:
+                raise ValueError(f'Bonus of ${payment.bonus} was already paid for {asgn_id} on {payment.bonus_paid_at}')
+            raise ValueError(f'Bonus of {asgn_id} is being paid by job {payment.job_id}')
+        try:
+            return self.mturk.send_bonus(worker_id, asgn_id, amount=amount, reason=reason,
+                                         unique_token=self.bonus_token(asgn_id))
+        except Exception:
+            # not paid; release the claim, so it can be retried
+            db.session.execute(sql.update(MTurkPayment).where(MTurkPayment.id == asgn_id)
+                               .values(bonus_paid_at=None).execution_options(synchronize_session=False))
+            db.session.commit()
+            raise
+
+    def bonus_paid(self, asgn_id: str) -> Optional[MTurkPayment]:
+        payment = MTurkPayment.query.get(asgn_id)
+        return payment if payment and payment.bonus_paid_at else None
+
+    def _get_or_new(self, asgn_id: str) -> Optional[MTurkPayment]:
+        payment = MTurkPayment.query.get(asgn_id)
+        if payment is None:
+            asgn = MTurkAssignment.query.get(asgn_id)
+            if not asgn:
+                log.warning(f'Assignment {asgn_id} is not in local mirror; not recorded in ledger')
+                return None
+            payment = MTurkPayment(id=asgn_id, ext_src=self.name, hit_id=asgn.hit_id, worker_id=asgn.worker_id)
+            db.session.add(payment)
+        return payment
+
+
 class MTurkController:
 
-    def __init__(self, mturk: MTurkService, templates_dir='admin/mturk/'):
+    def __init__(self, mturk: MTurkService, templates_dir='admin/mturk/', jobs=None):
         """Registers mechanical turk controller
 
         Args:
             mturk (_type_): MTurk service object
             where (_type_): live or sandbox
+            jobs (JobRunner): runs bulk operations e.g. payouts in background
         """
         #assert where in ('live', 'sandbox')
         #self.where = where
         self.mturk: MTurkService = mturk
         self.templates_dir = templates_dir
+        self.jobs = jobs
         self.meta = dict(mturk_endpoint_url=self.mturk.endpoint_url,
                          crowd_name=self.mturk.name)
         assert mturk.name in (C.MTURK, C.MTURK_SANDBOX)
@@ -205,6 +816,7 @@ class MTurkController:
         log.info(f'Registering mturk routes')
         rules = [
             ('/', self.home, dict(methods=["GET"])),
+            ('/sync', self.sync_mirror, dict(methods=["POST"])),
             ('/qualification/', self.list_qualifications, dict(methods=["GET"])),
             ('/qualification/<qual_id>', self.get_qualification, dict(methods=["GET"])),
             ('/qualification/<qual_id>', self.delete_qualification, dict(methods=['DELETE'])),
@@ -212,6 +824,7 @@ class MTurkController:
             ('/HIT/<HIT_id>', self.get_HIT, dict(methods=["GET"])),
             ('/HIT/<HIT_id>', self.delete_hit, dict(methods=['DELETE'])),
             ('/HIT/<HIT_id>/expire', self.expire_HIT, dict(methods=['DELETE'])),
+            ('/payout', self.payout, dict(methods=["GET", "POST"])),
             ('/assignment/<asgn_id>/approve', self.approve_assignment, dict(methods=["POST"])),
             ('/assignment/<asgn_id>/<worker_id>/<payment>/give_bonus', self.give_bonus, dict(methods=["POST"])),
             ('/worker/<worker_id>/qualification', self.qualify_worker, dict(methods=["POST", "PUT"])),
@@ -228,75 +841,147 @@ class MTurkController:
     def render_template(self, name, *args, **kwargs):
         return render_template(self.templates_dir + name, *args, meta=self.meta, **kwargs)
 
+    def stream_template(self, name, **kwargs):
+        return stream_template(self.templates_dir + name, meta=self.meta, **kwargs)
+
     def home(self):
-        return self.render_template('home.html')
+        mirror = self.mturk.mirror
+        HIT_counts = db.session.query(MTurkHIT.status, func.count(MTurkHIT.id))\
+            .filter(MTurkHIT.ext_src == self.mturk.name).group_by(MTurkHIT.status).all()
+        asgn_counts = db.session.query(MTurkAssignment.status, func.count(MTurkAssignment.id))\
+            .filter(MTurkAssignment.ext_src == self.mturk.name).group_by(MTurkAssignment.status).all()
+        sync = dict(last_synced=mirror.last_synced(), interval=mirror.interval, stats=mirror.last_stats,
+                    running=mirror._sync_lock.locked())
+        return self.render_template('home.html', HIT_counts=HIT_counts, asgn_counts=asgn_counts, sync=sync)
+
+    def sync_mirror(self):
+        if self.mturk.mirror.sync_async(current_app._get_current_object()):
+            flash('Sync started; reload this page in a while to see updates')
+        else:
+            flash('Sync is in progress already')
+        return redirect(request.referrer or '../')
 
     def list_qualifications(self):
         qtypes = self.mturk.list_qualification_types(max_results=C.AWS_MAX_RESULTS)
         return self.render_template('qualifications.html', qtypes=qtypes)
 
     def get_qualification(self, qual_id):
-        HITs = self.mturk.list_HITS(qual_id=qual_id,max_results=C.AWS_MAX_RESULTS)
-        workers = self.mturk.list_workers_for_qualtype(qual_id=qual_id, max_results=C.AWS_MAX_RESULTS)
-        data = dict(HITs=HITs['HITs'], workers=workers['Qualifications'])
-        return self.render_template('qualification.html', data=data, qual_id=qual_id)
+        # from local mirror; rows are streamed while the page is being sent
+        HITs = MTurkHIT.query.filter(MTurkHIT.ext_src == self.mturk.name, MTurkHIT.qual_ids.contains(qual_id))\
+            .order_by(MTurkHIT.creation_time.desc()).yield_per(C.MTURK_SYNC_BATCH)
+        workers = MTurkQualifiedWorker.query.filter_by(qual_id=qual_id)\
+            .order_by(MTurkQualifiedWorker.grant_time.desc()).yield_per(C.MTURK_SYNC_BATCH)
+        data = dict(HITs=(row.as_api() for row in HITs), workers=(row.as_api() for row in workers))
+        return self.stream_template('qualification.html', data=data, qual_id=qual_id)
 
     def delete_qualification(self, qual_id):
         data = self.mturk.mturk.delete_qualification_type(QualificationTypeId=qual_id)
         return jsonify(data), 200
 
     def list_HITs(self):
-        data = self.mturk.list_all_hits()
-        return self.render_template('HITs.html', data=data)
+        # from local mirror, recently changed first; one page at a time
+        query = MTurkHIT.query.filter_by(ext_src=self.mturk.name)
+        status = request.args.get('status')
+        if status:
+            query = query.filter_by(status=status)
+        rows, next_after = keyset_page(query, MTurkHIT, after_id=request.args.get('after'))
+        HITs = [row.as_api() | dict(topic_id=row.topic_id) for row in rows]
+        return self.render_template('HITs.html', data=dict(HITs=HITs), next_after=next_after, status=status,
+                                    last_synced=self.mturk.mirror.last_synced())
 
     def get_HIT(self, HIT_id):
-        data = self.mturk.list_assignments(HIT_id=HIT_id, max_results=100)
-        print(data)
-        qtypes = None
-        bonus_settings = self.mturk.hit_settings
-        if not "Reward" in bonus_settings:
-            return "You must set a reward attribute in the conf.yaml file."
-        base_pay = float(bonus_settings["Reward"])
-        pay_per_hour = float(bonus_settings.get("DesiredRate", 15))
-        bonus_pay = []
-        if data['Assignments']:
-            qtypes = self.mturk.list_qualification_types(max_results=100)
-            for i in enumerate(data['Assignments']):
-                index = i[0]
-                this_assignment = i[1]
-                total_time = this_assignment['SubmitTime'] - this_assignment['AcceptTime']
-                total_seconds = total_time.total_seconds()
-                this_bonus = self.get_bonus(base_pay=base_pay, pay_per_hour=pay_per_hour, total_seconds=total_seconds)
-                bonus_pay.insert(index, this_bonus)
-        return self.render_template('HIT.html', data=data, HIT_id=HIT_id, qtypes=qtypes, base_pay=base_pay, pay_per_hour=pay_per_hour, bonus_pay=bonus_pay)
+        try:
+            bonus_settings = self.mturk.bonus_settings()
+        except ValueError as e:
+            return str(e)
+        base_pay = bonus_settings['base_pay']
+        pay_per_hour = bonus_settings['pay_per_hour']
+        qtypes = self.mturk.list_qualification_types(max_results=C.AWS_MAX_RESULTS)
+        # from local mirror; assignments are read in batches, and their bonuses computed, while the page is being sent
+        rows = db.session.query(MTurkAssignment, MTurkPayment.bonus_paid_at, MTurkPayment.bonus)\
+            .outerjoin(MTurkPayment, MTurkPayment.id == MTurkAssignment.id)\
+            .filter(MTurkAssignment.hit_id == HIT_id).order_by(MTurkAssignment.submit_time)\
+            .yield_per(C.MTURK_SYNC_BATCH)
+        assignments = self.with_bonus((row.as_api() | dict(thread_id=row.thread_id, bonus_paid_at=paid_at,
+                                                           bonus_paid=paid_bonus)
+                                       for row, paid_at, paid_bonus in rows),
+                                      base_pay=base_pay, pay_per_hour=pay_per_hour)
+        return self.stream_template('HIT.html', assignments=assignments, HIT_id=HIT_id, qtypes=qtypes,
+                                    base_pay=base_pay, pay_per_hour=pay_per_hour)
+
+    def with_bonus(self, assignments, base_pay, pay_per_hour):
+        """
+        Pairs each assignment with its bonus.
+        :return: generator of (assignment, bonus)
+        """
+        for asgn in assignments:
+            bonus = 0.0
+            if 'AcceptTime' in asgn and 'SubmitTime' in asgn:
+                total_seconds = (asgn['SubmitTime'] - asgn['AcceptTime']).total_seconds()
+                bonus = self.get_bonus(base_pay=base_pay, pay_per_hour=pay_per_hour, total_seconds=total_seconds)
+            yield asgn, bonus
 
     def delete_hit(self, HIT_id):
         data = self.mturk.client.delete_hit(HITId=HIT_id)
+        self.mturk.mirror.delete_hit(HIT_id)
         return jsonify(data), data.get('HTTPStatusCode', 200)
 
     def approve_assignment(self, asgn_id):
         #RequesterFeedback=feedback # any feed back message to worker
         data = self.mturk.client.approve_assignment(AssignmentId=asgn_id)
+        self.mturk.mirror.set_assignment_status(asgn_id, 'Approved')
+        self.mturk.payout.record_approved(asgn_id)
         return jsonify(data), data.get('HTTPStatusCode', 200)
 
     #Calculates bonus given to worker to ensure the worker works $15 per hour.
     def give_bonus(self, worker_id, payment, asgn_id):
-        bonus_settings = self.mturk.hit_settings
-        bonus_payment_ret = float(payment)
-        bonus_reason = bonus_settings["BonusReason"]
-        desired_rate = str(bonus_settings["DesiredRate"])
-        bonus_reason = bonus_reason.replace("[RATE]", desired_rate)
-        data = self.mturk.client.send_bonus(WorkerId=worker_id,BonusAmount=str(bonus_payment_ret),AssignmentId=asgn_id,Reason=bonus_reason)
+        bonus_reason = self.mturk.bonus_settings()["reason"]
+        try:
+            data = self.mturk.payout.give_bonus(asgn_id, worker_id, amount=f'{float(payment):.2f}', reason=bonus_reason)
+        except ValueError as e:
+            return str(e), 409
         return jsonify(data), data.get('HTTPStatusCode', 200)
     
     def get_bonus(self, pay_per_hour, base_pay, total_seconds):
-        bonus_payment = 0.00
-        total_mins = ((1.00/60.0) * total_seconds)
-        rate_payment = (pay_per_hour / 60.0) * total_mins
-        if rate_payment > base_pay:
-            bonus_payment = rate_payment - base_pay
-        bonus_payment_ret = round(bonus_payment, 2)
-        return bonus_payment_ret
+        return self.mturk.get_bonus(pay_per_hour=pay_per_hour, base_pay=base_pay, total_seconds=total_seconds)
+
+    def _selected_HIT_ids(self) -> List[str]:
+        # HIT ids and topic ids; one per line, or space or comma separated, or repeated form fields
+        def _values(name):
+            return [val for vals in request.form.getlist(name) for val in re.split(r'[\s,]+', vals) if val]
+        HIT_ids = _values('HIT_ids')
+        topic_ids = _values('topic_ids')
+        if topic_ids:
+            HIT_ids += [hit_id for hit_id, in db.session.query(MTurkHIT.id).filter(
+                MTurkHIT.ext_src == self.mturk.name, MTurkHIT.topic_id.in_(topic_ids))]
+        return list(dict.fromkeys(HIT_ids))
+
+    def payout(self):
+        """
+        Approves assignments of selected HITs (or topics) and pays their bonuses in a background job.
+        GET shows the form; POST with dry_run shows what would be paid, without paying.
+        """
+        if request.method == 'GET':
+            return self.render_template('payout.html', last_synced=self.mturk.mirror.last_synced(),
+                                        HIT_ids=request.args.getlist('HIT_ids'))
+        HIT_ids = self._selected_HIT_ids()
+        if not HIT_ids:
+            flash('No HITs selected')
+            return redirect(request.referrer or './payout')
+        try:
+            settings = self.mturk.bonus_settings()
+            if request.form.get('dry_run'):
+                plan = self.mturk.payout.plan(HIT_ids)
+                return self.stream_template('payout_plan.html', plan=plan, HIT_ids=HIT_ids, settings=settings,
+                                            last_synced=self.mturk.mirror.last_synced())
+            if not self.jobs:
+                return 'Background jobs are not available', 400
+            job = self.mturk.payout.create_job(self.jobs, HIT_ids)
+        except ValueError as e:
+            return str(e), 400
+        self.jobs.start(current_app._get_current_object(), job.id)
+        flash(f'Paying out {job.n_total} assignments of {len(HIT_ids)} HITs')
+        return redirect(url_for('admin.get_job', job_id=job.id))
 
     def qualify_worker(self, worker_id):
         qual_id = request.form.get('QualificationTypeId')
@@ -304,12 +989,14 @@ class MTurkController:
         if not qual_id:
             return 'ERROR: QualificationTypeId argument is requires', 400
         data = self.mturk.qualify_worker(worker_id=worker_id, qual_id=qual_id)
+        self.mturk.mirror.set_qualified(worker_id, qual_id, qualified=True)
         return jsonify(data), data.get('HTTPStatusCode', 200)
 
     def disqualify_worker(self, worker_id, qual_id):
         log.info(f"Disqualify: worker: {worker_id} from qualification: {qual_id}")
         reason = request.values.get('reason', '')
         data = self.mturk.disqualify_worker(worker_id=worker_id,qual_id=qual_id, reason=reason)
+        self.mturk.mirror.set_qualified(worker_id, qual_id, qualified=False)
         return jsonify(data), data.get('HTTPStatusCode', 200)
 
     def expire_HIT(self, HIT_id):
@@ -317,4 +1004,5 @@ class MTurkController:
         data = self.mturk.client.update_expiration_for_hit(
                 HITId=HIT_id, ExpireAt=datetime.datetime(2021, 1, 1)
             )
+        self.mturk.mirror.sync_hit(HIT_id)
         return jsonify(data), data.get('HTTPStatusCode', 200)
@@ -0,0 +1,135 @@
+"""
+Offline pre-transform of seed conversations in topics file.
+Runs the `human` (or `bot`) transforms chain of a task over every seed message in bulk, and stores
+ `text_orig` (input) and `text` (output) in the topic data, so creating a chat thread never calls a model.
+
+    boteval-pretransform path/to/task-dir
+"""
+import argparse
+import json
+import multiprocessing as mp
+import shutil
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from . import log, C, registry as R
+from .config import TaskConfig
+from .model import ChatMessage
+from .transforms import load_transforms, Transforms
+from .utils import load_dir_as_module
+
+
+def transform_message(msg: Dict, transforms: Transforms) -> bool:
+    """
+    Transforms a seed message in place. Messages that already have text_orig are skipped.
+    :return: True if message was transformed, False if skipped
+    """
+    if msg.get('text_orig') is not None:
+        return False
+    res = transforms(ChatMessage(text=msg['text'], data=dict(speaker_id=msg.get('speaker_id'))))
+    msg['text_orig'] = res.data.get('text_orig', msg['text'])
+    msg['text'] = res.text
+    return True
+
+
+def pretransform_topics(topics: List[Dict], transforms: Transforms, threads=C.DEF_PRETRANSFORM_THREADS) -> int:
+    """
+    Transforms seed messages of all topics in place.
+    Messages are transformed concurrently by `threads` threads, so that batching transforms
+     (e.g. huggingface-mt) can group them into larger batches.
+    :return: number of messages transformed
+    """
+    msgs = [msg for topic in topics for msg in topic.get('conversation', [])]
+    with ThreadPoolExecutor(max_workers=max(threads, 1)) as pool:
+        count = sum(pool.map(lambda msg: transform_message(msg, transforms), msgs))
+    log.info(f'Transformed {count} of {len(msgs)} seed messages in {len(topics)} topics')
+    return count
+
+
+# each worker process loads its own copy of the transforms
+_worker_transforms: Optional[Transforms] = None
+
+def _init_worker(task_dir: Path, chain: List):
+    global _worker_transforms
+    if (task_dir / '__init__.py').exists() and task_dir.name not in sys.modules:
+        # task dir may have custom transforms; forked workers have it imported already
+        load_dir_as_module(task_dir)
+    R._register_all()
+    _worker_transforms = load_transforms(chain)
+
+
+def _work(args):
+    topics, threads = args
+    pretransform_topics(topics, _worker_transforms, threads=threads)
+    return topics
+
+
+def pretransform_file(task_dir: Path, config: TaskConfig, topics_file: Path, out_file: Path, chain_name='human',
+                      procs=1, threads=C.DEF_PRETRANSFORM_THREADS, chunk_size=C.DEF_PRETRANSFORM_CHUNK):
+    chain = config['chatbot'].get('transforms', {}).get(chain_name)
+    if not chain:
+        raise Exception(f'transforms.{chain_name} is not configured in {config._path}; nothing to do')
+    with open(topics_file, encoding='utf-8') as inp:
+        topics = json.load(inp)
+    assert isinstance(topics, list)
+    log.info(f'found {len(topics)} topics in {topics_file}; transforming with {procs=} {threads=}')
+
+    if procs <= 1:
+        _init_worker(task_dir, chain)
+        pretransform_topics(topics, _worker_transforms, threads=threads)
+        _worker_transforms.close()
+    else:
+        chunks = [topics[i: i + chunk_size] for i in range(0, len(topics), chunk_size)]
+        with mp.Pool(processes=procs, initializer=_init_worker, initargs=(task_dir, chain)) as pool:
+            chunks = pool.map(_work, [(chunk, threads) for chunk in chunks])
+        topics = [topic for chunk in chunks for topic in chunk]
+
+    if out_file.resolve() == topics_file.resolve():
+        bak_file = topics_file.with_name(topics_file.name + '.bak')
+        log.info(f'Backing up {topics_file} -> {bak_file}')
+        shutil.copy(topics_file, bak_file)
+    log.info(f'Writing {out_file}')
+    with open(out_file, 'w', encoding='utf-8') as out:
+        json.dump(topics, out, ensure_ascii=False, indent=2)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        prog='boteval-pretransform',
+        description='Pre-transform seed conversations in topics file using the transforms configured for task',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('task_dir', type=Path, metavar='DIR',
+                        help='Path to task dir. See "example-chat-task"')
+    parser.add_argument('-c', '--config', type=Path, metavar='FILE',
+                        help='Path to config file. Default is <task-dir>/conf.yml')
+    parser.add_argument('-o', '--out', type=Path, metavar='FILE',
+                        help='Output file. Default is to update the topics file in place (a .bak copy is kept)')
+    parser.add_argument('--chain', choices=['human', 'bot'], default='human',
+                        help='Which transforms chain to apply on seed messages')
+    parser.add_argument('-j', '--procs', type=int, default=1,
+                        help='Number of processes. Each process loads its own copy of models')
+    parser.add_argument('-t', '--threads', type=int, default=C.DEF_PRETRANSFORM_THREADS,
+                        help='Number of concurrent messages per process; these are batched by transforms')
+    parser.add_argument('--chunk', type=int, default=C.DEF_PRETRANSFORM_CHUNK,
+                        help='Number of topics per work unit when --procs > 1')
+    return vars(parser.parse_args())
+
+
+def main(**args):
+    args = args or parse_args()
+    task_dir: Path = args['task_dir']
+    config_file: Path = args.get('config') or (task_dir / 'conf.yml')
+    assert config_file.exists() and config_file.is_file(), f'Expected config YAML file at {config_file}, but it is not found'
+    config = TaskConfig.load(config_file)
+    topics_file = task_dir / config['chatbot'].get('topics_file', C.DEF_TOPICS_FILE)
+    assert topics_file.exists(), f'{topics_file} not found'
+    pretransform_file(task_dir=task_dir, config=config, topics_file=topics_file,
+                      out_file=args.get('out') or topics_file, chain_name=args.get('chain', 'human'),
+                      procs=args.get('procs', 1), threads=args.get('threads', C.DEF_PRETRANSFORM_THREADS),
+                      chunk_size=args.get('chunk', C.DEF_PRETRANSFORM_CHUNK))
+
+
+if '__main__' == __name__:
+    main()
@@ -10,6 +10,7 @@ from typing import Any
 
 BOT = 'bot'
 TRANSFORM = 'transform'
+BROKER = 'broker'
 
 
 global registry
@@ -17,13 +18,14 @@ global registry
 registry = {
     BOT: dict(),
     TRANSFORM: dict(),
+    BROKER: dict(),
 }
 
 
 def register(kind, name):
     """
     A decorator for registering modules; must be used on classes
-    :param kind: what kind of component :py:const:BOT, :py:const:TRANSFORM
+    :param kind: what kind of component :py:const:BOT, :py:const:TRANSFORM, :py:const:BROKER
     :param name: name for this component
     :return:
     """
@@ -45,6 +47,7 @@ def _register_all():
     modules = [
         'boteval.bots',
         'boteval.transforms',
+        'boteval.events',
     ]
     for name in modules:
         import_module(name)
@@ -0,0 +1,100 @@
+"""
+Lightweight, idempotent schema upgrades for existing databases.
+`db.create_all()` creates missing tables, but it does not touch tables that already exist;
+ so, on databases created by older versions, new indexes and columns declared in model.py are missing.
+`upgrade_schema()` compares the declared schema with the database and adds what is missing.
+It only adds (never drops or alters), so it is safe to run at every startup.
+"""
+
+from typing import List
+
+from sqlalchemy import func, inspect
+from sqlalchemy.schema import CreateColumn
+
+from . import db, log
+
+
+def _add_missing_columns(conn, table, existing: set) -> List[str]:
+    added = []
+    for col in table.columns:
+        if col.name in existing:
+            continue
+        if not col.nullable and col.server_default is None:
+            # existing rows need a value; this requires a proper migration
+            log.error(f'Cannot add column {table.name}.{col.name}: it is NOT NULL and has no server_default')
+            continue
+        col_ddl = CreateColumn(col).compile(dialect=conn.dialect)
+        log.info(f'Adding column {table.name}.{col.name}')
+        conn.exec_driver_sql(f'ALTER TABLE {conn.dialect.identifier_preparer.format_table(table)} ADD COLUMN {col_ddl}')
+        added.append(f'{table.name}.{col.name}')
+    return added
+
+
+def _add_missing_indexes(conn, table, existing: set) -> List[str]:
+    added = []
+    for index in table.indexes:
+        if index.name in existing:
+            continue
+        log.info(f'Creating index {index.name} on {table.name}')
+        index.create(bind=conn, checkfirst=True)
+        added.append(index.name)
+    return added
+
+
+def _recount_messages():
+    from .model import ChatThread
+    ChatThread.recount_messages()
+
+
+# column -> function that fills in values for existing rows, after that column is added
+BACKFILLS = {
+    'thread.message_count': _recount_messages,
+    'thread.last_message_id': _recount_messages,
+    'user_thread.turn_count': _recount_messages,
+}
+
+
+def _fill_time_updated(conn, table) -> int:
+    # rows inserted before time_updated had an insert default; listings are paged by it, so it cant be NULL.
+    # only for the tables that are paged i.e. indexed by time_updated; the index also makes this cheap to rerun
+    if 'time_created' not in table.c or \
+            not any(list(idx.columns)[0].name == 'time_updated' for idx in table.indexes):
+        return 0
+    res = conn.execute(table.update().where(table.c.time_updated.is_(None))
+                       .values(time_updated=func.coalesce(table.c.time_created, func.now())))
+    if res.rowcount:
+        log.info(f'Filled time_updated of {res.rowcount} rows in {table.name}')
+    return res.rowcount
+
+
+def upgrade_schema(engine=None) -> List[str]:
+    """
+    Adds missing columns and indexes to existing tables.
+    Call this after db.create_all(); i.e., tables are expected to exist.
+    :return: list of added columns and indexes
+    """
+    engine = engine or db.engine
+    changes = []
+    with engine.begin() as conn:
+        inspector = inspect(conn)
+        tables = set(inspector.get_table_names())
+        for table in db.metadata.sorted_tables:
+            if table.name not in tables:
+                log.warning(f'Table {table.name} does not exist; was db.create_all() called?')
+                continue
+            cols = {col['name'] for col in inspector.get_columns(table.name)}
+            changes += _add_missing_columns(conn, table, cols)
+            indexes = {idx['name'] for idx in inspector.get_indexes(table.name)}
+            changes += _add_missing_indexes(conn, table, indexes)
+            _fill_time_updated(conn, table)
+    backfills = list(dict.fromkeys(BACKFILLS[change] for change in changes if change in BACKFILLS))
+    for backfill in backfills:
+        log.info(f'Backfilling: {backfill.__name__}')
+        backfill()
+    if backfills:
+        db.session.commit()
+    if changes:
+        log.info(f'Schema upgraded: {changes}')
+    else:
+        log.info('Schema is up to date')
+    return changes
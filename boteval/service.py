@@ -1,34 +1,46 @@
 import os
 from pathlib import Path
 import json
-from typing import List, Mapping, Optional, Tuple, Union
+from typing import Dict, List, Mapping, Optional, Tuple, Union
 import functools
 from datetime import datetime
 import copy
 import time
 import re
+import threading
+from concurrent.futures import Future
 
 import flask
 import requests
-from sqlalchemy import func
+from sqlalchemy import func, orm, sql
+from cachetools import TTLCache
 
 
 from  . import log, db, C, TaskConfig
 from .model import ChatTopic, User, ChatMessage, ChatThread, UserThread, SuperTopic
-from .bots import BotAgent, load_bot_agent
+from .bots import BotAgent, BotAgentPool, load_bot_agent
 from .transforms import load_transforms, Transforms
+from .pretransform import pretransform_topics
 from .mturk import MTurkService
+from .jobs import JobRunner
+from .events import EventBroker, load_broker
 
 
 class ChatManager:
 
-    def __init__(self, thread_id) -> None:
+    def __init__(self, thread_id, broker: Optional[EventBroker]=None) -> None:
         self.thread_id = thread_id
         # Note: dont save/cache thread object here as it will go out of sync with ORM, only save ID
+        self.broker = broker
 
     def new_message(self, message):
         raise NotImplementedError()
 
+    def publish(self, event: str, data: dict):
+        # push event to clients listening on this thread
+        if self.broker:
+            self.broker.publish(ChatThread.socket_name_of(self.thread_id), event, data)
+
 
 class DialogBotChatManager(ChatManager):
 
@@ -37,8 +49,9 @@ class DialogBotChatManager(ChatManager):
     def __init__(self, thread: ChatThread, bot_agent:BotAgent,
                  max_turns:int=C.DEF_MAX_TURNS_PER_THREAD,
                  human_transforms: Optional[Transforms]=None,
-                 bot_transforms: Optional[Transforms]=None):
-        super().__init__(thread.id)
+                 bot_transforms: Optional[Transforms]=None,
+                 broker: Optional[EventBroker]=None):
+        super().__init__(thread.id, broker=broker)
         log.info(f'Initializing a dialog manager for thread {thread.id}')
         # Note: dont save/cache thread object here as it will go out of sync with ORM, only save ID
         bots = [ user for user in thread.users if user.role == User.ROLE_BOT ]
@@ -46,24 +59,43 @@ class DialogBotChatManager(ChatManager):
         assert len(bots) == 1, f'Expect 1 bot in thread {thread.id}; found {len(bots)}; Users: {user_ids}'
         self.bot_user_id = bots[0].id
         assert bot_agent
-        self.bot_agent: BotAgent = bot_agent
+        # the loaded agent (see ChatService.get_bot_agent); this dialog's session is valid only while it is loaded
+        self.parent_agent: BotAgent = bot_agent
+        self.bot_agent: BotAgent = bot_agent.new_session()
 
         humans = [ user for user in thread.users if user.role == User.ROLE_HUMAN ]
         # assert len(humans) == 1, f'Expect 1 human in thread {thread.id}; found {len(humans)}; Users: {user_ids}'
 
         self.max_turns = max_turns * thread.max_human_users_per_thread
         self.num_turns = 0
-        for human in humans:
-            self.num_turns += thread.count_turns(human)
+        # id of the last message that bot agent has seen; used to check if this manager is in sync with thread
+        self.last_msg_id = None
+        # serializes context replays; see ChatService.get_dialog_man
+        self.lock = threading.Lock()
 
         self.bot_transforms = bot_transforms
         self.human_transforms = human_transforms
                 
-        topic = ChatTopic.query.get(thread.topic_id)
-        self.init_chat_context(thread)
+        self.sync(thread)
         self.n_human_users = thread.max_human_users_per_thread
-        
 
+    def sync(self, thread: ChatThread):
+        """Reloads turn count and replays the thread's messages into bot agent"""
+        self.num_turns = thread.count_human_turns()
+        self.init_chat_context(thread)
+
+    def is_in_sync(self, thread: ChatThread) -> bool:
+        # messages could have been added by another server process
+        return self.last_msg_id == thread.last_message_id
+
+    @staticmethod
+    def add_message(thread: ChatThread, message: ChatMessage):
+        # message and thread counters are saved in the same transaction
+        db.session.add(message)
+        thread.messages.append(message)
+        db.session.flush()
+        thread.count_message(message)
+        db.session.commit()
 
     def init_chat_context(self, thread: ChatThread):
         if not thread.messages:
@@ -73,6 +105,7 @@ class DialogBotChatManager(ChatManager):
         topic_appeared = False 
         messages = [msg.as_dict() for msg in thread.messages]
         self.bot_agent.init_chat_context(messages)
+        self.last_msg_id = max(msg['id'] for msg in messages)
 
     def bot_init_reply(self, thread):
         # Last one was targeted speaker; bot reply here
@@ -83,9 +116,9 @@ class DialogBotChatManager(ChatManager):
         else: 
             reply: ChatMessage = self.bot_reply(n_users=self.n_human_users)
             if reply.text.strip():  # if bot responded
-                db.session.add(reply)
-                thread.messages.append(reply)
-                db.session.commit()
+                self.add_message(thread, reply)
+                self.publish('message', reply.as_dict())
+                self.bot_hear_own_reply(reply)
             # We should not increment num_turns here, as the bot reply shouldn't be counted.
             # self.num_turns += 1
             log.info(f'{self.thread_id} turns:{self.num_turns} max:{self.max_turns}')
@@ -105,14 +138,14 @@ class DialogBotChatManager(ChatManager):
         assert thread.id == self.thread_id
 
         # add new message
-        db.session.add(message)
-        thread.messages.append(message)
-        db.session.commit()
+        self.add_message(thread, message)
+        self.publish('message', message.as_dict())
 
         if self.human_transforms:
             message = self.human_transforms(message)
 
         self.bot_agent.hear(message.as_dict())
+        self.last_msg_id = message.id
 
         if not thread.need_moderator_bot:
             log.info("Do not need moderator bot in this chat")
@@ -120,16 +153,23 @@ class DialogBotChatManager(ChatManager):
         else: 
             reply = self.bot_reply(n_users = self.n_human_users)
             if reply.text.strip(): # if bot responded 
-                db.session.add(reply)
-                thread.messages.append(reply)
-                db.session.commit()
-
-        self.num_turns += 1
+                self.add_message(thread, reply)
+                self.publish('message', reply.as_dict())
+                self.bot_hear_own_reply(reply)
 
-        humans = [user for user in thread.users if user.role == User.ROLE_HUMAN]
+        # humans of multi-user threads may be served by different processes; so read the shared counter
+        self.num_turns = thread.count_human_turns()
         episode_done = self.num_turns >= self.max_turns
+        if episode_done:
+            self.publish('episode', dict(episode_done=episode_done))
         return reply, episode_done
         
+    def bot_hear_own_reply(self, reply: ChatMessage):
+        # Bot's context is not replayed on each request anymore (see ChatService.get_dialog_man);
+        # so we feed the stored reply back, just as the replay would have done
+        self.bot_agent.hear(reply.as_dict())
+        self.last_msg_id = reply.id
+
     def bot_reply(self, n_users:int=None) -> ChatMessage:
         reply: dict = self.bot_agent.talk(n_users=n_users)
         if not reply: #bot decided to not respond 
@@ -137,8 +177,9 @@ class DialogBotChatManager(ChatManager):
         else: 
             reply_text = reply['text']            
                 
+        speaker_id = (reply or {}).get('data', {}).get('speaker_id')
         reply = ChatMessage(user_id = self.bot_user_id, text=reply_text, is_seed=False,
-                            thread_id = self.thread_id, data={"speaker_id": reply['data']['speaker_id']})
+                            thread_id = self.thread_id, data={"speaker_id": speaker_id})
         if self.bot_transforms:
             reply = self.bot_transforms(reply)
         return reply
@@ -191,6 +232,13 @@ class ChatService:
         self._simple_instructions = None
         self._human_mod_instructions = None
 
+        # pushes chat events to browsers; see events.py
+        push_conf = self.config.get('push') or {}
+        self.broker: EventBroker = load_broker(push_conf.get('name', 'local'), push_conf.get('args'))
+        # each open event stream holds a server thread; so browsers open them only if the broker reaches all processes,
+        #  or if enabled explicitly (e.g. async workers); otherwise they just poll
+        self.push_streams = bool(push_conf.get('streams', self.broker.is_shared))
+
         transforms_conf = self.config['chatbot'].get('transforms', {})
 
         self.human_transforms = None
@@ -201,13 +249,14 @@ class ChatService:
             self.bot_transforms = load_transforms(transforms_conf['bot'])
         
         self.exporter = FileExportService(self.resolve_path(config.get('chat_dir'), 'data'))
-        bot_name = config['chatbot']['bot_name']
-        # bot_args are no longer used as we always load all possible bots and chose the one we need at launching.
+        self.bot_name = config['chatbot']['bot_name']
         bot_args = config['chatbot'].get('bot_args') or {}
 
         # get engine names
         self.endpoints = config['chatbot']['bot_args']['engines']
         log.info('endpoints: ', self.endpoints)
+        # the rest of bot_args are given to every bot agent, along with endpoint and persona_id
+        self.bot_args = {key: val for key, val in bot_args.items() if key != 'engines'}
 
         # Starting to load all ids from persona_configs.json
         persona_filepath = Path(task_dir) / persona_configs_relative_filepath
@@ -216,16 +265,12 @@ class ChatService:
             persona_jsons = json.load(f)
             self.persona_id_list = [x['id'] for x in persona_jsons]
 
-        # Initialize all possible bots
-        self.bot_agent_dict = {}
-        for cur_endpoint_name in self.endpoints:
-            for cur_persona_id in self.persona_id_list:
-                tmp_dict = {
-                    # 'engine': cur_engine_name,
-                    'default_endpoint': cur_endpoint_name,
-                    'persona_id': cur_persona_id
-                }
-                self.bot_agent_dict[(cur_endpoint_name, cur_persona_id)] = load_bot_agent(bot_name, tmp_dict)
+        # Bot agents for (endpoint, persona_id) are loaded when a thread first needs them, and unloaded when idle
+        max_agents = config['chatbot'].get('max_resident_agents', C.DEF_MAX_RESIDENT_AGENTS)
+        agent_idle_time = config['chatbot'].get('agent_idle_time', C.DEF_AGENT_IDLE_TIME)
+        self._bot_agents = BotAgentPool(maxsize=max_agents, ttl=agent_idle_time)
+        self._bot_agents_lock = threading.Lock()
+        self._bot_agent_loads: Dict[Tuple[str, str], Future] = {}  # agents being loaded
 
         # self.persona_id = bot_args.get('persona_id')
         # self.bot_agent = load_bot_agent(bot_name, bot_args)
@@ -237,10 +282,24 @@ class ChatService:
             self.onboarding['agreement_text'] = self.resolve_path(self.onboarding['agreement_file']).read_text(encoding='UTF-8')
 
 
+        # dialog managers, and their bot sessions, are reused across requests; key: thread_id
+        self._dialog_cache = TTLCache(maxsize=C.DIALOG_CACHE_SIZE, ttl=C.DIALOG_CACHE_TTL)
+        self._dialog_lock = threading.Lock()
+        self._dialog_builds: Dict[int, Future] = {}  # managers being built; key: thread_id
+        # aggregates shown on admin dashboard
+        self._dashboard_cache = TTLCache(maxsize=4, ttl=C.DASHBOARD_CACHE_TTL)
+        self._dashboard_lock = threading.Lock()
+
         self.crowd_service = None
         if C.MTURK in self.config:
             self.crowd_service = MTurkService.new(**self.config[C.MTURK])
         self._external_url_ok = None
+        # bulk crowd operations run in background; see jobs.py
+        jobs_conf = self.config.get('jobs') or {}
+        self.jobs = JobRunner(max_workers=jobs_conf.get('max_workers', C.DEF_JOB_WORKERS))
+        self.jobs.register(C.JOB_LAUNCH, self._launch_job_item)
+        if self.crowd_service:
+            self.jobs.register(C.JOB_PAYOUT, self.crowd_service.payout.pay)
         
     def resolve_path(self, *args):
         return Path(self.task_dir, *args)
@@ -264,6 +323,45 @@ class ChatService:
             log.warning('Looks like external URL is not configured as HTTPs. Crowd launching is disabled')
             self._external_url_ok = False
        
+    def get_bot_agent(self, endpoint, persona_id) -> BotAgent:
+        """Gets bot agent for (endpoint, persona_id); loads it if not already loaded"""
+        key = (endpoint, persona_id)
+        # loading is slow, so it happens outside of the lock; concurrent callers of the same key wait for its future
+        with self._bot_agents_lock:
+            agent = self._bot_agents.get(key)
+            if agent is not None:
+                self._bot_agents[key] = agent  # also marks it as recently used
+                return agent
+            loading = self._bot_agent_loads.get(key)
+            is_loader = loading is None
+            if is_loader:
+                loading = self._bot_agent_loads[key] = Future()
+        if not is_loader:
+            return loading.result()
+
+        try:
+            log.info(f'Loading bot agent {self.bot_name} for {key}')
+            args = self.bot_args | dict(default_endpoint=endpoint, persona_id=persona_id)
+            agent = load_bot_agent(self.bot_name, args)
+        except BaseException as e:
+            with self._bot_agents_lock:
+                del self._bot_agent_loads[key]
+            loading.set_exception(e)
+            raise
+        with self._bot_agents_lock:
+            del self._bot_agent_loads[key]
+            self._bot_agents[key] = agent  # may unload the least recently used agent
+        loading.set_result(agent)
+        self._drop_unloaded_dialogs()
+        return agent
+
+    @property
+    def resident_bot_agents(self) -> List[Tuple[str, str, BotAgent]]:
+        """Bot agents that are currently loaded, as (endpoint, persona_id, agent)"""
+        with self._bot_agents_lock:
+            self._bot_agents.expire()
+            return [(endpoint, persona_id, agent) for (endpoint, persona_id), agent in self._bot_agents.items()]
+
     @property
     def is_external_url_ok(self):
         return self._external_url_ok
@@ -351,12 +449,26 @@ class ChatService:
                     continue
                 obj = SuperTopic(id=topic['id'], name=topic['name'], data=topic, next_task_id=1)
                 objs.append(obj)
+            if objs and (chain_name := self.config['chatbot'].get('pretransform_seeds')):
+                self.pretransform_seeds([obj.data for obj in objs], chain_name=chain_name)
             if objs:
                 log.info(f"Inserting {len(objs)} topics to db")
                 db.session.add_all(objs)
             # self.init_sub_topics()
         db.session.commit()
 
+    def pretransform_seeds(self, topics: List[Dict], chain_name='human'):
+        """
+        Transforms seed conversations of new topics once at import, so that creating threads does not call models.
+        For large topic files, prefer the offline tool `boteval-pretransform` (which is multi-process).
+        """
+        transforms = dict(human=self.human_transforms, bot=self.bot_transforms)[chain_name]
+        if not transforms:
+            log.warning(f'pretransform_seeds={chain_name} but transforms.{chain_name} is not configured; skipping')
+            return
+        log.info(f'Pre-transforming seed conversations of {len(topics)} topics with {chain_name} transforms')
+        pretransform_topics(topics, transforms)
+
     # def init_sub_topics(self):
     #     """
     #     A helper function to create a topic for all super_topics when booting.
@@ -385,26 +497,56 @@ class ChatService:
                                          human_moderator=human_moderator, reward=reward)
         db.session.add(new_topic)
         db.session.commit()
+        self.clear_dashboard_cache()
+
+    def get_topic_seats(self, topic: ChatTopic, user: Optional[User]=None,
+                        as_moderator=False) -> Tuple[int, Optional[int], Optional[int]]:
+        """
+        Summarizes threads of a topic in one aggregate query over user_thread and user tables.
+        :param as_moderator: user is a human moderator; threads that already have a moderator are not open to them
+        :return: (number of threads of topic,
+                  id of thread that user is already part of, or None,
+                  id of the first thread that has a free seat for a human, or None)
+        """
+        is_member = (User.id == user.id) if user else sql.false()
+        per_thread = db.session.query(
+            ChatThread.id.label('id'),
+            func.max(sql.case((is_member, 1), else_=0)).label('is_member'),
+            func.sum(sql.case((User.role.in_([User.ROLE_HUMAN, User.ROLE_HUMAN_MODERATOR]), 1), else_=0)).label('seats'),
+            func.sum(sql.case((User.role == User.ROLE_HUMAN_MODERATOR, 1), else_=0)).label('moderators'))\
+            .outerjoin(UserThread, UserThread.c.thread_id == ChatThread.id)\
+            .outerjoin(User, User.id == UserThread.c.user_id)\
+            .filter(ChatThread.topic_id == topic.id)\
+            .group_by(ChatThread.id).subquery()
+        is_open = per_thread.c.seats < topic.max_human_users_per_thread
+        if as_moderator:
+            is_open = sql.and_(is_open, per_thread.c.moderators == 0)
+        thread_count, user_thread_id, open_thread_id = db.session.query(
+            func.count(per_thread.c.id),
+            func.min(sql.case((per_thread.c.is_member == 1, per_thread.c.id))),
+            func.min(sql.case((is_open, per_thread.c.id)))).one()
+        return thread_count, user_thread_id, open_thread_id
 
     def limit_check(self, topic: ChatTopic=None, user: User=None) -> Tuple[bool, str]:
         # total_threads = db.session.query(func.count(ChatThread.id)).scalar()
         # Check if the user reached the max_threads_per_user.
         if user and self.limits.get(C.LIMIT_MAX_THREADS_PER_USER, 0) > 0:
-            user_thread_count = ChatThread.query.join(User, ChatThread.users).filter(User.id==user.id).count()
+            user_thread_count = db.session.query(func.count(UserThread.c.thread_id))\
+                .filter(UserThread.c.user_id == user.id).scalar()
             if user_thread_count >= self.limits[C.LIMIT_MAX_THREADS_PER_USER]:
                 return True, 'User has exceeded maximum permissible threads'
+        if not topic:
+            return False, ''
+        as_moderator = bool(user) and topic.human_moderator == 'yes' and user.role == User.ROLE_HUMAN_MODERATOR
+        topic_thread_count, user_thread_id, open_thread_id = self.get_topic_seats(topic, user, as_moderator=as_moderator)
         # Firstly, we check if the current user is trying to re-enter a chatroom
         # In this case, even if we have reached the max_threads_per_topic limit, we should still let the user
         # re-enter the chatroom and check their history.
-        if User is not None:
-            topic_threads = ChatThread.query.filter_by(topic_id=topic.id).all()
-            for tt in topic_threads:
-                if any(user.id == tu.id for tu in tt.users):
-                    return False, ''
+        if user_thread_id is not None:
+            return False, ''
         # If the user is not trying to re-enter a chatroom,
         # we check if the topic has reached the max_threads_per_topic limit
-        if topic and topic.max_threads_per_topic:
-            topic_thread_count = ChatThread.query.filter(ChatThread.topic_id==topic.id).count()
+        if topic.max_threads_per_topic:
             # If the user is trying to enter a single-user chatroom,
             # we just need to check if the topic has reached the max_threads_per_topic
             if topic.max_human_users_per_thread == 1:
@@ -416,15 +558,7 @@ class ChatService:
                 # (Because there might be a thread with less than max_human_users_per_thread number of users)
                 if topic_thread_count > topic.max_threads_per_topic:
                     return True, 'This topic has exceeded maximum permissible threads'
-                elif topic_thread_count == topic.max_threads_per_topic:
-                    # Check if there is a thread with less than max_human_users_per_thread
-                    # If so, allow the user to enter the thread
-                    threads_under_this_topic = ChatThread.query.filter(ChatThread.topic_id == topic.id).all()
-                    for thr in threads_under_this_topic:
-                        humans = [user for user in thr.users if user.role == User.ROLE_HUMAN]
-                        human_moderators = [user for user in thr.users if user.role == User.ROLE_HUMAN_MODERATOR]
-                        if len(humans) + len(human_moderators) < topic.max_human_users_per_thread:
-                            return False, ''
+                elif topic_thread_count == topic.max_threads_per_topic and open_thread_id is None:
                     return True, 'This topic has exceeded maximum permissible threads'
         return False, ''
 
@@ -432,7 +566,10 @@ class ChatService:
         return ChatTopic.query.all()
 
     def get_user_threads(self, user):
-        return ChatThread.query.join(User, ChatThread.users).filter(User.id==user.id).all()
+        # only the columns needed for listing
+        return ChatThread.query.join(User, ChatThread.users).filter(User.id==user.id)\
+            .options(orm.load_only(ChatThread.id, ChatThread.topic_id, ChatThread.episode_done,
+                                   ChatThread.time_created)).all()
 
     def get_topic(self, topic_id):
         return ChatTopic.query.get(topic_id)
@@ -453,7 +590,7 @@ class ChatService:
 
         if topic.human_moderator == 'yes' and data is not None and data.get(ext_src) is not None:
             cur_user_is_qualified = self.crowd_service.is_worker_qualified(user_worker_id=user.id,
-                                                                           qual_name='human_moderator_qualification')
+                                                                           qual_name=C.HUMAN_MOD_QUALIFICATION)
 
             if cur_user_is_qualified:
                 log.info(f"Assign human moderator role to worker_id: {user.id}")
@@ -461,79 +598,97 @@ class ChatService:
             else:
                 log.info(f"Not Assign human moderator role to worker_id: {user.id}")
 
-        topic_threads = ChatThread.query.filter_by(topic_id=topic.id).all()
-        # TODO: appply this second filter directly into sqlalchemy
+        try:
+            return self._reserve_seat(user, topic, create_if_missing=create_if_missing,
+                                      ext_id=ext_id, ext_src=ext_src, data=data)
+        except Exception:
+            db.session.rollback()  # release topic lock
+            raise
+
+    def lock_topic(self, topic: ChatTopic):
+        """
+        Write-locks topic row until the current transaction ends (commit or rollback).
+        Concurrent joiners of the same topic wait here, one at a time, so they see each others' seats.
+        Row-level lock on postgres/mysql; on sqlite, it is the database write lock (other writers wait upto busy timeout).
+        """
+        # time_updated is kept as is; topic listings are ordered and paged by it
+        db.session.execute(sql.update(ChatTopic).where(ChatTopic.id == topic.id)
+                           .values(join_count=func.coalesce(ChatTopic.join_count, 0) + 1,
+                                   time_updated=ChatTopic.time_updated)
+                           .execution_options(synchronize_session=False))
+
+    def _reserve_seat(self, user, topic: ChatTopic, create_if_missing=True,
+                      ext_id=None, ext_src=None, data=None) -> Optional[ChatThread]:
+        as_moderator = topic.human_moderator == 'yes' and user.role == User.ROLE_HUMAN_MODERATOR
+        # users re-entering their thread (e.g. page reloads) are the common case; that needs no lock
+        thread_count, user_thread_id, open_thread_id = self.get_topic_seats(topic, user, as_moderator=as_moderator)
+        if user_thread_id is None and (open_thread_id is not None or create_if_missing):
+            # a seat is to be reserved; every path below ends the transaction, releasing the lock
+            self.lock_topic(topic)
+            thread_count, user_thread_id, open_thread_id = self.get_topic_seats(topic, user, as_moderator=as_moderator)
+            if user_thread_id is not None:
+                db.session.rollback()  # joined by a concurrent request of the same user; nothing to reserve
         thread = None
-        for tt in topic_threads:
-            if any(user.id == tu.id for tu in tt.users):
-                log.info('Topic thread already exists; reusing it')
-                thread = tt
-                break
-
-            # if tt.human_user_2 is None or tt.human_user_2 == '':
-            human_moderators = [user for user in tt.users if user.role == User.ROLE_HUMAN_MODERATOR]
-            humans = [user for user in tt.users if user.role == User.ROLE_HUMAN]
-
-            # if tt.need_moderator_bot and user.role == User.ROLE_HUMAN_MODERATOR:
-                # print("Current chat thread does not need a human moderator, topic id: ", topic.id, ' user.role:', user.role)
-                # continue
-
-            if topic.human_moderator == 'yes' and len(human_moderators) > 0 and user.role == User.ROLE_HUMAN_MODERATOR:
-                log.info("More than one human moderator not allowed, topic id: ", topic.id)
-                continue
-
-            if len(humans) + len(human_moderators) < topic.max_human_users_per_thread:
-                # Mark the thread as "is being created".
-                # This is to prevent other users from joining the thread at the same time.
-                if tt.thread_state == 1:
-                    log.error("thread is being created")
-                    return None
-
-                log.info('human_user_2 join thread!')
-
-                # store speakers id
-                chat_topic = ChatTopic.query.get(tt.topic_id)
-                loaded_users = [speaker_id for speaker_id in chat_topic.data['conversation']]
-                speakers = [cur_user.get('speaker_id') for cur_user in loaded_users]
-
-                if topic.human_moderator == 'yes' and user.role == User.ROLE_HUMAN_MODERATOR:
-                    # tt.need_moderator_bot = False
-                    tt.speakers[user.id] = 'Moderator'
-                elif topic.human_moderator == 'yes' and len(human_moderators) == 1:
-                    tt.speakers[user.id] = speakers[-1]
-                else:
-                    i = -2
-                    while len(speakers) + i >= 0:
-                        if speakers[i] != speakers[-1]:
-                            # user.name = speakers[i]
-                            tt.speakers[user.id] = speakers[i]
-                            # tt.user_2nd = user.id
-                            # tt.speaker_2nd = speakers[i]
-                            break
-                        else:
-                            i -= 1
-
-                tt.assignment_id_dict[user.id] = ext_id
-                if tt.data.get(ext_src) is not None:
-                    tt.submit_url_dict[user.id] = tt.data.get(ext_src).get('submit_url')
-
-                # user.name = speakers[-2]
-                log.info(f'2nd user is: {user.id}, 2nd speaker is: {tt.speakers[user.id]}')
-
-                tt.users.append(user)
-                # tt.users.append(self.bot_user)
-                # tt.users.append(self.context_user)
-                # tt.human_user_2 = user.id
-
-                tt.flag_speakers_modified()
-                tt.flag_assignment_id_dict_modified()
-                tt.flag_submit_url_dict_modified()
-                db.session.merge(tt)
-                db.session.flush()
-                db.session.commit()
-
-                thread = tt
-                break
+        if user_thread_id is not None:
+            log.info('Topic thread already exists; reusing it')
+            thread = ChatThread.query.get(user_thread_id)
+        elif open_thread_id is not None:
+            tt = ChatThread.query.get(open_thread_id)
+            human_moderators = [u for u in tt.users if u.role == User.ROLE_HUMAN_MODERATOR]
+            log.info('human_user_2 join thread!')
+
+            # store speakers id
+            chat_topic = ChatTopic.query.get(tt.topic_id)
+            loaded_users = [speaker_id for speaker_id in chat_topic.data['conversation']]
+            speakers = [cur_user.get('speaker_id') for cur_user in loaded_users]
+
+            if topic.human_moderator == 'yes' and user.role == User.ROLE_HUMAN_MODERATOR:
+                # tt.need_moderator_bot = False
+                tt.speakers[user.id] = 'Moderator'
+            elif topic.human_moderator == 'yes' and len(human_moderators) == 1:
+                tt.speakers[user.id] = speakers[-1]
+            else:
+                i = -2
+                while len(speakers) + i >= 0:
+                    if speakers[i] != speakers[-1]:
+                        # user.name = speakers[i]
+                        tt.speakers[user.id] = speakers[i]
+                        # tt.user_2nd = user.id
+                        # tt.speaker_2nd = speakers[i]
+                        break
+                    else:
+                        i -= 1
+
+            tt.assignment_id_dict[user.id] = ext_id
+            if tt.data.get(ext_src) is not None:
+                tt.submit_url_dict[user.id] = tt.data.get(ext_src).get('submit_url')
+
+            # user.name = speakers[-2]
+            log.info(f'2nd user is: {user.id}, 2nd speaker is: {tt.speakers[user.id]}')
+
+            tt.users.append(user)
+            # tt.users.append(self.bot_user)
+            # tt.users.append(self.context_user)
+            # tt.human_user_2 = user.id
+
+            tt.flag_speakers_modified()
+            tt.bump_data_version()  # users changed
+            tt.flag_assignment_id_dict_modified()
+            tt.flag_submit_url_dict_modified()
+            db.session.merge(tt)
+            db.session.flush()
+            db.session.commit()
+            self.broker.publish(tt.socket_name, 'speakers',
+                                dict(speakers=tt.speakers, speakers_version=tt.speakers_version))
+
+            thread = tt
+
+        if not thread and create_if_missing and topic.max_threads_per_topic \
+                and thread_count >= topic.max_threads_per_topic:
+            # limit_check passed, but concurrent joiners took the last seats meanwhile
+            log.warning(f'No seats left in topic {topic.id} for user {user.id}')
+            db.session.rollback()
+            return None
 
         if not thread and create_if_missing:
             log.info(f'creating a thread: user: {user.id} topic: {topic.id}')
@@ -580,8 +735,6 @@ class ChatService:
             if data.get(ext_src):
                 thread.submit_url_dict[user.id] = data.get(ext_src).get('submit_url')
 
-            thread.thread_state = 1
-            log.info("Set thread state to 1")
             log.info(f'1st user is: {user.id}, 1st speaker is: {thread.speakers[user.id]}')
 
             thread.users.append(user)
@@ -592,30 +745,76 @@ class ChatService:
 
             db.session.add(thread)
             db.session.flush()  # flush it to get thread_id
-            for m in topic.data['conversation']:
-                # assumption: messages are pre-transformed to reduce wait times
-                text = m['text']
-                data = dict(text_orig=m.get('text_orig'),
-                            speaker_id=m.get('speaker_id'),
-                            fake_start=True)
-                msg = ChatMessage(text=text, user_id=self.context_user.id, thread_id=thread.id, is_seed=True, data=data)
-                db.session.add(msg)
-                thread.messages.append(msg)
-            thread.thread_state = 2
-            
-            # if moderator: 
-            if topic.human_moderator == 'yes':
-                log.info("Set thread state to 2")
-                
+            self.insert_seed_messages(thread.id, topic.data['conversation'])
             db.session.merge(thread)
             db.session.flush()
-            db.session.commit()
+        db.session.commit()
         return thread
 
-    def get_thread(self, thread_id) -> Optional[ChatThread]:
-        result = ChatThread.query.get(thread_id)
-        result.messages = sorted(result.messages, key=lambda x: x.id)
-        return result
+    def insert_seed_messages(self, thread_id, conversation: List[Dict]):
+        """
+        Copies seed conversation of topic to thread, as one bulk insert.
+        Skips ORM object construction; thread.messages will have these once thread is reloaded (e.g. after commit).
+        """
+        # assumption: messages are pre-transformed to reduce wait times; see boteval-pretransform
+        rows = [dict(text=m['text'], user_id=self._context_user_id, thread_id=thread_id, is_seed=True,
+                     data=dict(text_orig=m.get('text_orig'), speaker_id=m.get('speaker_id'), fake_start=True))
+                for m in conversation]
+        if rows:
+            db.session.execute(ChatMessage.__table__.insert(), rows)
+            ChatThread.recount_messages([thread_id])
+
+    def get_thread(self, thread_id, messages=True) -> Optional[ChatThread]:
+        """
+        Gets thread along with its users, and its messages (in id order) if `messages` is True.
+        Each relation is one extra query, regardless of how many messages or users it has.
+        """
+        options = [orm.selectinload(ChatThread.users)]
+        if messages:
+            options.append(orm.selectinload(ChatThread.messages))
+        return ChatThread.query.options(*options).get(thread_id)
+
+    def get_latest_message(self, thread_id) -> Optional[ChatMessage]:
+        return ChatMessage.query.filter(ChatMessage.thread_id == thread_id)\
+            .order_by(ChatMessage.id.desc()).first()
+
+    def get_messages_since(self, thread_id, after_id=0) -> List[ChatMessage]:
+        """
+        Messages of a thread whose id is greater than `after_id`, in id order.
+        This is a range scan on (thread_id, id) index, so the cost is proportional to number of new messages.
+        """
+        return ChatMessage.query.filter(ChatMessage.thread_id == thread_id, ChatMessage.id > after_id)\
+            .order_by(ChatMessage.id).all()
+
+    def get_thread_version(self, thread_id) -> Optional[str]:
+        """
+        Change token of thread (see ChatThread.version); None if thread doesnt exist.
+        A primary key lookup of a few columns; no ORM objects are loaded.
+        """
+        row = db.session.query(ChatThread.last_message_id, ChatThread.speakers, ChatThread.episode_done,
+                               ChatThread.data_version).filter(ChatThread.id == thread_id).first()
+        return row and ChatThread.version_of(*row)
+
+    def get_thread_updates(self, thread_id, after_id=0, speakers_version=None) -> Optional[dict]:
+        """
+        Incremental view of a thread for pollers: messages after `after_id` and speakers (only if changed).
+        Returns None if the thread doesnt exist.
+        """
+        # only the needed columns; loading ChatThread object would drag in all its messages
+        row = db.session.query(ChatThread.speakers, ChatThread.episode_done, ChatThread.last_message_id)\
+            .filter(ChatThread.id == thread_id).first()
+        if row is None:
+            return None
+        messages = []
+        if row.last_message_id is not None and row.last_message_id > (after_id or 0):
+            messages = self.get_messages_since(thread_id, after_id=after_id)
+        cur_version = ChatThread.speakers_version_of(row.speakers)
+        updates = dict(messages=[m.as_dict() for m in messages],
+                       speakers_version=cur_version,
+                       episode_done=row.episode_done)
+        if speakers_version != cur_version:
+            updates['speakers'] = row.speakers
+        return updates
 
     def get_threads(self, user: User) -> List[ChatThread]:
         log.info(f'Querying {user.id}')
@@ -625,11 +824,12 @@ class ChatService:
         return threads
 
     def get_thread_counts(self, episode_done=True) -> Mapping[str, int]:
-        thread_counts = ChatThread.query.filter_by(episode_done=bool(episode_done))\
-            .with_entities(ChatThread.topic_id, func.count(ChatThread.topic_id))\
+        # inner join skips threads whose topic has been deleted
+        thread_counts = db.session.query(ChatThread.topic_id, func.count(ChatThread.id))\
+            .join(ChatTopic, ChatTopic.id == ChatThread.topic_id)\
+            .filter(ChatThread.episode_done == bool(episode_done))\
             .group_by(ChatThread.topic_id).all()
-
-        return {tid: count for tid, count in thread_counts if ChatTopic.query.get(tid)}
+        return dict(thread_counts)
 
     def get_thread_counts_of_super_topic(self, episode_done=True) -> Mapping[str, int]:
         """
@@ -637,15 +837,28 @@ class ChatService:
         @param episode_done: whether you want to consider the completed or uncompleted threads
         @return: a dict containing the thread count of each super topic.
         """
-        tmp_res = self.get_thread_counts(episode_done)
-        all_topics = ChatTopic.query.all()
-        topic_thread_counts = [(topic, tmp_res.get(topic.id, 0)) for topic in all_topics]
-        super_topic_thread_counts_dict = {}
-        for topic, count in topic_thread_counts:
-            cur_super_topic = SuperTopic.query.get(topic.super_topic_id)
-            super_topic_thread_counts_dict[cur_super_topic.id] = \
-                super_topic_thread_counts_dict.get(cur_super_topic.id, 0) + count
-        return super_topic_thread_counts_dict
+        thread_counts = db.session.query(ChatTopic.super_topic_id, func.count(ChatThread.id))\
+            .join(ChatTopic, ChatTopic.id == ChatThread.topic_id)\
+            .filter(ChatThread.episode_done == bool(episode_done), ChatTopic.super_topic_id.isnot(None))\
+            .group_by(ChatTopic.super_topic_id).all()
+        return dict(thread_counts)
+
+    def get_dashboard_counts(self) -> Tuple[Mapping[str, int], Mapping[str, int]]:
+        """
+        Completed thread counts for admin dashboard: (topic_id -> count, super_topic_id -> count).
+        Cached for a few seconds (C.DASHBOARD_CACHE_TTL), so reloading the dashboard doesnt re-aggregate all threads.
+        """
+        with self._dashboard_lock:
+            counts = self._dashboard_cache.get('completed')
+            if counts is None:
+                counts = (self.get_thread_counts(episode_done=True),
+                          self.get_thread_counts_of_super_topic(episode_done=True))
+                self._dashboard_cache['completed'] = counts
+            return counts
+
+    def clear_dashboard_cache(self):
+        with self._dashboard_lock:
+            self._dashboard_cache.clear()
 
     def update_thread_ratings(self, thread: ChatThread, ratings: dict, user_id: str):
         if thread.data is None:
@@ -661,9 +874,12 @@ class ChatService:
             thread.episode_done = True
 
         thread.flag_data_modified()
+        thread.bump_data_version()
         db.session.merge(thread)
         db.session.flush()
         db.session.commit()
+        if thread.episode_done:
+            self.broker.publish(thread.socket_name, 'episode', dict(episode_done=True))
         if len(thread.data.get('ratings')) == thread.max_human_users_per_thread:
             self.exporter.export_thread(thread, rating_questions=self.ratings, engine=thread.engine,
                                         persona_id=thread.persona_id,
@@ -671,14 +887,64 @@ class ChatService:
                                         max_turns_per_thread=thread.max_turns_per_thread,
                                         human_moderator=thread.human_moderator, reward=thread.reward)
 
-    # @functools.lru_cache(maxsize=256)
     def get_dialog_man(self, thread: ChatThread) -> DialogBotChatManager:
-        cur_bot_agent = self.bot_agent_dict[(thread.engine, thread.persona_id)]
-        return DialogBotChatManager(thread=thread,
-                                    bot_agent=cur_bot_agent,
-                                    max_turns=thread.max_turns_per_thread,
-                                    bot_transforms=self.bot_transforms,
-                                    human_transforms=self.human_transforms)
+        """
+        Gets dialog manager for thread. Each thread gets its own bot session (see BotAgent.new_session) which
+        shares the model/client of bot agent for (endpoint, persona). Managers are cached, so bot context is
+        replayed only when the cached manager is out of sync with thread, or when its bot agent was unloaded.
+        """
+        # always fetch the agent, even for cached managers, so agents of active threads are not evicted as idle
+        bot_agent = self.get_bot_agent(thread.engine, thread.persona_id)
+        # the global lock only guards the cache; managers are built and synced outside of it (these replay
+        #  context into the bot), so threads dont wait on each other. A manager being built is kept as a future
+        with self._dialog_lock:
+            dialog = self._dialog_cache.get(thread.id)
+            if dialog is not None and dialog.parent_agent is not bot_agent:
+                # its session shares the batcher and model of an unloaded agent; they are closed once it is gone
+                log.info(f'Bot agent of thread {thread.id} was unloaded; starting a new session')
+                del self._dialog_cache[thread.id]
+                dialog = None
+            if dialog is not None:
+                self._dialog_cache[thread.id] = dialog  # refreshes TTL
+            else:
+                building = self._dialog_builds.get(thread.id)
+                is_builder = building is None
+                if is_builder:
+                    building = self._dialog_builds[thread.id] = Future()
+
+        if dialog is None and not is_builder:
+            dialog = building.result()
+        elif dialog is None:
+            try:
+                dialog = DialogBotChatManager(thread=thread,
+                                              bot_agent=bot_agent,
+                                              max_turns=thread.max_turns_per_thread,
+                                              bot_transforms=self.bot_transforms,
+                                              human_transforms=self.human_transforms,
+                                              broker=self.broker)
+            except BaseException as e:
+                with self._dialog_lock:
+                    del self._dialog_builds[thread.id]
+                building.set_exception(e)
+                raise
+            with self._dialog_lock:
+                del self._dialog_builds[thread.id]
+                self._dialog_cache[thread.id] = dialog
+            building.set_result(dialog)
+
+        with dialog.lock:
+            if not dialog.is_in_sync(thread):
+                log.info(f'Dialog manager of thread {thread.id} is out of sync; re-initializing')
+                dialog.sync(thread)
+        return dialog
+
+    def _drop_unloaded_dialogs(self):
+        """Drops cached dialog managers whose bot agent was unloaded, so their sessions dont keep its model in memory"""
+        with self._dialog_lock:
+            for thread_id, dialog in list(self._dialog_cache.items()):
+                if dialog.parent_agent.unloaded:
+                    log.info(f'Dropping dialog manager of thread {thread_id}; its bot agent was unloaded')
+                    self._dialog_cache.pop(thread_id, None)
 
     def new_message(self, msg: ChatMessage, thread: ChatThread) -> tuple[ChatMessage, bool]:
         dialog = self.get_dialog_man(thread)
@@ -702,38 +968,80 @@ class ChatService:
             log.warning(msg)
             flask.flash(msg)
             return None
-        if self.crowd_name in (C.MTURK, C.MTURK_SANDBOX):                
-            landing_url = flask.url_for('app.mturk_landing', topic_id=topic.id,
-                                        _external=True, _scheme='https')
-            log.info(f'mturk landing URL {landing_url}')
-            
-            ext_id, task_url, result = self.crowd_service.create_HIT(landing_url, 
-                max_assignments=topic.max_threads_per_topic,
-                reward=topic.reward,
-            )
-            
-            ext_src = self.crowd_service.name
-            if ext_id:
-                topic.ext_id = ext_id
-                topic.ext_src = ext_src
-                topic.data[ext_src] = dict(
-                    is_sandbox = self.crowd_service.is_sandbox,
-                    time_created = datetime.now().isoformat(),
-                    hit_id = ext_id,
-                    ext_url = task_url
-                    )
-                topic.flag_data_modified()
-                db.session.merge(topic)
-                db.session.commit()
-            return ext_id
+        if self.crowd_name in (C.MTURK, C.MTURK_SANDBOX):
+            return self.create_crowd_task(topic, landing_url=self.crowd_landing_url(topic.id))
         else:
             log.error(f'Crowd name {self.crowd_name} not supported yet')
             return
 
+    def crowd_landing_url(self, topic_id: str) -> str:
+        # needs request context (or SERVER_NAME)
+        landing_url = flask.url_for('app.mturk_landing', topic_id=topic_id, _external=True, _scheme='https')
+        log.info(f'mturk landing URL {landing_url}')
+        return landing_url
+
+    def create_crowd_task(self, topic: ChatTopic, landing_url: str, unique_token: Optional[str] = None):
+        """
+        Creates task (e.g. HIT) for topic on crowd service and saves its id in topic.
+        :param unique_token: makes this safe to retry; a task already created with this token is reused
+        :return: id of task on crowd service
+        """
+        kwargs = dict(UniqueRequestToken=unique_token) if unique_token else {}
+        ext_id, task_url, result = self.crowd_service.create_HIT(landing_url,
+            max_assignments=topic.max_threads_per_topic,
+            reward=topic.reward,
+            **kwargs
+        )
+
+        ext_src = self.crowd_service.name
+        if ext_id:
+            topic.ext_id = ext_id
+            topic.ext_src = ext_src
+            topic.data[ext_src] = dict(
+                is_sandbox = self.crowd_service.is_sandbox,
+                time_created = datetime.now().isoformat(),
+                hit_id = ext_id,
+                ext_url = task_url
+                )
+            topic.flag_data_modified()
+            db.session.merge(topic)
+            db.session.commit()
+        return ext_id
+
+    def launch_topics_on_crowd(self, topic_ids: List[str]):
+        """
+        Launches many topics in background.
+        :return: the job, whose progress is shown on admin page; None if crowd service is not ready
+        """
+        if not self.crowd_service or self.crowd_name not in (C.MTURK, C.MTURK_SANDBOX):
+            log.warning('Crowd service not configured')
+            return None
+        if not self.is_external_url_ok:
+            msg = 'External URL is not configured correctly. Skipping.'
+            log.warning(msg)
+            flask.flash(msg)
+            return None
+        # landing URLs are made now, while we have request context; job threads dont
+        item_data = {topic_id: dict(landing_url=self.crowd_landing_url(topic_id)) for topic_id in topic_ids}
+        job = self.jobs.create(C.JOB_LAUNCH, keys=topic_ids, ext_src=self.crowd_name, item_data=item_data)
+        self.jobs.start(flask.current_app._get_current_object(), job.id)
+        return job
+
+    def _launch_job_item(self, item, params: Dict) -> Dict:
+        topic = ChatTopic.query.get(item.key)
+        if not topic:
+            raise ValueError(f'Topic {item.key} not found')
+        if topic.ext_id:  # launched already, e.g. job was resumed after restart
+            return dict(ext_id=topic.ext_id, skipped=True)
+        ext_id = self.create_crowd_task(topic, landing_url=item.data['landing_url'],
+                                        unique_token=f'boteval-launch-{topic.id}')
+        return dict(ext_id=ext_id)
+
     # @staticmethod
     def delete_topic(self, topic: ChatTopic):
         db.session.delete(topic)
         db.session.commit()
+        self.clear_dashboard_cache()
 
     def generate_limits(self, topic: ChatTopic):
         limit_dict = {
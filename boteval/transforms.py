@@ -1,7 +1,15 @@
 
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from cachetools import LRUCache
+
 from boteval.model import ChatMessage
-from boteval import registry as R, log
-from typing import List
+from boteval import registry as R, log, C
+from boteval.hub import hub
+from boteval.batching import MicroBatcher
 
 
 class BaseTransform:
@@ -12,6 +20,10 @@ class BaseTransform:
     def transform(self, msg: ChatMessage):
         return msg
 
+    def close(self):
+        # release resources e.g. models
+        pass
+
 class Transforms:
 
     def __init__(self, transforms) -> None:
@@ -23,6 +35,10 @@ class Transforms:
             x = transform(x)
         return x
 
+    def close(self):
+        for transform in self.transforms:
+            transform.close()
+
 
 def load_transform(name, args=None) -> BaseTransform:
     transforms = R.registry[R.TRANSFORM]
@@ -74,20 +90,76 @@ class SpacySplitter():
         return cls._instance 
 
 
+class SqliteTranslationStore:
+    """On-disk tier of translation cache; a sqlite table of (model, source) -> target"""
+
+    def __init__(self, path) -> None:
+        log.info(f'Translation cache at {path}')
+        self.conn = sqlite3.connect(str(path), check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS translation (model TEXT NOT NULL, source TEXT NOT NULL,'
+                              ' target TEXT NOT NULL, PRIMARY KEY (model, source))')
+
+    def get_many(self, model: str, sources: List[str]) -> Dict[str, str]:
+        if not sources:
+            return {}
+        marks = ','.join('?' * len(sources))
+        with self.lock:
+            rows = self.conn.execute(f'SELECT source, target FROM translation WHERE model = ? AND source IN ({marks})',
+                                     [model, *sources]).fetchall()
+        return dict(rows)
+
+    def put_many(self, model: str, pairs: List[Tuple[str, str]]):
+        with self.lock, self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO translation (model, source, target) VALUES (?, ?, ?)',
+                                  [(model, src, tgt) for src, tgt in pairs])
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
 @R.register(kind=R.TRANSFORM, name='huggingface-mt')
 class HuggingfaceMT(BaseTransform):
+    """
+    Machine translation using huggingface seq2seq model.
+    Translations are cached per sentence: in memory (LRU of `cache_size` sentences), and optionally on disk
+     at `cache_file` (sqlite) which survives restarts and can be shared by server processes.
+    Sentences that are not in cache are translated in batches along with sentences of concurrent messages;
+     see `batching` (dict with max_batch_size and max_wait_ms).
+    """
     
-    
-    def __init__(self, model_name: str, max_length=256) -> None:
+    def __init__(self, model_name: str, max_length=256, dtype=None,
+                 cache_size=C.DEF_TRANSLATION_CACHE_SIZE, cache_file: Optional[str]=None, batching=None) -> None:
         super().__init__()
-        from transformers import AutoTokenizer, AutoModelForSeq2SeqLM 
         self.model_name = model_name
+        self.dtype = dtype
         log.info(f' Loading Huggingface MT model {model_name}')
-        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
-        self.model = AutoModelForSeq2SeqLM.from_pretrained(model_name)
+        # weights are shared with other transforms and bots using the same model
+        self.tokenizer, self.model = hub.acquire(model_name, dtype=dtype)
+        self._released = False
         self.sentence_splitter = SpacySplitter.get_instance()
         self.max_length = max_length or 256
 
+        # key: (model_name, sentence); value: translation
+        self.cache = LRUCache(maxsize=cache_size)
+        self.cache_lock = threading.Lock()
+        self.store = cache_file and SqliteTranslationStore(Path(cache_file))
+        batching = batching or {}
+        self.batcher = MicroBatcher(self._translate_batch,
+            max_batch_size=batching.get('max_batch_size', C.DEF_MT_BATCH_SIZE),
+            max_wait=batching.get('max_wait_ms', C.DEF_BATCH_WAIT * 1000) / 1000,
+            name=f'batcher:{model_name}')
+
+    def close(self):
+        if not self._released:
+            self._released = True
+            self.batcher.close()
+            if self.store:
+                self.store.close()
+            hub.release(self.model_name, dtype=self.dtype)
+
     def transform(self, msg: ChatMessage):
         text = msg.text
         msg.data['text_orig'] = text
@@ -97,10 +169,51 @@ class HuggingfaceMT(BaseTransform):
     def translate(self, text: str) -> str:
         log.debug(f"Translating {text}...")
         sents: List[str] = self.sentence_splitter(text)
+        translations = self.lookup_cache(sents)
+        misses = [sent for sent in dict.fromkeys(sents) if sent not in translations]
+        if misses:
+            # each sentence may go in a different batch, along with sentences from concurrent messages
+            futures = [self.batcher.submit(sent) for sent in misses]
+            new_translations = {sent: fut.result() for sent, fut in zip(misses, futures)}
+            self.update_cache(new_translations)
+            translations.update(new_translations)
+        outputs = [translations[sent] for sent in sents]
+        return ' '.join(outputs)
+
+    def _translate_batch(self, sents: List[str]) -> List[str]:
+        # concurrent messages may share sentences; translate each only once
+        uniq_sents = list(dict.fromkeys(sents))
+        translations = dict(zip(uniq_sents, self.translate_sents(uniq_sents)))
+        return [translations[sent] for sent in sents]
+
+    def translate_sents(self, sents: List[str]) -> List[str]:
         batch = self.tokenizer(sents, return_tensors="pt", padding=True,
          max_length=self.max_length)
         gen = self.model.generate(**batch)
         outputs = self.tokenizer.batch_decode(
             gen, skip_special_tokens=True)
-        return ' '.join(outputs)
+        return outputs
+
+    def lookup_cache(self, sents: List[str]) -> Dict[str, str]:
+        found = {}
+        with self.cache_lock:
+            for sent in sents:
+                if (tgt := self.cache.get((self.model_name, sent))) is not None:
+                    found[sent] = tgt
+        misses = [sent for sent in sents if sent not in found]
+        if self.store and misses:
+            from_disk = self.store.get_many(self.model_name, misses)
+            if from_disk:
+                with self.cache_lock:
+                    for sent, tgt in from_disk.items():
+                        self.cache[(self.model_name, sent)] = tgt
+                found.update(from_disk)
+        return found
+
+    def update_cache(self, translations: Dict[str, str]):
+        with self.cache_lock:
+            for sent, tgt in translations.items():
+                self.cache[(self.model_name, sent)] = tgt
+        if self.store:
+            self.store.put_many(self.model_name, list(translations.items()))
 
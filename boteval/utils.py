@@ -2,10 +2,13 @@
 from typing import Tuple
 import sys
 import time
+import importlib
+from pathlib import Path
 from datetime import datetime
 
 import flask
 import flask_login as FL
+from sqlalchemy import sql
 
 from . import log, C
 
@@ -18,6 +21,18 @@ def render_template(*args, **kwargs):
         cur_user=FL.current_user, C=C, **kwargs)
 
 
+def stream_template(name, **kwargs):
+    """
+    Like render_template, but sends the page as it is rendered; for pages that iterate over generators
+     e.g. paginated API calls, so that neither server holds nor browser waits for the whole result
+    """
+    app = flask.current_app
+    context = dict(environ=C.ENV, cur_user=FL.current_user, C=C, **kwargs)
+    app.update_template_context(context)
+    template = app.jinja_env.get_template(name)
+    return flask.Response(flask.stream_with_context(template.generate(context)))
+
+
 # def max_RSS(who=resource.RUSAGE_SELF) -> Tuple[int, str]:
 #     """Gets memory usage of current process, maximum so far.
 #     Maximum so far, since the system call API doesnt provide "current"
@@ -36,6 +51,41 @@ def render_template(*args, **kwargs):
 #     return mem, f'{int(h_mem)}{unit}'
 
 
+def load_dir_as_module(dir_path: Path):
+    log.info(f'Going to import {dir_path} as a python module.')
+    module_name = dir_path.name
+    parent_dir = dir_path.resolve().parent
+
+    log.info(f'adding "{parent_dir}" to PYTHONPATH and importing "{module_name}"')
+    assert module_name not in sys.modules, f'{module_name} collide with existing module. please rename dir to something else'
+    sys.path.append(str(parent_dir))
+
+    _module = importlib.import_module(module_name)
+    log.info(f'import success! {_module=}')
+
+
+def keyset_page(query, model, after_id=None, page_size=C.ADMIN_PAGE_SIZE, id_of=lambda item: item.id):
+    """
+    Gets a page of query results, most recently updated first, using keyset pagination on (time_updated, id).
+    Unlike offset, the cost of a page doesnt grow with its depth.
+    :param model: model class having time_updated and id columns
+    :param after_id: id of the last item of previous page; None for the first page
+    :param id_of: function to get id from an item of query (for queries that return tuples)
+    :return: (items, after_id for next page or None if this is the last page)
+    """
+    if after_id:
+        # compare against the stored value itself, rather than a timestamp round-tripped through URL
+        last_time = sql.select(model.time_updated).where(model.id == after_id).scalar_subquery()
+        query = query.filter(sql.or_(model.time_updated < last_time,
+                                     sql.and_(model.time_updated == last_time, model.id < after_id)))
+    items = query.order_by(model.time_updated.desc(), model.id.desc()).limit(page_size + 1).all()
+    next_after_id = None
+    if len(items) > page_size:
+        items = items[:page_size]
+        next_after_id = id_of(items[-1])
+    return items, next_after_id
+
+
 def format_bytes(bytes):
     if bytes >= 10**6:
         return f'{bytes/10**6:.2f} MB'
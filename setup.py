@@ -49,6 +49,7 @@ setup(name=PACKAGE,
           "console_scripts": [
               "boteval=boteval.app:main",
               "boteval-quickstart=boteval.quickstart:main",
+              "boteval-pretransform=boteval.pretransform:main",
               ]
           },
       classifiers=[
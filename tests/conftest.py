@@ -0,0 +1,164 @@
+import datetime
+import json
+import sys
+from types import SimpleNamespace
+
+import flask
+import pytest
+
+from boteval import db, registry as R, C
+from boteval.bots import BotAgent
+
+@R.register(R.BOT, 'echo-bot')
+class EchoBot(BotAgent):
+
+    def __init__(self, **kwargs) -> None:
+        super().__init__(name='echo-bot')
+
+    def init_chat_context(self, messages):
+        self.last_msg = messages[-1] if messages else None
+
+    def talk(self, n_users=None):
+        text = (self.last_msg or {}).get('text', '')
+        return dict(text=f'echo: {text}', data=dict(speaker_id='Moderator'))
+
+
+TOPICS = [
+    dict(id='chat01', name='Sample conversation', target_user='B',
+         conversation=[dict(speaker_id='A', text='Did you see the news?'),
+                       dict(speaker_id='B', text='Yes, what about it?'),
+                       dict(speaker_id='A', text='It is all over the place.')]),
+]
+
+CONF = """
+chat_dir: data
+chatbot:
+  display_name: Moderator
+  topics_file: chat_topics.json
+  bot_name: echo-bot
+  bot_args:
+    engines: [e1]
+limits:
+  max_threads_per_user: 10
+  max_threads_per_topic: 10
+  max_turns_per_thread: 4
+onboarding:
+  instructions_file: instructions.html
+ratings:
+  - question: 'How was it?'
+    choices: [good, bad]
+flask_config:
+  DATABASE_FILE_NAME: boteval.db
+  SQLALCHEMY_TRACK_MODIFICATIONS: false
+"""
+
+
+@pytest.fixture(scope='session')
+def boteval_app(tmp_path_factory):
+    """The boteval app on a task dir with one super topic and a sqlite database file"""
+    task_dir = tmp_path_factory.mktemp('task')
+    (task_dir / 'conf.yml').write_text(CONF)
+    (task_dir / 'chat_topics.json').write_text(json.dumps(TOPICS))
+    (task_dir / 'persona_configs.json').write_text(json.dumps([dict(id='p1')]))
+    (task_dir / 'instructions.html').write_text('<p>Instructions</p>')
+    argv = sys.argv
+    sys.argv = ['boteval', str(task_dir), '-b', '']  # app is initialized from args when imported
+    try:
+        from boteval.app import app
+    finally:
+        sys.argv = argv
+    app.config['TESTING'] = True
+    return app
+
+
+@pytest.fixture(scope='session')
+def service(boteval_app):
+    return boteval_app.extensions['boteval']
+
+
+@pytest.fixture
+def app():
+    """Bare flask app with an empty in-memory database, for tests of models and services"""
+    app = flask.Flask(__name__)
+    app.config.update(SQLALCHEMY_DATABASE_URI='sqlite://', SQLALCHEMY_TRACK_MODIFICATIONS=False)
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+
+class FakeMTurk:
+    """
+    In-memory stand-in for boto3 mturk client, in the spirit of moto: state is kept in plain dicts,
+     list_* calls are paged with MaxResults/NextToken, and calls are recorded in `calls`.
+    """
+
+    def __init__(self) -> None:
+        self.meta = SimpleNamespace(endpoint_url=C.MTURK_SANDBOX_URL)
+        self.hits = {}  # id -> HIT
+        self.assignments = {}  # hit id -> list of assignments
+        self.qual_types = {}  # id -> qualification type
+        self.qual_workers = {}  # qual id -> list of qualifications
+        self.bonuses = []
+        self.bonus_tokens = set()
+        self.calls = []
+
+    def add_hit(self, hit_id, status='Assignable', n_completed=0, **kwargs):
+        self.hits[hit_id] = dict(HITId=hit_id, Title=f'Title {hit_id}', HITStatus=status, MaxAssignments=2,
+                                 NumberOfAssignmentsPending=0, NumberOfAssignmentsAvailable=2 - n_completed,
+                                 NumberOfAssignmentsCompleted=n_completed,
+                                 CreationTime=datetime.datetime(2020, 1, 1, tzinfo=datetime.timezone.utc), **kwargs)
+        self.assignments.setdefault(hit_id, [])
+
+    def add_assignment(self, hit_id, asgn_id, worker_id, status='Submitted'):
+        self.assignments[hit_id].append(dict(AssignmentId=asgn_id, HITId=hit_id, WorkerId=worker_id,
+                                             AssignmentStatus=status))
+
+    @staticmethod
+    def _page(items, key, MaxResults=C.AWS_MAX_RESULTS, NextToken=None):
+        start = int(NextToken or 0)
+        page = dict(NumResults=len(items[start:start + MaxResults]), **{key: items[start:start + MaxResults]})
+        if start + MaxResults < len(items):
+            page['NextToken'] = str(start + MaxResults)
+        return page
+
+    def list_hits(self, **kwargs):
+        self.calls.append(('list_hits', None))
+        return self._page(list(self.hits.values()), 'HITs', **kwargs)
+
+    def get_hit(self, HITId):
+        self.calls.append(('get_hit', HITId))
+        return dict(HIT=self.hits[HITId])
+
+    def list_assignments_for_hit(self, HITId, AssignmentStatuses=None, **kwargs):
+        self.calls.append(('list_assignments_for_hit', HITId))
+        items = [a for a in self.assignments.get(HITId, [])
+                 if not AssignmentStatuses or a['AssignmentStatus'] in AssignmentStatuses]
+        return self._page(items, 'Assignments', **kwargs)
+
+    def list_qualification_types(self, MustBeRequestable=True, MustBeOwnedByCaller=True, **kwargs):
+        self.calls.append(('list_qualification_types', None))
+        return self._page(list(self.qual_types.values()), 'QualificationTypes', **kwargs)
+
+    def list_workers_with_qualification_type(self, QualificationTypeId, Status=None, **kwargs):
+        self.calls.append(('list_workers_with_qualification_type', QualificationTypeId))
+        items = [q for q in self.qual_workers.get(QualificationTypeId, []) if not Status or q['Status'] == Status]
+        return self._page(items, 'Qualifications', **kwargs)
+
+    def send_bonus(self, WorkerId, BonusAmount, AssignmentId, Reason, UniqueRequestToken=None):
+        self.calls.append(('send_bonus', AssignmentId))
+        if UniqueRequestToken and UniqueRequestToken in self.bonus_tokens:
+            return {}  # repeated request; not paid again
+        self.bonus_tokens.add(UniqueRequestToken)
+        self.bonuses.append(dict(WorkerId=WorkerId, BonusAmount=BonusAmount, AssignmentId=AssignmentId))
+        return {}
+
+    def calls_of(self, method):
+        return [arg for name, arg in self.calls if name == method]
+
+
+@pytest.fixture
+def fake_mturk():
+    return FakeMTurk()
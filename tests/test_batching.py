@@ -0,0 +1,46 @@
+import threading
+
+import pytest
+
+from boteval.batching import MicroBatcher
+
+
+def test_concurrent_items_are_batched():
+    batch_sizes = []
+
+    def process(items):
+        batch_sizes.append(len(items))
+        return [item * 2 for item in items]
+
+    batcher = MicroBatcher(process, max_batch_size=4, max_wait=0.2)
+    results = {}
+    threads = [threading.Thread(target=lambda i=i: results.update({i: batcher(i)})) for i in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    batcher.close()
+    assert results == {i: i * 2 for i in range(8)}
+    assert max(batch_sizes) <= 4 and sum(batch_sizes) == 8
+    stats = batcher.stats()
+    assert stats['requests'] == 8 and stats['batches'] == len(batch_sizes) and stats['errors'] == 0
+
+
+def test_errors_are_raised_to_callers():
+    def process(items):
+        raise ValueError('bad batch')
+
+    batcher = MicroBatcher(process, max_wait=0)
+    with pytest.raises(ValueError):
+        batcher('x', timeout=5)
+    batcher.close()
+    assert batcher.stats()['errors'] == 1
+
+
+def test_submit_after_close_raises():
+    batcher = MicroBatcher(lambda items: items, max_wait=0)
+    pending = batcher.submit('before')
+    batcher.close()
+    assert pending.result(timeout=5) == 'before'  # submitted before close, so still processed
+    with pytest.raises(RuntimeError):
+        batcher.submit('after')
@@ -0,0 +1,40 @@
+import gc
+
+from boteval.bots import BotAgent, BotAgentPool
+
+
+class ClosingBot(BotAgent):
+
+    def __init__(self, **kwargs) -> None:
+        super().__init__(name='closing-bot')
+        self.num_closes = 0
+
+    def close(self):
+        self.num_closes += 1
+
+
+def test_unloaded_agent_is_closed_after_its_last_session():
+    agent = ClosingBot()
+    session1, session2 = agent.new_session(), agent.new_session()
+    agent.unload()
+    assert agent.unloaded and agent.num_closes == 0  # sessions may be serving requests
+    del session1
+    gc.collect()
+    assert agent.num_closes == 0
+    del session2
+    gc.collect()
+    assert agent.num_closes == 1
+
+
+def test_pool_eviction_unloads_agents():
+    pool = BotAgentPool(maxsize=1, ttl=60)
+    idle, busy = ClosingBot(), ClosingBot()
+    pool['idle'] = idle
+    pool['busy'] = busy  # evicts idle, which has no sessions
+    assert idle.unloaded and idle.num_closes == 1
+    session = busy.new_session()
+    pool['other'] = ClosingBot()
+    assert busy.unloaded and busy.num_closes == 0
+    del session
+    gc.collect()
+    assert busy.num_closes == 1
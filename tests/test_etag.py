@@ -0,0 +1,36 @@
+from boteval.model import ChatTopic, SuperTopic, User
+
+
+def poll(client, thread_id, etag=None):
+    headers = {'If-None-Match': f'"{etag}"'} if etag else {}
+    reply = client.get(f'/thread/{thread_id}/get_thread_object', headers=headers)
+    return reply.status_code, reply.headers.get('ETag', '').strip('"')
+
+
+def test_thread_object_etag(boteval_app, service):
+    with boteval_app.app_context():
+        for user_id in ['etag-u1', 'etag-u2']:
+            if not User.query.get(user_id):
+                User.create_new(user_id, 'secret')
+        topic = ChatTopic.create_new(SuperTopic.query.first(), endpoint='e1', persona_id='p1',
+                                     max_threads_per_topic=1, max_turns_per_thread=4, max_human_users_per_thread=2,
+                                     human_moderator='no', reward='0')
+        topic_id = topic.id
+        thread_id = service.get_thread_for_topic(User.query.get('etag-u1'), topic).id
+    client = boteval_app.test_client()
+    client.post('/login', data=dict(user_id='etag-u1', secret='secret', action='login'))
+
+    status, etag = poll(client, thread_id)
+    assert status == 200 and etag
+    assert poll(client, thread_id, etag) == (304, etag)
+
+    with boteval_app.app_context():  # second user joins
+        service.get_thread_for_topic(User.query.get('etag-u2'), ChatTopic.query.get(topic_id))
+    status, joined_etag = poll(client, thread_id, etag)
+    assert status == 200 and joined_etag != etag
+
+    with boteval_app.app_context():  # the other user submits ratings; data changes, but not messages or speakers
+        service.update_thread_ratings(service.get_thread(thread_id), ratings={'q': 'a'}, user_id='etag-u2')
+    status, rated_etag = poll(client, thread_id, joined_etag)
+    assert status == 200 and rated_etag != joined_etag
+    assert poll(client, thread_id, rated_etag) == (304, rated_etag)
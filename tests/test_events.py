@@ -0,0 +1,83 @@
+import queue
+
+from boteval.events import LocalBroker, RedisBroker, format_sse
+
+
+class FakeRedis:
+    """In-process stand-in for redis client; only publish() and pubsub() are used by RedisBroker"""
+
+    def __init__(self) -> None:
+        self.pubsubs = []
+
+    def publish(self, channel, message):
+        for ps in self.pubsubs:
+            if channel in ps.channels:
+                ps.messages.put(dict(type='message', channel=channel, data=message))
+
+    def pubsub(self):
+        ps = FakePubSub(self)
+        self.pubsubs.append(ps)
+        return ps
+
+
+class FakePubSub:
+
+    def __init__(self, client) -> None:
+        self.client = client
+        self.channels = set()
+        self.messages = queue.Queue()
+
+    def subscribe(self, channel):
+        self.channels.add(channel)
+        self.messages.put(dict(type='subscribe', channel=channel, data=1))
+
+    def get_message(self, ignore_subscribe_messages=False, timeout=0.0):
+        try:
+            msg = self.messages.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        if ignore_subscribe_messages and msg['type'] == 'subscribe':
+            return None
+        return msg
+
+    def close(self):
+        self.client.pubsubs.remove(self)
+
+
+def test_format_sse():
+    assert format_sse('message', {'id': 3, 'text': 'héllo'}, id=3) == \
+        'id: 3\nevent: message\ndata: {"id": 3, "text": "héllo"}\n\n'
+    assert format_sse('episode', {'episode_done': True}) == 'event: episode\ndata: {"episode_done": true}\n\n'
+
+
+def test_local_broker():
+    broker = LocalBroker()
+    assert not broker.is_shared
+    with broker.subscribe('thread-1') as sub, broker.subscribe('thread-2') as other:
+        broker.publish('thread-1', 'message', {'id': 1})
+        assert sub.get(timeout=1) == ('message', {'id': 1})
+        assert other.get(timeout=0.01) is None
+    broker.publish('thread-1', 'message', {'id': 2})  # no subscribers left
+    assert not broker._subscribers
+
+
+def test_local_broker_drops_events_of_full_queue():
+    broker = LocalBroker(max_queue_size=1)
+    with broker.subscribe('thread-1') as sub:
+        broker.publish('thread-1', 'message', {'id': 1})
+        broker.publish('thread-1', 'message', {'id': 2})
+        assert sub.get(timeout=1) == ('message', {'id': 1})
+        assert sub.get(timeout=0.01) is None
+
+
+def test_redis_broker_with_local_stand_in():
+    client = FakeRedis()
+    broker = RedisBroker(client=client, prefix='test:')
+    assert broker.is_shared
+    with broker.subscribe('thread-1') as sub:
+        assert sub.get(timeout=0.01) is None  # subscribe confirmation is not an event
+        broker.publish('thread-1', 'speakers', {'speakers': ['a', 'b']})
+        broker.publish('thread-2', 'message', {'id': 9})
+        assert sub.get(timeout=1) == ('speakers', {'speakers': ['a', 'b']})
+        assert sub.get(timeout=0.01) is None
+    assert not client.pubsubs
@@ -0,0 +1,75 @@
+import threading
+import time
+
+from boteval.hub import ModelHub
+
+
+class SlowHub(ModelHub):
+
+    def __init__(self, fail=()) -> None:
+        super().__init__()
+        self.fail = set(fail)
+        self.num_loads = 0
+        self.release_slow = threading.Event()
+
+    def _load(self, model_name, dtype=None):
+        self.num_loads += 1
+        if model_name == 'slow':
+            self.release_slow.wait(timeout=5)
+        if model_name in self.fail:
+            raise OSError(f'cannot load {model_name}')
+        return f'{model_name}-tokenizer', f'{model_name}-model'
+
+
+def test_load_does_not_block_other_models():
+    hub = SlowHub()
+    slow = threading.Thread(target=hub.acquire, args=('slow',))
+    slow.start()
+    time.sleep(0.1)
+    assert hub.acquire('fast') == ('fast-tokenizer', 'fast-model')  # not blocked by 'slow'
+    assert hub.loaded_models == {('fast', None): 1}
+    hub.release_slow.set()
+    slow.join()
+    assert hub.loaded_models == {('fast', None): 1, ('slow', None): 1}
+
+
+def test_concurrent_acquires_load_once():
+    hub = SlowHub()
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(hub.acquire('slow'))) for _ in range(4)]
+    for t in threads:
+        t.start()
+    time.sleep(0.1)
+    hub.release_slow.set()
+    for t in threads:
+        t.join()
+    assert hub.num_loads == 1
+    assert results == [('slow-tokenizer', 'slow-model')] * 4
+    assert hub.loaded_models == {('slow', None): 4}
+    for _ in range(4):
+        hub.release('slow')
+    assert hub.loaded_models == {}
+
+
+def test_failed_load_is_not_cached():
+    hub = SlowHub(fail=['slow'])
+    errors = []
+
+    def acquire():
+        try:
+            hub.acquire('slow')
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=acquire) for _ in range(3)]
+    for t in threads:
+        t.start()
+    time.sleep(0.1)
+    hub.release_slow.set()
+    for t in threads:
+        t.join()
+    assert len(errors) == 3
+    assert hub.loaded_models == {}
+    hub.fail.clear()
+    assert hub.acquire('slow') == ('slow-tokenizer', 'slow-model')
+    assert hub.num_loads == 2
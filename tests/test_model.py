@@ -0,0 +1,25 @@
+from datetime import datetime
+
+from boteval import db
+from boteval.model import ChatMessage, ChatThread, ChatTopic, User
+
+
+def test_recount_messages_keeps_time_updated(app):
+    old_time = datetime(2020, 1, 1)
+    db.session.add(User(id='u1', name='u1', secret='x'))
+    db.session.add(ChatTopic(id='t1', name='t1', endpoint='e', persona_id='p', reward='0',
+                             max_threads_per_topic=1, max_turns_per_thread=1, max_human_users_per_thread=1))
+    db.session.add(ChatThread(id=1, topic_id='t1', thread_state=1))
+    db.session.flush()
+    db.session.add_all([ChatMessage(text=f'm{i}', user_id='u1', thread_id=1) for i in range(3)])
+    db.session.flush()
+    db.session.execute(ChatThread.__table__.update().values(time_updated=old_time, message_count=0))
+    db.session.commit()
+
+    ChatThread.recount_messages()
+    db.session.commit()
+
+    db.session.expire_all()
+    thread = ChatThread.query.get(1)
+    assert thread.message_count == 3
+    assert thread.time_updated == old_time
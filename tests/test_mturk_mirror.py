@@ -0,0 +1,91 @@
+import pytest
+
+from boteval import db
+from boteval.model import ChatThread, ChatTopic, MTurkAssignment, MTurkHIT, MTurkQualifiedWorker
+from boteval.mturk import MTurkService
+
+
+@pytest.fixture
+def mturk(app, fake_mturk):
+    return MTurkService(fake_mturk, sync_interval=0)
+
+
+def hits():
+    return {row.id: row for row in MTurkHIT.query.all()}
+
+
+def assignments():
+    return {row.id: row for row in MTurkAssignment.query.all()}
+
+
+def test_sync_hits_and_assignments(mturk, fake_mturk):
+    fake_mturk.add_hit('H1')
+    fake_mturk.add_hit('H2', n_completed=1)
+    fake_mturk.add_assignment('H2', 'A1', 'W1', status='Approved')
+    fake_mturk.add_hit('H3')
+    fake_mturk.add_assignment('H3', 'A2', 'W2', status='Submitted')
+    stats = mturk.mirror.sync()
+    assert stats['hits_new'] == 3 and stats['assignments'] == 2
+    assert set(hits()) == {'H1', 'H2', 'H3'}
+    assert {key: row.status for key, row in assignments().items()} == {'A1': 'Approved', 'A2': 'Submitted'}
+    assert sorted(fake_mturk.calls_of('list_assignments_for_hit')) == ['H1', 'H2', 'H3']  # new HITs
+
+    # unchanged HITs: assignments are fetched only for H3, as it has a submitted assignment
+    fake_mturk.calls.clear()
+    stats = mturk.mirror.sync()
+    assert stats['hits_new'] == stats['hits_changed'] == stats['hits_deleted'] == 0
+    assert fake_mturk.calls_of('list_assignments_for_hit') == ['H3']
+
+    # changed, and deleted HITs
+    fake_mturk.calls.clear()
+    fake_mturk.hits['H1']['HITStatus'] = 'Unassignable'
+    fake_mturk.hits['H1']['NumberOfAssignmentsPending'] = 1
+    fake_mturk.add_assignment('H1', 'A3', 'W3', status='Submitted')
+    fake_mturk.assignments['H3'][0]['AssignmentStatus'] = 'Approved'
+    del fake_mturk.hits['H2']
+    stats = mturk.mirror.sync()
+    assert stats['hits_changed'] == 1 and stats['hits_deleted'] == 1 and stats['assignments'] == 2
+    assert sorted(fake_mturk.calls_of('list_assignments_for_hit')) == ['H1', 'H3']
+    db.session.expire_all()
+    assert set(hits()) == {'H1', 'H3'} and hits()['H1'].status == 'Unassignable'
+    assert {key: row.status for key, row in assignments().items()} == {'A2': 'Approved', 'A3': 'Submitted'}
+
+    # nothing is waiting for approval now, except the new one on H1
+    fake_mturk.calls.clear()
+    mturk.mirror.sync()
+    assert fake_mturk.calls_of('list_assignments_for_hit') == ['H1']
+
+
+def test_hits_and_assignments_are_linked_to_topics_and_threads(mturk, fake_mturk):
+    db.session.add(ChatTopic(id='t1', name='t1', endpoint='e', persona_id='p', reward='0', ext_id='H1',
+                             max_threads_per_topic=1, max_turns_per_thread=1, max_human_users_per_thread=2))
+    db.session.add(ChatThread(id=7, topic_id='t1', assignment_id_dict={'W1': 'A1', 'W2': 'A2'}))
+    db.session.commit()
+    fake_mturk.add_hit('H1')
+    fake_mturk.add_assignment('H1', 'A1', 'W1')
+    fake_mturk.add_hit('H2')
+    fake_mturk.add_assignment('H2', 'A9', 'W9')
+    mturk.mirror.sync()
+    db.session.expire_all()
+    assert hits()['H1'].topic_id == 't1' and hits()['H2'].topic_id is None
+    assert assignments()['A1'].thread_id == 7 and assignments()['A9'].thread_id is None
+
+
+def test_sync_qualifications(mturk, fake_mturk):
+    def grant(qual_id, *worker_ids):
+        fake_mturk.qual_workers[qual_id] = [dict(QualificationTypeId=qual_id, WorkerId=w, Status='Granted')
+                                            for w in worker_ids]
+
+    for qual_id in ['Q1', 'Q2']:
+        fake_mturk.qual_types[qual_id] = dict(QualificationTypeId=qual_id, Name=qual_id, Description=qual_id)
+    grant('Q1', 'W1', 'W2')
+    grant('Q2', 'W3')
+    stats = mturk.mirror.sync()
+    assert stats['qual_types'] == 2 and stats['qual_workers_new'] == 3
+
+    grant('Q1', 'W2', 'W4')  # W1 revoked, W4 granted
+    del fake_mturk.qual_types['Q2']  # qualification type deleted
+    stats = mturk.mirror.sync()
+    assert stats['qual_workers_new'] == 1 and stats['qual_workers_deleted'] == 1
+    rows = MTurkQualifiedWorker.query.all()
+    assert sorted((row.qual_id, row.worker_id) for row in rows) == [('Q1', 'W2'), ('Q1', 'W4')]
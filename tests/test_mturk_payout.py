@@ -0,0 +1,48 @@
+import pytest
+
+from boteval import db
+from boteval.model import CrowdJob, MTurkPayment
+from boteval.mturk import MTurkService
+
+
+@pytest.fixture
+def mturk(app, fake_mturk):
+    return MTurkService(fake_mturk, sync_interval=0)
+
+
+def test_give_bonus_once(mturk, fake_mturk):
+    mturk.payout.give_bonus('A1', 'W1', amount='1.50', reason='thanks')
+    with pytest.raises(ValueError, match='already paid'):
+        mturk.payout.give_bonus('A1', 'W1', amount='1.50', reason='thanks')  # double click
+    assert fake_mturk.bonuses == [dict(WorkerId='W1', BonusAmount='1.50', AssignmentId='A1')]
+    assert fake_mturk.bonus_tokens == {mturk.payout.bonus_token('A1')}  # same token as payout jobs
+    payment = MTurkPayment.query.get('A1')
+    assert payment.bonus == '1.50' and payment.bonus_paid_at
+
+
+def test_give_bonus_claimed_by_job(mturk, fake_mturk):
+    job = CrowdJob(kind='payout', ext_src=mturk.name, status=CrowdJob.RUNNING)
+    db.session.add(job)
+    db.session.flush()
+    db.session.add(MTurkPayment(id='A2', ext_src=mturk.name, worker_id='W2', job_id=job.id))
+    db.session.commit()
+    with pytest.raises(ValueError, match='being paid by job'):
+        mturk.payout.give_bonus('A2', 'W2', amount='1.00', reason='thanks')
+    assert not fake_mturk.calls_of('send_bonus')
+
+    job.status = CrowdJob.DONE
+    db.session.commit()
+    mturk.payout.give_bonus('A2', 'W2', amount='1.00', reason='thanks')
+    assert fake_mturk.calls_of('send_bonus') == ['A2']
+
+
+def test_give_bonus_failed_is_released(mturk, fake_mturk, monkeypatch):
+    def fail(**kwargs):
+        raise RuntimeError('service unavailable')
+    monkeypatch.setattr(fake_mturk, 'send_bonus', fail)
+    with pytest.raises(RuntimeError):
+        mturk.payout.give_bonus('A3', 'W3', amount='2.00', reason='thanks')
+    assert MTurkPayment.query.get('A3').bonus_paid_at is None
+    monkeypatch.undo()
+    mturk.payout.give_bonus('A3', 'W3', amount='2.00', reason='thanks')
+    assert len(fake_mturk.bonuses) == 1
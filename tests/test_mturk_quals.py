@@ -0,0 +1,99 @@
+import time
+
+import boto3
+import pytest
+from botocore.stub import Stubber
+
+from boteval import C
+from boteval.mturk import MTurkService
+
+QUAL_NAME, QUAL_ID = 'Moderator', 'QUAL-MOD'
+
+
+@pytest.fixture
+def mturk():
+    client = boto3.client('mturk', region_name='us-east-1', endpoint_url=C.MTURK_SANDBOX_URL,
+                          aws_access_key_id='test', aws_secret_access_key='test')
+    with Stubber(client) as stubber:
+        service = MTurkService(client, qual_cache_ttl=0.5)
+        service.stubber = stubber
+        yield service
+        stubber.assert_no_pending_responses()
+
+
+def qual_type(qual_id, name):
+    return dict(QualificationTypeId=qual_id, Name=name, Description=name)
+
+
+def expect_qual_types(stubber, pages):
+    """pages: list of lists of (qual_id, name)"""
+    for i, page in enumerate(pages):
+        params = dict(MustBeRequestable=True, MustBeOwnedByCaller=True, MaxResults=C.AWS_MAX_RESULTS)
+        if i > 0:
+            params['NextToken'] = f'qt-{i}'
+        response = dict(NumResults=len(page), QualificationTypes=[qual_type(*qt) for qt in page])
+        if i < len(pages) - 1:
+            response['NextToken'] = f'qt-{i + 1}'
+        stubber.add_response('list_qualification_types', response, params)
+
+
+def expect_workers(stubber, worker_ids, page_size=C.AWS_MAX_RESULTS):
+    pages = [worker_ids[i:i + page_size] for i in range(0, len(worker_ids), page_size)] or [[]]
+    for i, page in enumerate(pages):
+        params = dict(QualificationTypeId=QUAL_ID, Status='Granted', MaxResults=C.AWS_MAX_RESULTS)
+        if i > 0:
+            params['NextToken'] = f'w-{i}'
+        quals = [dict(QualificationTypeId=QUAL_ID, WorkerId=w, IntegerValue=1, Status='Granted') for w in page]
+        response = dict(NumResults=len(page), Qualifications=quals)
+        if i < len(pages) - 1:
+            response['NextToken'] = f'w-{i + 1}'
+        stubber.add_response('list_workers_with_qualification_type', response, params)
+
+
+def test_name_is_resolved_once(mturk):
+    # the name is on the second page of qualification types
+    expect_qual_types(mturk.stubber, [[('QUAL-X', 'Other')], [(QUAL_ID, QUAL_NAME)]])
+    expect_workers(mturk.stubber, ['W1'])
+    assert mturk.is_worker_qualified('W1', QUAL_NAME)
+    assert not mturk.is_worker_qualified('W2', QUAL_NAME)  # no more AWS calls; stubber would raise
+    assert mturk.get_qualification_type_id_by_name(QUAL_NAME) == QUAL_ID
+
+
+def test_unknown_name(mturk):
+    expect_qual_types(mturk.stubber, [[('QUAL-X', 'Other')]])
+    assert not mturk.is_worker_qualified('W1', QUAL_NAME)
+    assert not mturk.is_worker_qualified('W1', QUAL_NAME)  # miss is cached too
+
+
+def test_workers_beyond_first_page(mturk):
+    workers = [f'W{i:03d}' for i in range(250)]
+    expect_qual_types(mturk.stubber, [[(QUAL_ID, QUAL_NAME)]])
+    expect_workers(mturk.stubber, workers)
+    assert mturk.is_worker_qualified('W000', QUAL_NAME)
+    assert mturk.is_worker_qualified('W249', QUAL_NAME)
+    assert len(mturk.get_qualified_workers(QUAL_ID)) == 250
+
+
+def test_workers_are_refreshed_after_ttl(mturk):
+    expect_qual_types(mturk.stubber, [[(QUAL_ID, QUAL_NAME)]])
+    expect_workers(mturk.stubber, ['W1'])
+    assert not mturk.is_worker_qualified('W2', QUAL_NAME)
+    expect_workers(mturk.stubber, ['W1', 'W2'])  # granted elsewhere, e.g. on the AWS console
+    time.sleep(0.6)
+    assert mturk.is_worker_qualified('W2', QUAL_NAME)
+
+
+def test_cache_follows_qualify_and_disqualify(mturk):
+    expect_qual_types(mturk.stubber, [[(QUAL_ID, QUAL_NAME)]])
+    expect_workers(mturk.stubber, ['W1'])
+    assert not mturk.is_worker_qualified('W2', QUAL_NAME)
+
+    mturk.stubber.add_response('associate_qualification_with_worker', {},
+                               dict(QualificationTypeId=QUAL_ID, WorkerId='W2', IntegerValue=1, SendNotification=False))
+    mturk.qualify_worker('W2', QUAL_ID, send_email=False)
+    assert mturk.is_worker_qualified('W2', QUAL_NAME)
+
+    mturk.stubber.add_response('disassociate_qualification_from_worker', {},
+                               dict(QualificationTypeId=QUAL_ID, WorkerId='W1', Reason='test'))
+    mturk.disqualify_worker('W1', QUAL_ID, reason='test')
+    assert not mturk.is_worker_qualified('W1', QUAL_NAME)
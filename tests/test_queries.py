@@ -0,0 +1,136 @@
+from contextlib import contextmanager
+from typing import List
+
+import pytest
+from sqlalchemy import event
+
+from boteval import db
+from boteval.model import ChatMessage, ChatThread, ChatTopic, SuperTopic, User
+
+USER, SECRET = 'query-counter', 'secret'
+# upper bounds; these dont grow with number of threads or messages
+MAX_STATEMENTS = dict(admin_threads=4, thread_counts=1, limit_check=2, user_threads=1)
+
+
+@contextmanager
+def count_statements():
+    """Collects SQL statements run on db engine within this block"""
+    statements: List[str] = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(db.engine, 'before_cursor_execute', before_cursor_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', before_cursor_execute)
+
+
+def loads_messages(statements: List[str]) -> bool:
+    return any('FROM message' in stmt for stmt in statements)
+
+
+def add_threads(service, user_id, n, n_messages=5) -> List[int]:
+    """Creates n topics, each with a thread of user that has seed messages and n_messages more"""
+    thread_ids = []
+    super_topic = SuperTopic.query.first()
+    user = User.query.get(user_id)
+    for _ in range(n):
+        topic = ChatTopic.create_new(super_topic, endpoint='e1', persona_id='p1', max_threads_per_topic=3,
+                                     max_turns_per_thread=4, max_human_users_per_thread=1,
+                                     human_moderator='no', reward='0')
+        thread = service.get_thread_for_topic(user, topic)
+        add_messages(thread.id, user_id, n_messages)
+        thread_ids.append(thread.id)
+    return thread_ids
+
+
+def add_messages(thread_id, user_id, n):
+    for i in range(n):
+        thread = ChatThread.query.get(thread_id)
+        msg = ChatMessage(text=f'message {i}', user_id=user_id, thread_id=thread_id, data={})
+        db.session.add(msg)
+        db.session.flush()
+        thread.count_message(msg)
+    db.session.commit()
+
+
+@pytest.fixture(scope='module')
+def client(boteval_app, service):
+    with boteval_app.app_context():
+        if not User.query.get(USER):
+            User.create_new(USER, SECRET, name='Query Counter')
+        add_threads(service, USER, 2)
+    return boteval_app.test_client()
+
+
+def login(client, user_id, secret):
+    client.get('/logout')
+    client.post('/login', data=dict(user_id=user_id, secret=secret, action='login'))
+
+
+def assert_ok(reply):
+    assert reply.status_code == 200
+
+
+def measure(boteval_app, fn):
+    with boteval_app.app_context(), count_statements() as statements:
+        fn()
+    return statements
+
+
+def test_list_and_count_paths(boteval_app, service, client):
+    from boteval import C
+    login(client, C.Auth.ADMIN_USER, C.Auth.ADMIN_SECRET)
+
+    def run_all():
+        user = User.query.get(USER)
+        topic = ChatTopic.query.first()
+        paths = dict(
+            admin_threads=lambda: assert_ok(client.get('/admin/thread/')),
+            thread_counts=lambda: service.get_thread_counts(episode_done=False),
+            limit_check=lambda: service.limit_check(topic=topic, user=user),
+            user_threads=lambda: service.get_user_threads(user=user))
+        return {name: measure(boteval_app, fn) for name, fn in paths.items()}
+
+    with boteval_app.app_context():
+        before = run_all()
+        add_threads(service, USER, 3)
+        after = run_all()
+    for name, statements in after.items():
+        assert not loads_messages(statements), f'{name} loads messages: {statements}'
+        assert len(statements) == len(before[name]), f'{name} runs a query per thread'
+        assert len(statements) <= MAX_STATEMENTS[name], f'{name}: {statements}'
+
+
+def test_chat_view(boteval_app, client):
+    login(client, USER, SECRET)
+    with boteval_app.app_context():
+        thread_id = ChatThread.query.join(User, ChatThread.users).filter(User.id == USER).first().id
+
+    def chat_view():
+        assert_ok(client.get(f'/thread/{thread_id}'))
+
+    chat_view()  # warm up dialog manager and bot agent
+    before = measure(boteval_app, chat_view)
+    with boteval_app.app_context():
+        add_messages(thread_id, USER, 10)
+    chat_view()  # dialog manager replays the new messages once
+    after = measure(boteval_app, chat_view)
+    assert len(after) == len(before) <= 8, after
+    assert sum('FROM message' in stmt for stmt in after) == 1  # messages in one query, ordered in SQL
+
+
+def test_index_page(boteval_app, service, client):
+    login(client, USER, SECRET)
+
+    def index():
+        assert_ok(client.get('/'))
+
+    before = measure(boteval_app, index)
+    with boteval_app.app_context():
+        add_threads(service, USER, 2)
+    after = measure(boteval_app, index)
+    assert not loads_messages(after), after
+    assert len(after) == len(before) <= 5, after
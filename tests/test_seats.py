@@ -0,0 +1,66 @@
+from concurrent.futures import ThreadPoolExecutor
+
+from boteval import db, C
+from boteval.model import ChatThread, ChatTopic, SuperTopic, User
+
+
+def new_topic(app, hit_id, max_threads=10, max_humans=2) -> str:
+    with app.app_context():
+        topic = ChatTopic.create_new(SuperTopic.query.first(), endpoint='e1', persona_id='p1',
+                                     max_threads_per_topic=max_threads, max_turns_per_thread=4,
+                                     max_human_users_per_thread=max_humans, human_moderator='no', reward='0.1')
+        topic.ext_id = hit_id
+        db.session.commit()
+        return topic.id
+
+
+def land(app, hit_id, worker_id, assignment_id):
+    client = app.test_client()
+    params = dict(hitId=hit_id, workerId=worker_id, assignmentId=assignment_id,
+                  turkSubmitTo='https://workersandbox.mturk.com')
+    with app.app_context():
+        if not User.query.filter_by(ext_src=C.MTURK_SANDBOX, ext_id=worker_id).first():
+            User.create_new(worker_id, 'secret', ext_id=worker_id, ext_src=C.MTURK_SANDBOX)
+    return client.get('/mturk-landing/' + hit_id, query_string=params)
+
+
+def topic_threads(app, topic_id):
+    """Humans and seed message counts of each thread of topic"""
+    with app.app_context():
+        threads = ChatThread.query.filter_by(topic_id=topic_id).all()
+        humans = [sorted(u.id for u in t.users if u.role == User.ROLE_HUMAN) for t in threads]
+        seeds = [sum(1 for m in t.messages if m.is_seed) for t in threads]
+        return humans, seeds
+
+
+def test_parallel_landings_fill_seats_exactly(boteval_app):
+    hit_id = 'HIT-PARALLEL'
+    topic_id = new_topic(boteval_app, hit_id, max_threads=5, max_humans=2)
+    workers = [f'W{i:02d}' for i in range(14)]  # 10 seats
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        replies = list(pool.map(lambda w: land(boteval_app, hit_id, w, f'A-{w}'), workers))
+
+    assert all(r.status_code in (200, 302, 400) for r in replies), [r.status_code for r in replies]
+    humans, seeds = topic_threads(boteval_app, topic_id)
+    assert len(humans) == 5
+    assert all(len(h) == 2 for h in humans)  # no thread is over or under filled
+    joined = [w for h in humans for w in h]
+    assert len(joined) == len(set(joined)) == 10
+    assert seeds == [3] * 5  # seed messages are copied once per thread
+
+
+def test_reentry_does_not_lock_topic(boteval_app):
+    hit_id = 'HIT-REENTRY'
+    topic_id = new_topic(boteval_app, hit_id)
+    land(boteval_app, hit_id, 'W-RE', 'A-RE')
+    with boteval_app.app_context():
+        topic = ChatTopic.query.get(topic_id)
+        join_count, time_updated = topic.join_count, topic.time_updated
+    for _ in range(3):
+        land(boteval_app, hit_id, 'W-RE', 'A-RE')
+    with boteval_app.app_context():
+        topic = ChatTopic.query.get(topic_id)
+        assert topic.join_count == join_count == 1
+        assert topic.time_updated == time_updated
+    humans, _ = topic_threads(boteval_app, topic_id)
+    assert humans == [['W-RE']]